@@ -58,5 +58,46 @@ def create_app():
     with app.app_context():
         from app import models  # noqa: F401
         db.create_all()
+        _upgrade_schema()
 
-    return app
\ No newline at end of file
+    return app
+
+
+def _upgrade_schema():
+    """create_all не добавляет колонки в уже существующие таблицы — дописываем новые вручную."""
+    from sqlalchemy import inspect, text
+
+    inspector = inspect(db.engine)
+    columns = {column['name'] for column in inspector.get_columns('documents')}
+    if 'content_hash' not in columns:
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE documents ADD COLUMN content_hash VARCHAR(64)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_documents_content_hash ON documents (content_hash)"))
+    columns = {column['name'] for column in inspector.get_columns('chat_sessions')}
+    if 'document_scope' not in columns:
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE chat_sessions ADD COLUMN document_scope TEXT"))
+    if db.engine.dialect.name == 'sqlite':
+        _add_documents_autoincrement()
+
+
+def _add_documents_autoincrement():
+    """
+    Без AUTOINCREMENT SQLite отдаёт новому документу id удалённого последним — а вместе
+    с ним и id векторов, которые ещё могут лежать в индексе (tombstones HNSW, чанки,
+    перешедшие к другим документам). Флаг задаётся только при создании таблицы,
+    поэтому старая таблица documents пересоздаётся с теми же данными.
+    """
+    from sqlalchemy import text
+    from app.models import Document
+
+    with db.engine.begin() as conn:
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'documents'")).scalar()
+        if not sql or 'AUTOINCREMENT' in sql.upper():
+            return
+        columns = ', '.join(column.name for column in Document.__table__.columns)
+        conn.execute(text("DROP INDEX IF EXISTS ix_documents_content_hash"))
+        conn.execute(text("ALTER TABLE documents RENAME TO documents_old"))
+        Document.__table__.create(conn)
+        conn.execute(text(f"INSERT INTO documents ({columns}) SELECT {columns} FROM documents_old"))
+        conn.execute(text("DROP TABLE documents_old"))
\ No newline at end of file
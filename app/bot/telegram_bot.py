@@ -33,6 +33,7 @@ if project_root not in sys.path:
 # =================================================
 from config import Config
 # === ИМПОРТЫ ===
+import asyncio
 import logging
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -47,6 +48,8 @@ from telegram.ext import (
 # Импортируем конфигурацию и LLMManager из проекта
 from config import Config
 from app.services.llm_manager import LLMManager
+from app.services.conversation_memory import build_memory
+from app.services.cache import LRUCache
 # ===============
 
 # === НАСТРОЙКА ЛОГИРОВАНИЯ ===
@@ -63,11 +66,44 @@ SELECTING_MODEL, CHATTING, CHANGING_MODEL = range(3)
 # ========================================
 
 # === ХРАНЕНИЕ СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ===
-# Для MVP используем глобальный словарь.
-# {user_id: {'llm_manager': LLMManager_instance, 'model': 'yandex_gpt'/'local_llm', 'history': []}}
-user_states = {}
+# user_id -> {'model': 'yandex_gpt'/'local_llm', 'memory': ConversationMemory}
+# История каждого пользователя ограничена бюджетом токенов (CONVERSATION_MAX_TOKENS),
+# а число пользователей в памяти — LRU (BOT_USER_STATES_SIZE) и временем простоя
+# (BOT_USER_STATES_TTL_SEC): после него бот попросит начать с /start
+user_states = LRUCache(max_size=max(1, Config.BOT_USER_STATES_SIZE), ttl=Config.BOT_USER_STATES_TTL_SEC)
+
+def get_user_state(user_id):
+    """Состояние пользователя или None; обращение продлевает его TTL."""
+    user_state = user_states.get(user_id)
+    if user_state is not None:
+        user_states.set(user_id, user_state)
+    return user_state
 # ======================================
 
+# === ОБЩИЙ LLMManager ===
+# Один на процесс: провайдеры и их пулы HTTP-соединений общие для всех пользователей,
+# модель передаётся в каждый запрос, поэтому память не растёт с числом пользователей
+_llm_manager = None
+
+def get_config_dict() -> dict:
+    return {key: getattr(Config, key) for key in dir(Config) if not key.startswith('__')}
+
+def get_llm_manager() -> LLMManager:
+    global _llm_manager
+    if _llm_manager is None:
+        _llm_manager = LLMManager(get_config_dict()) # ✅ Передаём СЛОВАРЬ
+        logger.info("LLMManager создан.")
+    return _llm_manager
+# ========================
+
+# === ОГРАНИЧЕНИЕ ПАРАЛЛЕЛЬНЫХ ЗАПРОСОВ К LLM ===
+# Обработчики работают конкурентно (concurrent_updates), запросы к LLM идут через
+# AsyncOpenAI и не блокируют event loop; семафор ограничивает их число
+llm_semaphore = asyncio.Semaphore(Config.BOT_MAX_CONCURRENT_REQUESTS)
+# Ссылки на фоновые задачи (суммаризация истории), чтобы их не собрал GC
+_background_tasks = set()
+# ==============================================
+
 # === ХЭНДЛЕРЫ ===
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -75,17 +111,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     logger.info(f"Пользователь {user_id} начал диалог (/start).")
 
-    # Инициализируем LLMManager для этого пользователя
+    # Проверяем, что LLM-провайдеры доступны, и заводим состояние пользователя
     try:
-        config_dict = {key: getattr(Config, key) for key in dir(Config) if not key.startswith('__')}
-        llm_manager = LLMManager(config_dict) # ✅ Передаём СЛОВАРЬ
-        # Сохраняем менеджер и пустую историю в состоянии пользователя
-        user_states[user_id] = {
-            'llm_manager': llm_manager,
+        get_llm_manager()
+        user_states.set(user_id, {
             'model': None,
-            'history': [] # Для MVP: список сообщений в формате {'role': '...', 'content': '...'}
-        }
-        logger.info(f"LLMManager создан для пользователя {user_id}.")
+            'memory': build_memory(get_config_dict())
+        })
     except Exception as e:
         logger.error(f"Ошибка создания LLMManager для пользователя {user_id}: {e}")
         await update.message.reply_text(
@@ -113,9 +145,9 @@ async def select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     user_id = update.effective_user.id
     text = update.message.text
     logger.info(f"Пользователь {user_id} выбрал: {text}")
-    user_state = user_states.get(user_id)
+    user_state = get_user_state(user_id)
     
-    if not user_state or not user_state.get('llm_manager'):
+    if not user_state:
         logger.warning(f"Пользователь {user_id} без состояния пытался выбрать модель.")
         await update.message.reply_text(
             "⚠️ Ошибка состояния. Начни сначала с /start.",
@@ -123,7 +155,7 @@ async def select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         )
         return ConversationHandler.END
 
-    llm_manager = user_state['llm_manager']
+    llm_manager = get_llm_manager()
     available_models = {m['name'] for m in llm_manager.get_available_models()}
     # Сопоставляем текст с внутренним именем модели
     model_map = {
@@ -152,11 +184,10 @@ async def select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         return CHANGING_MODEL
 
     try:
-        # Переключаем LLMManager на выбранную модель
-        llm_manager.switch_model(model_name)
+        # Запоминаем модель — она передаётся в каждый запрос к LLM
         user_state['model'] = model_name
         # Сбрасываем историю при смене модели
-        user_state['history'] = []
+        user_state['memory'].clear()
         logger.info(f"Пользователь {user_id} успешно переключился на модель: {model_name}")
 
     
@@ -190,16 +221,13 @@ async def select_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def change_model_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик выбора новой модели через /model."""
     user_id = update.effective_user.id
-    user_state = user_states.get(user_id)
+    user_state = get_user_state(user_id)
     
-    if not user_state or not user_state.get('llm_manager'):
+    if not user_state:
         await update.message.reply_text("⚠️ Пожалуйста, сначала начни с /start.")
         return ConversationHandler.END
 
-    llm_manager = user_state.get('llm_manager')
-    if not llm_manager:
-        await update.message.reply_text("⚠️ Ошибка состояния. Начни сначала с /start.")
-        return ConversationHandler.END
+    llm_manager = get_llm_manager()
 
     text = update.message.text
     model_map = {
@@ -228,11 +256,10 @@ async def change_model_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return CHANGING_MODEL
 
     try:
-        user_state['llm_manager'].switch_model(model_name)
         user_state['model'] = model_name
-        user_state['history'] = [] # Сбрасываем историю
+        user_state['memory'].clear() # Сбрасываем историю
         logger.info(f"Пользователь {user_id} успешно переключился на модель: {model_name}")
-        model_info = next((m for m in user_state['llm_manager'].get_available_models() if m['name'] == model_name), {})
+        model_info = next((m for m in llm_manager.get_available_models() if m['name'] == model_name), {})
         display_name = model_info.get('display_name', model_name)
         await update.message.reply_text(
             f"✅ Модель успешно изменена на: <b>{display_name}</b>",
@@ -250,10 +277,26 @@ async def change_model_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
 
 
+async def summarize_memory(memory, model_name: str) -> None:
+    """Сворачивает вытесненные из памяти реплики в краткое содержание."""
+    # Параллельная задача того же пользователя уже сворачивает историю — вытесненное подберёт следующая
+    turns = memory.begin_summary()
+    if not turns:
+        return
+    summary = None
+    try:
+        async with llm_semaphore:
+            summary = await get_llm_manager().asummarize(memory.summary, turns, model=model_name)
+    except Exception as e:
+        logger.warning(f"Не удалось свернуть историю: {e}")
+    finally:
+        memory.finish_summary(summary)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает текстовые сообщения пользователя во время чата."""
     user_id = update.effective_user.id    
-    user_state = user_states.get(user_id)
+    user_state = get_user_state(user_id)
     user_message_text = update.message.text
     logger.info(f"Получено сообщение от пользователя {user_id}: {user_message_text}")
         
@@ -263,9 +306,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("ℹ️ Пожалуйста, сначала выбери модель с помощью /start.")
         return
 
-    llm_manager = user_state['llm_manager']
+    llm_manager = get_llm_manager()
     model_name = user_state['model']
-    chat_history = user_state['history']
+    memory = user_state['memory']
 
     # --- Отправляем сообщение "печатает..." ---
     await update.message.chat.send_action("typing")
@@ -273,25 +316,30 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     try:
         # --- Подготовка контекста из истории ---
-        MAX_HISTORY_PAIRS = 5 # 5 пар вопрос-ответ
-        recent_history = chat_history[-(MAX_HISTORY_PAIRS * 2):] if len(chat_history) > MAX_HISTORY_PAIRS * 2 else chat_history
-
-        # Добавляем новое сообщение пользователя в историю
-        chat_history.append({"role": "user", "content": user_message_text})
+        # Последние реплики в пределах бюджета токенов (+ краткое содержание старых)
+        chat_history = memory.messages()
 
         # --- Генерация ответа с историей ---
         logger.info(f"Отправка запроса в LLM ({model_name}) для пользователя {user_id} с историей...")
-        result_dict = llm_manager.generate_response(
-            prompt=user_message_text,
-            chat_history=chat_history 
-        )
+        async with llm_semaphore:
+            result_dict = await llm_manager.agenerate_response(
+                prompt=user_message_text,
+                chat_history=chat_history,
+                model=model_name
+            )
 
         bot_response = result_dict.get('response', 'Извините, не удалось сгенерировать ответ.')
         model_used_final = result_dict.get('model_used', model_name)
         logger.info(f"Ответ от LLM ({model_used_final}) для пользователя {user_id} получен (длина: {len(bot_response)} символов).")
 
-        # Добавляем ответ ассистента в историю
-        chat_history.append({"role": "assistant", "content": bot_response})
+        # Добавляем вопрос и ответ в историю
+        memory.add('user', user_message_text)
+        memory.add('assistant', bot_response)
+        if Config.CONVERSATION_SUMMARY_ENABLED and memory.has_evicted():
+            # Сворачиваем вытесненные реплики в фоне, ответ пользователю не ждёт
+            task = asyncio.create_task(summarize_memory(memory, model_name))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
 
         # === ФОРМАТИРУЕМ ОТВЕТ С УКАЗАНИЕМ МОДЕЛИ И ЭМОДЗИ ===
         # Получаем отображаемое имя модели
@@ -313,9 +361,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /model — предлагает сменить модель."""
     user_id = update.effective_user.id
-    user_state = user_states.get(user_id)
+    user_state = get_user_state(user_id)
     
-    if not user_state or not user_state.get('llm_manager'):
+    if not user_state:
         await update.message.reply_text("⚠️ Пожалуйста, сначала начни с /start.")
         return
 
@@ -329,14 +377,14 @@ async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /reset — сбрасывает историю чата."""
     user_id = update.effective_user.id
-    user_state = user_states.get(user_id)
+    user_state = get_user_state(user_id)
     
     if not user_state or not user_state.get('model'):
         await update.message.reply_text("⚠️ Пожалуйста, сначала выбери модель с помощью /start.")
         return
 
     # Сбрасываем историю
-    user_state['history'] = []
+    user_state['memory'].clear()
     await update.message.reply_text("🔄 История чата сброшена. Начни новый диалог!")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -354,8 +402,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик команды /cancel. Завершает диалог."""
     user_id = update.effective_user.id
-    if user_id in user_states:
-        del user_states[user_id]
+    user_states.pop(user_id)
     logger.info(f"Пользователь {user_id} отменил диалог (/cancel).")
     await update.message.reply_text(
         "⏹ Диалог отменен. Начни сначала с /start.",
@@ -387,7 +434,8 @@ def run_bot() -> None:
 
     # 3. Создаем приложение бота
     try:
-        application = Application.builder().token(TOKEN).build()
+        # Обновления разных пользователей обрабатываются параллельно
+        application = Application.builder().token(TOKEN).concurrent_updates(True).build()
         logger.info("Application (ApplicationBuilder) создано.")
     except Exception as e:
         logger.critical(f"Ошибка создания Application: {e}")
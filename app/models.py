@@ -25,6 +25,7 @@ class ChatSession(db.Model):
     title = db.Column(db.String(200), nullable=False, default='Новая сессия')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     model_used = db.Column(db.String(50), default='yandex_gpt')  # 'yandex_gpt' или 'local'
+    document_scope = db.Column(db.Text, nullable=True)  # JSON-список id документов для RAG; NULL — все документы
 
     messages = db.relationship('Message', backref='session', lazy=True, cascade='all, delete-orphan')
 
@@ -48,12 +49,15 @@ class Message(db.Model):
 
 class Document(db.Model):
     __tablename__ = 'documents'
+    # id документа входит в id его векторов в FAISS: id удалённого документа не должен достаться новому
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
     file_size = db.Column(db.Integer, nullable=False)  # в байтах
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     processed = db.Column(db.Boolean, default=False)
+    content_hash = db.Column(db.String(64), index=True, nullable=True)  # SHA-256 файла: повторная загрузка не индексируется
 
     def __repr__(self):
         return f'<Document {self.filename}>'
\ No newline at end of file
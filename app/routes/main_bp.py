@@ -1,8 +1,9 @@
 # app/routes/main_bp.py
-from flask import Blueprint, render_template, request, jsonify, current_app
+from flask import Blueprint, render_template, request, jsonify, current_app, Response, stream_with_context
 from app.models import db, ChatSession, Message, Document
 from app import db
 import threading
+import json
 
 main_bp = Blueprint('main', __name__)
 
@@ -14,23 +15,57 @@ def get_llm_manager():
 
 def get_rag_engine():
     if 'rag_engine' not in current_app.config:
-        from app.services.vector_db import VectorDB
-        from app.services.rag_engine import RAGEngine
-        config = current_app.config
-        vector_db = VectorDB(
-            index_path=config['FAISS_INDEX_PATH'],
-            embedding_model_name=config['EMBEDDING_MODEL']
-        )
-        vector_db.initialize_index()
-        rag_engine = RAGEngine(
-            vector_db=vector_db,
-            embedding_model_name=config['EMBEDDING_MODEL'],
-            chunk_size=config['CHUNK_SIZE'],
-            chunk_overlap=config['CHUNK_OVERLAP']
-        )
-        current_app.config['rag_engine'] = rag_engine
+        from app.services.rag_engine import build_rag_engine
+        current_app.config['rag_engine'] = build_rag_engine(current_app.config)
     return current_app.config['rag_engine']
 
+def get_conversation_memories():
+    """LRU-кэш ConversationMemory по session_id: число сессий в памяти ограничено."""
+    if 'conversation_memories' not in current_app.config:
+        from app.services.cache import LRUCache
+        current_app.config['conversation_memories'] = LRUCache(
+            max_size=current_app.config.get('CONVERSATION_CACHE_SESSIONS', 1000),
+            ttl=current_app.config.get('CONVERSATION_CACHE_TTL_SEC', 3600)
+        )
+    return current_app.config['conversation_memories']
+
+def _load_history(session_id, llm_manager, model):
+    """
+    История сессии для LLM. Память собирается из Message один раз, дальше из БД
+    догружаются только сообщения новее last_message_id.
+    """
+    from app.services.conversation_memory import build_memory
+    memories = get_conversation_memories()
+    memory = memories.get(session_id)
+    if memory is None:
+        memory = build_memory(current_app.config)
+        # Больше max_turns последних сообщений в память всё равно не попадёт
+        rows = (Message.query.filter_by(session_id=session_id)
+                .order_by(Message.id.desc()).limit(memory.max_turns).all())
+        rows.reverse()
+    else:
+        rows = (Message.query.filter(Message.session_id == session_id, Message.id > memory.last_message_id)
+                .order_by(Message.id).all())
+    memory.extend([(msg.id, 'user' if msg.is_user else 'assistant', msg.content) for msg in rows])
+    memories.set(session_id, memory)
+
+    if current_app.config.get('CONVERSATION_SUMMARY_ENABLED') and memory.has_evicted():
+        # Не больше одной суммаризации на сессию: остальные запросы её не запускают
+        turns = memory.begin_summary()
+        if turns:
+            threading.Thread(target=_summarize_memory, args=(memory, turns, llm_manager, model,
+                                                             current_app.logger), daemon=True).start()
+    return memory.messages()
+
+def _summarize_memory(memory, turns, llm_manager, model, logger):
+    summary = None
+    try:
+        summary = llm_manager.summarize(memory.summary, turns, model=model)
+    except Exception as e:
+        logger.warning(f"Conversation summary failed: {e}")
+    finally:
+        memory.finish_summary(summary)
+
 @main_bp.route('/')
 def index():
     # Получаем или создаём дефолтного пользователя и сессию (для однопользовательского режима)
@@ -50,20 +85,43 @@ def index():
 
     return render_template('chat.html', session_id=session.id)
 
-@main_bp.route('/api/chat', methods=['POST'])
-def chat():
-    data = request.get_json()
+def _prepare_chat(data):
+    """
+    Общая часть /api/chat и /api/chat/stream: проверка запроса, сообщение пользователя,
+    RAG-контекст и LLMManager с моделью сессии.
+    Возвращает (context, None) или (None, (ответ с ошибкой, код)).
+    """
     message_text = data.get('message', '').strip()
     session_id = data.get('session_id')
 
     if not message_text or not session_id:
-        return jsonify({'error': 'Message and session_id are required'}), 400
+        return None, (jsonify({'error': 'Message and session_id are required'}), 400)
 
     session = ChatSession.query.get(session_id)
     if not session:
-        return jsonify({'error': 'Session not found'}), 404
+        return None, (jsonify({'error': 'Session not found'}), 404)
+
+    # Область поиска: doc_ids из запроса заменяют область документов сессии, даты сужают её
+    from app.services.search_scope import parse_search_filters, load_session_scope, resolve_document_scope
+    try:
+        filters = parse_search_filters(data)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+    if filters['doc_ids'] is None:
+        filters['doc_ids'] = load_session_scope(session)
 
-    # Сохраняем сообщение пользователя
+    # Модель сессии передаётся в сам запрос: общий LLMManager не переключается
+    llm_manager = get_llm_manager()
+    try:
+        llm_manager.get_provider(session.model_used)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+
+    # История — до нового сообщения: оно уйдёт в LLM отдельно, как prompt
+    chat_history = _load_history(session.id, llm_manager, session.model_used)
+
+    # Сохраняем сообщение пользователя сразу: открытая транзакция держала бы
+    # блокировку записи SQLite всё время запроса к LLM и тормозила параллельные чаты
     user_message = Message(
         session_id=session_id,
         content=message_text,
@@ -71,30 +129,52 @@ def chat():
         used_rag=False
     )
     db.session.add(user_message)
+    db.session.commit()
 
-    # Проверяем, есть ли обработанные документы → включаем RAG
-    has_processed_docs = Document.query.filter_by(processed=True).count() > 0
+    # Проверяем, есть ли обработанные документы (в области поиска, если она задана) → включаем RAG
+    doc_scope = resolve_document_scope(**filters)
+    if doc_scope is None:
+        has_processed_docs = Document.query.filter_by(processed=True).count() > 0
+    else:
+        has_processed_docs = bool(doc_scope)
     rag_context = ""
+    context_hashes = []
     used_rag = False
 
     if has_processed_docs:
         rag_engine = get_rag_engine()
-        rag_context = rag_engine.augment_prompt(message_text, k=3)
+        rag_context, context_hashes = rag_engine.build_context(message_text, k=current_app.config['RAG_TOP_K'],
+                                                               doc_ids=doc_scope)
         used_rag = bool(rag_context.strip())
 
-    # Переключаем LLM на модель из сессии
-    llm_manager = get_llm_manager()
-    try:
-        llm_manager.switch_model(session.model_used)        
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
+    return {
+        'session': session,
+        'message_text': message_text,
+        'rag_context': rag_context,
+        'context_hashes': context_hashes,
+        'used_rag': used_rag,
+        'chat_history': chat_history,
+        'model': session.model_used,
+        'llm_manager': llm_manager
+    }, None
+
+@main_bp.route('/api/chat', methods=['POST'])
+def chat():
+    chat_ctx, error = _prepare_chat(request.get_json() or {})
+    if error:
+        return error
+    session = chat_ctx['session']
+    used_rag = chat_ctx['used_rag']
 
     # Генерация ответа
     try:
-        response_dict = llm_manager.generate_response(
-            prompt=message_text,
+        response_dict = chat_ctx['llm_manager'].generate_response(
+            prompt=chat_ctx['message_text'],
             use_rag=used_rag,
-            rag_context=rag_context
+            rag_context=chat_ctx['rag_context'],
+            chat_history=chat_ctx['chat_history'],
+            context_hashes=chat_ctx['context_hashes'],
+            model=chat_ctx['model']
         )
         # Извлекаем текст ответа из словаря
         response_text_to_save = response_dict['response']
@@ -106,7 +186,7 @@ def chat():
 
     # Сохраняем ответ ассистента
     ai_message = Message(
-        session_id=session_id,
+        session_id=session.id,
         content=response_text_to_save,
         is_user=False,
         used_rag=used_rag,
@@ -118,8 +198,72 @@ def chat():
     return jsonify({
         'response': response_text_to_save,
         'used_rag': used_rag,
-        'model_used': session.model_used
+        'cached': response_dict.get('cached', False),
+        'model_used': model_used
     })
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@main_bp.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    То же, что /api/chat, но ответ приходит по мере генерации (Server-Sent Events):
+    event: token {"text": "..."} — очередной фрагмент,
+    event: done {"used_rag", "model_used", "cached", "ttft_ms", "total_ms"} — конец ответа,
+    event: error {"error": "..."} — генерация прервалась.
+    Сообщение ассистента сохраняется в БД, когда поток завершился.
+    """
+    chat_ctx, error = _prepare_chat(request.get_json() or {})
+    if error:
+        return error
+    session_id = chat_ctx['session'].id
+    used_rag = chat_ctx['used_rag']
+
+    def generate():
+        try:
+            for event in chat_ctx['llm_manager'].stream_response(
+                prompt=chat_ctx['message_text'],
+                use_rag=used_rag,
+                rag_context=chat_ctx['rag_context'],
+                chat_history=chat_ctx['chat_history'],
+                context_hashes=chat_ctx['context_hashes'],
+                model=chat_ctx['model']
+            ):
+                if 'token' in event:
+                    yield _sse('token', {'text': event['token']})
+                    continue
+
+                db.session.add(Message(
+                    session_id=session_id,
+                    content=event['response'],
+                    is_user=False,
+                    used_rag=used_rag,
+                    model_used=event['model_used']
+                ))
+                db.session.commit()
+                current_app.logger.info(
+                    f"Chat stream finished: ttft={event['ttft_ms']} ms, total={event['total_ms']} ms, "
+                    f"cached={event['cached']}"
+                )
+                yield _sse('done', {
+                    'used_rag': used_rag,
+                    'model_used': event['model_used'],
+                    'cached': event['cached'],
+                    'ttft_ms': event['ttft_ms'],
+                    'total_ms': event['total_ms']
+                })
+        except Exception as e:
+            current_app.logger.error(f"LLM streaming error: {e}")
+            db.session.rollback()
+            yield _sse('error', {'error': 'Failed to generate response'})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # nginx не должен буферизовать поток
+        'X-Accel-Buffering': 'no'
+    })
+
 @main_bp.route('/api/current-session', methods=['GET'])
 def get_current_session():
     from app.models import User, ChatSession
@@ -155,6 +299,32 @@ def get_session_info(session_id):
         'model_used': session.model_used,
         'created_at': session.created_at.isoformat()
     })
+@main_bp.route('/api/session/<int:session_id>/documents', methods=['GET', 'PUT'])
+def session_documents(session_id):
+    """
+    Область документов сессии для RAG: {"doc_ids": [1, 2]} — чат ищет только в этих
+    документах, {"doc_ids": null} — во всех. doc_ids в самом запросе /api/chat её заменяют.
+    """
+    from app.services.search_scope import parse_doc_ids, load_session_scope, dump_session_scope
+    session = ChatSession.query.get(session_id)
+    if not session:
+        return jsonify({'error': 'Session not found'}), 404
+
+    if request.method == 'PUT':
+        try:
+            doc_ids = parse_doc_ids((request.get_json() or {}).get('doc_ids'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if doc_ids:
+            found = {doc.id for doc in Document.query.filter(Document.id.in_(doc_ids)).all()}
+            missing = sorted(set(doc_ids) - found)
+            if missing:
+                return jsonify({'error': f'Documents not found: {missing}'}), 404
+        session.document_scope = dump_session_scope(doc_ids)
+        db.session.commit()
+
+    return jsonify({'session_id': session.id, 'doc_ids': load_session_scope(session)})
+
 @main_bp.route('/api/session/<int:session_id>/messages', methods=['GET'])
 def get_session_messages(session_id):
     messages = Message.query.filter_by(session_id=session_id).order_by(Message.timestamp).all()
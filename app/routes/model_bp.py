@@ -33,9 +33,10 @@ def switch_model():
     if not session:
         return jsonify({'error': 'Session not found'}), 404
 
+    # Модель сохраняется только в сессии; общий LLMManager не переключается
     llm_manager = get_llm_manager()
     try:
-        llm_manager.switch_model(model_name)
+        llm_manager.get_provider(model_name)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
@@ -46,4 +47,39 @@ def switch_model():
         'success': True,
         'message': f'Model switched to {model_name}',
         'session_id': session_id
-    })
\ No newline at end of file
+    })
+
+@model_bp.route('/llm-health', methods=['GET'])
+def llm_health():
+    """Режим маршрутизации, состояние circuit breaker'ов и латентности провайдеров."""
+    from app.services.llm_routing import get_provider_health
+    llm_manager = get_llm_manager()
+    return jsonify({
+        'routing_mode': llm_manager.routing_mode,
+        'fallback_chain': llm_manager.fallback_chain,
+        'providers': {
+            name: get_provider_health(name, current_app.config).get_stats()
+            for name in llm_manager.providers
+        }
+    })
+
+@model_bp.route('/response-cache', methods=['GET'])
+def response_cache_stats():
+    cache = get_llm_manager().response_cache
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(cache.get_stats(), enabled=True))
+
+@model_bp.route('/response-cache/invalidate', methods=['POST'])
+def invalidate_response_cache():
+    """
+    Сбрасывает кэш ответов: {"model": "yandex_gpt"} — только для одной модели, {} — целиком.
+    """
+    data = request.get_json(silent=True) or {}
+    model_name = data.get('model')
+    llm_manager = get_llm_manager()
+    if model_name and model_name not in llm_manager.providers:
+        return jsonify({'error': f"Unknown model '{model_name}'"}), 400
+    if llm_manager.response_cache is None:
+        return jsonify({'enabled': False, 'removed': 0})
+    return jsonify({'enabled': True, 'removed': llm_manager.response_cache.invalidate(model_name)})
@@ -1,11 +1,12 @@
 # app/routes/rag_bp.py
 
 import os
-import threading
 import magic  
 from flask import Blueprint, render_template, request, jsonify, current_app
 from werkzeug.utils import secure_filename
 from app.models import db, Document
+from app.services.ingestion import IngestionQueueFull, JOB_QUEUED, JOB_PROCESSING, allocate_document_path
+from app.services.content_hash import hash_file
 
 rag_bp = Blueprint('rag', __name__)
 
@@ -21,58 +22,31 @@ def get_rag_engine():
     Ленивая инициализация RAGEngine с кэшированием в app.config.
     """
     if 'rag_engine' not in current_app.config:
-        from app.services.vector_db import VectorDB
-        from app.services.rag_engine import RAGEngine
-
-        config = current_app.config
-        vector_db = VectorDB(
-            index_path=config['FAISS_INDEX_PATH'],
-            embedding_model_name=config['EMBEDDING_MODEL']
-        )
-        vector_db.initialize_index()
-
-        rag_engine = RAGEngine(
-            vector_db=vector_db,
-            embedding_model_name=config['EMBEDDING_MODEL'],
-            chunk_size=config['CHUNK_SIZE'],
-            chunk_overlap=config['CHUNK_OVERLAP']
-        )
-        current_app.config['rag_engine'] = rag_engine
+        from app.services.rag_engine import build_rag_engine
+        current_app.config['rag_engine'] = build_rag_engine(current_app.config)
 
     return current_app.config['rag_engine']
 
-def process_document_background(doc_id, file_path):
-    from app import create_app  
-    app = create_app()
+def get_ingestion_queue():
+    """
+    Ленивый запуск пула индексации (один на приложение).
+    Пул пишет в тот же RAGEngine, что и поиск, поэтому новые чанки сразу видны в чате.
+    """
+    if 'ingestion_queue' not in current_app.config:
+        from app.services.ingestion import IngestionQueue
 
-    with app.app_context():
-        try:
-            from app.models import db, Document  
-            from app.services.rag_engine import RAGEngine  
-            from flask import current_app
-
-            current_app.logger.info(f"Starting background processing for doc {doc_id} at {file_path}")
-            rag_engine = get_rag_engine()
-            current_app.logger.info(f"RAG engine loaded for doc {doc_id}")
-            success = rag_engine.add_document(file_path, doc_id)
-            current_app.logger.info(f"RAG engine add_document returned: {success}")
-
-            # Обновляем статус в БД
-            doc = Document.query.get(doc_id)
-            if doc:
-                doc.processed = success
-                db.session.commit()
-                if success:
-                    current_app.logger.info(f"Document {doc_id} processed successfully")
-                else:
-                    current_app.logger.warning(f"Failed to process document {doc_id}")
-        except Exception as e:
-            current_app.logger.error(f"Background processing error for doc {doc_id}: {e}", exc_info=True)
-            # Помечаем как необработанный, если ошибка
-            doc = Document.query.get(doc_id)
-            if doc:
-                doc.processed = False
-                db.session.commit()
+        config = current_app.config
+        ingestion_queue = IngestionQueue(
+            app=current_app._get_current_object(),
+            engine_getter=get_rag_engine,
+            workers=config['INGESTION_WORKERS'],
+            max_queue=config['INGESTION_QUEUE_SIZE'],
+            batch_docs=config['INGESTION_BATCH_DOCS']
+        )
+        ingestion_queue.start()
+        current_app.config['ingestion_queue'] = ingestion_queue
+
+    return current_app.config['ingestion_queue']
 
 @rag_bp.route('/')  # <-- HTML-маршрут для страницы "Документы"
 def upload_page():
@@ -86,8 +60,17 @@ def upload_page():
 def upload_document():
     """
     Загружает файл, проверяет тип и размер, сохраняет на диск,
-    создаёт запись в БД и запускает фоновую обработку.
+    создаёт запись в БД и ставит документ в очередь индексации.
+    Если очередь заполнена — 429, клиенту стоит повторить позже.
+    Файл с тем же содержимым (SHA-256), что у уже загруженного документа, не сохраняется
+    и не индексируется — возвращается существующий документ (200, status=duplicate).
+    Поле формы replaces=<doc_id> загружает новую версию документа: эмбеддятся только
+    новые и изменённые чанки, старая версия удаляется после индексации.
     """
+    ingestion_queue = get_ingestion_queue()
+    if ingestion_queue.is_full():
+        return jsonify({'error': 'Ingestion queue is full, try again later'}), 429
+
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
 
@@ -119,18 +102,33 @@ def upload_document():
     if mime_type not in ALLOWED_MIME_TYPES:
         return jsonify({'error': f'Unsupported file type: {mime_type}'}), 400
 
-    # Сохраняем файл
-    documents_folder = current_app.config['DOCUMENTS_FOLDER']
-    file_path = os.path.join(documents_folder, filename)
+    replaces = request.form.get('replaces')
+    if replaces is not None:
+        try:
+            replaces = int(replaces)
+        except ValueError:
+            return jsonify({'error': 'replaces must be a document id'}), 400
+        if not Document.query.get(replaces):
+            return jsonify({'error': 'Document to replace not found'}), 404
+
+    # Тот же файл уже загружен и проиндексирован (или в очереди) — повторно не индексируем
+    content_hash = hash_file(file.stream)
+    file.seek(0)
+    duplicate = Document.query.filter_by(content_hash=content_hash).order_by(Document.id.desc()).first()
+    if duplicate:
+        job = ingestion_queue.get_job_for_doc(duplicate.id)
+        if duplicate.processed or (job and job.status in (JOB_QUEUED, JOB_PROCESSING)):
+            return jsonify({
+                'doc_id': duplicate.id,
+                'job_id': job.job_id if job else None,
+                'filename': duplicate.filename,
+                'status': 'duplicate'
+            }), 200
 
+    # Сохраняем файл
     # Избегаем коллизий имён
-    counter = 1
     original_name = filename
-    while os.path.exists(file_path):
-        name, ext = os.path.splitext(original_name)
-        filename = f"{name}_{counter}{ext}"
-        file_path = os.path.join(documents_folder, filename)
-        counter += 1
+    file_path, filename = allocate_document_path(current_app.config['DOCUMENTS_FOLDER'], filename)
 
     file.save(file_path)
 
@@ -138,51 +136,74 @@ def upload_document():
     doc = Document(
         filename=original_name,
         file_path=file_path,
-        file_size=file_size
+        file_size=file_size,
+        content_hash=content_hash
     )
     db.session.add(doc)
     db.session.commit()
 
-    # Запускаем фоновую обработку
-    thread = threading.Thread(
-        target=process_document_background,
-        args=(doc.id, file_path)
-    )
-    thread.daemon = True
-    thread.start()
+    # Ставим в очередь индексации
+    try:
+        job = ingestion_queue.submit(doc.id, file_path, replaces=replaces)
+    except IngestionQueueFull as e:
+        # Очередь заполнилась между проверкой и постановкой — откатываем загрузку
+        db.session.delete(doc)
+        db.session.commit()
+        os.remove(file_path)
+        return jsonify({'error': str(e)}), 429
 
     return jsonify({
         'doc_id': doc.id,
+        'job_id': job.job_id,
         'filename': original_name,
+        'replaces': replaces,
         'status': 'uploaded, processing started'
     }), 202
 
 @rag_bp.route('/documents', methods=['GET'])
 def list_documents():
     """
-    Возвращает список всех загруженных документов с флагом processed.
+    Возвращает список всех загруженных документов с флагом processed
+    и статусом задачи индексации (queued / processing / done / failed).
     """
+    ingestion_queue = get_ingestion_queue()
     docs = Document.query.order_by(Document.uploaded_at.desc()).all()
-    result = [{
-        'id': d.id,
-        'filename': d.filename,
-        'file_size': d.file_size,
-        'uploaded_at': d.uploaded_at.isoformat(),
-        'processed': d.processed
-    } for d in docs]
+    result = []
+    for d in docs:
+        job = ingestion_queue.get_job_for_doc(d.id)
+        result.append({
+            'id': d.id,
+            'filename': d.filename,
+            'file_size': d.file_size,
+            'uploaded_at': d.uploaded_at.isoformat(),
+            'processed': d.processed,
+            'status': job.status if job else ('done' if d.processed else 'failed'),
+            'job_id': job.job_id if job else None
+        })
     return jsonify(result)
 
+@rag_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """
+    Статус задачи индексации: queued / processing / done / failed, число чанков и ошибка.
+    """
+    job = get_ingestion_queue().get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
 @rag_bp.route('/documents/<int:doc_id>', methods=['DELETE'])
 def delete_document(doc_id):
     """
-    Удаляет документ из БД и с диска.
-    FAISS не поддерживает удаление векторов в IndexFlatL2, поэтому
-    индекс остаётся, но документ удаляется из БД и с диска.
+    Удаляет документ из БД, с диска и его векторы из индекса FAISS.
     """
     doc = Document.query.get(doc_id)
     if not doc:
         return jsonify({'error': 'Document not found'}), 404
 
+    # Удаляем векторы и метаданные чанков
+    removed_chunks = get_rag_engine().delete_document(doc_id)
+
     # Удаляем файл с диска
     if os.path.exists(doc.file_path):
         try:
@@ -194,13 +215,64 @@ def delete_document(doc_id):
     db.session.delete(doc)
     db.session.commit()
 
-    return jsonify({'success': True, 'message': 'Document deleted'})
+    return jsonify({'success': True, 'message': 'Document deleted', 'removed_chunks': removed_chunks})
+
+@rag_bp.route('/search', methods=['POST'])
+def search():
+    """
+    Пакетный семантический поиск: {"queries": ["...", ...], "k": 5, "min_score": 0.3}.
+    Все запросы кодируются и ищутся одним батчем. Необязательные фильтры
+    doc_ids, uploaded_after, uploaded_before (ISO 8601) ограничивают поиск документами.
+    """
+    data = request.get_json() or {}
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries:
+        return jsonify({'error': 'queries must be a non-empty list of strings'}), 400
+    if not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({'error': 'queries must be a non-empty list of strings'}), 400
+    max_queries = current_app.config['SEARCH_MAX_QUERIES']
+    if len(queries) > max_queries:
+        return jsonify({'error': f'Too many queries (max {max_queries})'}), 400
+
+    try:
+        k = int(data.get('k', current_app.config['RAG_TOP_K']))
+        min_score = float(data['min_score']) if data.get('min_score') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'k must be an integer and min_score a number'}), 400
+    if not 1 <= k <= current_app.config['SEARCH_MAX_K']:
+        return jsonify({'error': f"k must be between 1 and {current_app.config['SEARCH_MAX_K']}"}), 400
+
+    from app.services.search_scope import parse_search_filters, resolve_document_scope
+    try:
+        doc_scope = resolve_document_scope(**parse_search_filters(data))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    results = get_rag_engine().search_similar_batch([q.strip() for q in queries], k=k, min_score=min_score,
+                                                    doc_ids=doc_scope)
+    return jsonify({
+        'results': [{
+            'query': query,
+            'hits': [{
+                'doc_id': hit['doc_id'],
+                'chunk_no': hit['chunk_no'],
+                'text': hit['text'],
+                'score': round(hit['score'], 4),
+                # Гибридный поиск: скоры каждого из поисков (None — хит найден только другим)
+                **{name: round(hit[name], 4) if hit[name] is not None else None
+                   for name in ('dense_score', 'lexical_score') if name in hit}
+            } for hit in hits]
+        } for query, hits in zip(queries, results)]
+    })
 
 @rag_bp.route('/stats', methods=['GET'])
 def rag_stats():
     """
     Возвращает статистику по RAG: количество документов, обработанных и др.
     """
+    from app.services.embedding_service import find_embedding_service
+
+    embedding_service = find_embedding_service(current_app.config['EMBEDDING_MODEL'])
     total_docs = Document.query.count()
     processed_docs = Document.query.filter_by(processed=True).count()
 
@@ -208,5 +280,31 @@ def rag_stats():
         'total_documents': total_docs,
         'processed_documents': processed_docs,
         'faiss_index_path': current_app.config['FAISS_INDEX_PATH'],
-        'embedding_model': current_app.config['EMBEDDING_MODEL']
-    })
\ No newline at end of file
+        'embedding_model': current_app.config['EMBEDDING_MODEL'],
+        'ingestion': get_ingestion_queue().get_stats(),
+        # Индекс показываем, только если движок уже построен (не грузим модель ради статистики)
+        'index': current_app.config['rag_engine'].vector_db.get_index_info()
+        if 'rag_engine' in current_app.config else None,
+        'cache': current_app.config['rag_engine'].get_cache_stats()
+        if 'rag_engine' in current_app.config else None,
+        # Не создаёт сервис и не загружает модель: статистика есть, только если она уже в памяти
+        'embedding_service': embedding_service.get_stats() if embedding_service is not None else None
+    })
+
+@rag_bp.route('/index/search-params', methods=['POST'])
+def set_index_search_params():
+    """
+    Меняет параметры ANN-поиска на лету: {"nprobe": 32, "ef_search": 128}.
+    """
+    data = request.get_json() or {}
+    try:
+        nprobe = int(data['nprobe']) if data.get('nprobe') is not None else None
+        ef_search = int(data['ef_search']) if data.get('ef_search') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'nprobe and ef_search must be integers'}), 400
+    if (nprobe is not None and nprobe < 1) or (ef_search is not None and ef_search < 1):
+        return jsonify({'error': 'nprobe and ef_search must be positive'}), 400
+
+    vector_db = get_rag_engine().vector_db
+    vector_db.set_search_params(nprobe=nprobe, ef_search=ef_search)
+    return jsonify(vector_db.get_index_info())
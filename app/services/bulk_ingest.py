@@ -0,0 +1,254 @@
+# app/services/bulk_ingest.py
+"""
+Массовая индексация папки или zip-архива: python run.py ingest <папка|zip>.
+
+Загрузка через POST /api/upload — один файл на HTTP-запрос и лимит
+MAX_CONTENT_LENGTH. Здесь файлы обходятся потоком (архив не распаковывается
+целиком), копируются в DOCUMENTS_FOLDER с подсчётом SHA-256 на лету и идут
+пачками по BULK_INGEST_BATCH_DOCS в RAGEngine.add_documents: разбор в пуле
+процессов, нарезка, эмбеддинг общими батчами, запись в журнал индекса.
+Снимок индекса на диск — в конце прогона; по ходу только по обычным порогам
+журнала (FAISS_CHECKPOINT_WAL_MB / FAISS_CHECKPOINT_INTERVAL_SEC).
+
+Прогресс пишется в журнал (JSON lines, одна строка на файл) в
+BULK_INGEST_STATE_DIR после того, как пачка проиндексирована и записана в БД.
+Прерванный прогон того же источника продолжает с первого необработанного
+файла. Документ, оставшийся от оборванной пачки (processed=False, тот же хэш),
+удаляется и индексируется заново.
+
+Индекс пишется напрямую, мимо веб-процесса: на время прогона веб-сервер
+и бот должны быть остановлены.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+import zipfile
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from werkzeug.utils import secure_filename
+
+from app.services.content_hash import _FILE_BLOCK_BYTES
+from app.services.ingestion import allocate_document_path
+
+logger = logging.getLogger(__name__)
+
+# Итоговые статусы файла в журнале прогресса
+FILE_INDEXED = 'indexed'
+FILE_DUPLICATE = 'duplicate'
+FILE_FAILED = 'failed'
+
+# Источник файла: (путь внутри папки/архива, размер, функция открытия бинарного потока)
+Source = Tuple[str, int, Callable[[], BinaryIO]]
+
+
+def _allowed(name: str, extensions: Set[str]) -> bool:
+    base = os.path.basename(name)
+    if base.startswith('.') or '.' not in base:
+        return False
+    return base.rsplit('.', 1)[-1].lower() in extensions
+
+
+def _iter_directory(root: str, extensions: Set[str]) -> Iterator[Source]:
+    # Сортировка — чтобы порядок обхода был одинаковым при возобновлении
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if _allowed(filename, extensions) and os.path.isfile(path):
+                yield (os.path.relpath(path, root).replace(os.sep, '/'), os.path.getsize(path),
+                       lambda path=path: open(path, 'rb'))
+
+
+@contextmanager
+def open_sources(source: str, extensions: Set[str]) -> Iterator[Iterator[Source]]:
+    """Файлы папки (рекурсивно) или zip-архива с поддерживаемыми расширениями."""
+    if os.path.isdir(source):
+        yield _iter_directory(source, extensions)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            members = sorted((info for info in archive.infolist()
+                              if not info.is_dir() and _allowed(info.filename, extensions)),
+                             key=lambda info: info.filename)
+            yield ((info.filename, info.file_size, lambda info=info: archive.open(info)) for info in members)
+    else:
+        raise ValueError(f"Not a directory or zip archive: {source}")
+
+
+class ProgressJournal:
+    """Журнал обработанных файлов одного источника; переживает прерывание прогона."""
+
+    def __init__(self, state_dir: str, source: str):
+        os.makedirs(state_dir, exist_ok=True)
+        key = hashlib.sha256(os.path.realpath(source).encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(state_dir, f"{key}.jsonl")
+        self.source = os.path.realpath(source)
+
+    def load(self) -> Dict[str, Dict]:
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная при сбое последняя строка — файл просто обработается ещё раз
+                    continue
+                done[record['name']] = record
+        return done
+
+    def append(self, records: List[Dict]):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _copy_hashing(src: BinaryIO, dest_path: str) -> str:
+    """Копирует поток в файл и возвращает SHA-256 содержимого — один проход по данным."""
+    digest = hashlib.sha256()
+    with open(dest_path, 'wb') as dest:
+        for block in iter(lambda: src.read(_FILE_BLOCK_BYTES), b''):
+            digest.update(block)
+            dest.write(block)
+    return digest.hexdigest()
+
+
+class BulkIngestor:
+    def __init__(self, rag_engine, documents_folder: str, state_dir: str, extensions: Set[str],
+                 batch_docs: int = 32, progress: Optional[Callable[[Dict], None]] = None):
+        self.rag_engine = rag_engine
+        self.documents_folder = documents_folder
+        self.state_dir = state_dir
+        self.extensions = {ext.lower() for ext in extensions}
+        self.batch_docs = max(1, batch_docs)
+        # Вызывается после каждой пачки со снимком счётчиков (для вывода в консоль)
+        self.progress = progress
+
+    def run(self, source: str, restart: bool = False) -> Dict:
+        """
+        Индексирует все файлы источника, пропуская уже обработанные в прошлых прогонах.
+        Возвращает счётчики и скорость: files/sec и chunks/sec по проиндексированным файлам.
+        """
+        journal = ProgressJournal(self.state_dir, source)
+        if restart:
+            journal.reset()
+        done = journal.load()
+
+        stats = {'source': journal.source, 'indexed': 0, 'duplicates': 0, 'failed': 0,
+                 'skipped': 0, 'chunks': 0, 'reused_chunks': 0, 'bytes': 0}
+        started = time.time()
+        batch: Dict[str, object] = {}     # имя файла в источнике -> Document, ждущий индексации
+
+        with open_sources(source, self.extensions) as sources:
+            for name, size, opener in sources:
+                if name in done:
+                    stats['skipped'] += 1
+                    continue
+                record = self._stage(name, size, opener, batch, stats)
+                if record is not None:
+                    journal.append([record])
+                    continue
+                if len(batch) >= self.batch_docs:
+                    journal.append(self._index_batch(batch, stats))
+                    batch = {}
+            if batch:
+                journal.append(self._index_batch(batch, stats))
+
+        # Фиксируем всё, что накопилось в журнале индекса, одним снимком
+        self.rag_engine.vector_db.save_index()
+
+        elapsed = time.time() - started
+        stats['elapsed_sec'] = round(elapsed, 3)
+        stats['files_per_sec'] = round(stats['indexed'] / elapsed, 2) if elapsed else 0.0
+        stats['chunks_per_sec'] = round(stats['chunks'] / elapsed, 2) if elapsed else 0.0
+        return stats
+
+    def _stage(self, name: str, size: int, opener: Callable[[], BinaryIO], batch: Dict[str, object],
+               stats: Dict) -> Optional[Dict]:
+        """
+        Копирует файл в DOCUMENTS_FOLDER и добавляет в пачку новую запись Document. Возвращает
+        запись журнала, если файл индексировать не нужно (дубликат или ошибка), иначе None.
+        """
+        from app import db
+        from app.models import Document
+
+        filename = secure_filename(os.path.basename(name))
+        if not filename:
+            stats['failed'] += 1
+            return {'name': name, 'status': FILE_FAILED, 'error': 'Invalid filename'}
+
+        file_path, _ = allocate_document_path(self.documents_folder, filename)
+        try:
+            with opener() as src:
+                content_hash = _copy_hashing(src, file_path)
+        except (OSError, zipfile.BadZipFile, RuntimeError) as e:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            logger.warning(f"Failed to read {name}: {e}")
+            stats['failed'] += 1
+            return {'name': name, 'status': FILE_FAILED, 'error': str(e)}
+
+        existing = next((doc for doc in batch.values() if doc.content_hash == content_hash), None)
+        if existing is None:
+            existing = Document.query.filter_by(content_hash=content_hash).order_by(Document.id.desc()).first()
+            if existing and not existing.processed:
+                # Остался от оборванной пачки или неудачной индексации — индексируем заново
+                self._drop_stale(existing)
+                existing = None
+        if existing:
+            os.remove(file_path)
+            stats['duplicates'] += 1
+            return {'name': name, 'status': FILE_DUPLICATE, 'doc_id': existing.id}
+
+        doc = Document(filename=filename, file_path=file_path, file_size=size, content_hash=content_hash)
+        db.session.add(doc)
+        db.session.flush()
+        batch[name] = doc
+        stats['bytes'] += size
+        return None
+
+    def _drop_stale(self, doc):
+        from app import db
+
+        self.rag_engine.delete_document(doc.id)
+        if os.path.exists(doc.file_path):
+            os.remove(doc.file_path)
+        db.session.delete(doc)
+        db.session.flush()
+
+    def _index_batch(self, batch: Dict[str, object], stats: Dict) -> List[Dict]:
+        from app import db
+
+        # Записи Document нужны до индексации: их id входят в id векторов
+        db.session.commit()
+        results = self.rag_engine.add_documents([(doc.file_path, doc.id) for doc in batch.values()])
+
+        records = []
+        for name, doc in batch.items():
+            result = results.get(doc.id, {'success': False, 'chunks': 0, 'reused': 0, 'error': 'No result'})
+            doc.processed = result['success']
+            if result['success']:
+                stats['indexed'] += 1
+                stats['chunks'] += result['chunks']
+                stats['reused_chunks'] += result.get('reused', 0)
+                records.append({'name': name, 'status': FILE_INDEXED, 'doc_id': doc.id, 'chunks': result['chunks']})
+            else:
+                stats['failed'] += 1
+                logger.warning(f"Failed to index {name}: {result['error']}")
+                records.append({'name': name, 'status': FILE_FAILED, 'doc_id': doc.id, 'error': result['error']})
+        # Сначала БД, потом журнал прогресса: после сбоя между ними файлы пачки найдутся
+        # по хэшу как уже проиндексированные и будут отмечены дубликатами
+        db.session.commit()
+        if self.progress:
+            self.progress(dict(stats))
+        return records
@@ -0,0 +1,320 @@
+# app/services/chunk_store.py
+"""
+Хранилище текста и метаданных чанков в SQLite (chunks.sqlite3 рядом с индексом).
+
+Раньше все чанки целиком лежали в Python-списке и грузились через pickle при
+старте. Теперь строки читаются по id вектора только для top-k хитов, а файл
+базы в режиме WAL одновременно читают несколько процессов (gunicorn workers).
+
+Дедупликация: у каждого чанка есть content_hash (SHA-256 нормализованного
+текста). Строка chunks — один вектор в FAISS на уникальный текст; таблица
+chunk_refs — все вхождения этого текста в документы. Чанк, текст которого уже
+есть в индексе, добавляет только ссылку. При удалении документа вектор, на
+который ссылаются другие документы, не удаляется, а передаётся одному из них.
+
+Хранилище переживает рестарт само по себе, поэтому вместе с изменением в той же
+транзакции запоминается номер записи журнала индекса (wal_seq): при повторном
+применении журнала уже учтённые записи к SQLite не применяются — иначе передача
+векторов при удалении повторилась бы поверх актуального состояния.
+
+Лексический индекс: таблица FTS5 chunks_fts (rowid = id вектора) с токенами
+текста чанка (app/services/lexical.py) для BM25-поиска. Она меняется в тех же
+транзакциях, что и chunks, поэтому всегда согласована с индексом FAISS. Таблица
+contentless — текст повторно не хранится, только инвертированные списки.
+"""
+
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from app.services.content_hash import hash_chunk
+from app.services.lexical import TOKENIZER_VERSION, tokenize, to_match_query
+
+# Поля, которые хранятся отдельными колонками; остальное — в JSON-колонке extra.
+# vector_id — ключ строки: в метаданные хита он попадает при чтении, в extra не пишется
+_COLUMNS = ('vector_id', 'doc_id', 'chunk_no', 'text', 'content_hash')
+# Старые сборки SQLite ограничивают число параметров запроса 999
+_MAX_SQL_PARAMS = 900
+
+
+class ChunkStore:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # sqlite3-соединение нельзя делить между потоками — у каждого потока своё
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    vector_id INTEGER PRIMARY KEY,
+                    doc_id INTEGER NOT NULL,
+                    chunk_no INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    extra TEXT,
+                    content_hash TEXT
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS store_state (key TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunk_refs (
+                    doc_id INTEGER NOT NULL,
+                    chunk_no INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    extra TEXT,
+                    PRIMARY KEY (doc_id, chunk_no)
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chunks)")}
+            if 'content_hash' not in columns:
+                conn.execute("ALTER TABLE chunks ADD COLUMN content_hash TEXT")
+                self._backfill_hashes(conn)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_chunks_doc_id ON chunks (doc_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_chunks_content_hash ON chunks (content_hash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_chunk_refs_content_hash ON chunk_refs (content_hash)")
+            self._ensure_lexical_index(conn)
+
+    @classmethod
+    def _ensure_lexical_index(cls, conn: sqlite3.Connection):
+        """Создаёт FTS5-таблицу и заполняет её из chunks — для старых баз и при смене токенизатора."""
+        row = conn.execute("SELECT value FROM store_state WHERE key = 'fts_tokenizer'").fetchone()
+        if row and row[0] == TOKENIZER_VERSION:
+            return
+        conn.execute("DROP TABLE IF EXISTS chunks_fts")
+        # Токены уже нормализованы lexical.tokenize; tokenchars — чтобы коды (AB-12.3) не дробились повторно
+        conn.execute("""
+            CREATE VIRTUAL TABLE chunks_fts USING fts5(
+                tokens, content='', tokenize="unicode61 remove_diacritics 0 tokenchars '-./_'"
+            )
+        """)
+        conn.executemany("INSERT INTO chunks_fts (rowid, tokens) VALUES (?, ?)",
+                         ((vector_id, cls._lexical_tokens(text))
+                          for vector_id, text in conn.execute("SELECT vector_id, text FROM chunks").fetchall()))
+        conn.execute("INSERT OR REPLACE INTO store_state (key, value) VALUES ('fts_tokenizer', ?)",
+                     (TOKENIZER_VERSION,))
+
+    @staticmethod
+    def _lexical_tokens(text: str) -> str:
+        return ' '.join(tokenize(text or ''))
+
+    @classmethod
+    def _unindex_lexical(cls, conn: sqlite3.Connection, rows: Iterable[Tuple[int, str]]):
+        """Удаление из contentless FTS5 требует тех же токенов, что были вставлены."""
+        conn.executemany("INSERT INTO chunks_fts (chunks_fts, rowid, tokens) VALUES ('delete', ?, ?)",
+                         [(vector_id, cls._lexical_tokens(text)) for vector_id, text in rows])
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def applied_seq(self) -> int:
+        """Номер последней записи журнала индекса, применённой к хранилищу."""
+        row = self._connect().execute("SELECT value FROM store_state WHERE key = 'wal_seq'").fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _mark_applied(conn: sqlite3.Connection, seq: int = None):
+        if seq is not None:
+            conn.execute("INSERT OR REPLACE INTO store_state (key, value) VALUES ('wal_seq', ?)", (int(seq),))
+
+    @staticmethod
+    def _backfill_hashes(conn: sqlite3.Connection):
+        """Чанки, проиндексированные до дедупликации, получают хэши и ссылки своих документов."""
+        rows = conn.execute("SELECT vector_id, doc_id, chunk_no, text, extra FROM chunks").fetchall()
+        hashes = [(hash_chunk(text), vector_id) for vector_id, _, _, text, _ in rows]
+        conn.executemany("UPDATE chunks SET content_hash = ? WHERE vector_id = ?", hashes)
+        conn.executemany(
+            "INSERT OR REPLACE INTO chunk_refs (doc_id, chunk_no, content_hash, extra) VALUES (?, ?, ?, ?)",
+            [(doc_id, chunk_no, content_hash, extra)
+             for (_, doc_id, chunk_no, _, extra), (content_hash, _) in zip(rows, hashes)]
+        )
+
+    @staticmethod
+    def _extra(meta: Dict):
+        extra = {key: value for key, value in meta.items() if key not in _COLUMNS}
+        return json.dumps(extra, ensure_ascii=False) if extra else None
+
+    @classmethod
+    def _to_row(cls, vector_id: int, meta: Dict, content_hash: str) -> tuple:
+        return (int(vector_id), int(meta['doc_id']), int(meta['chunk_no']), meta.get('text', ''),
+                cls._extra(meta), content_hash)
+
+    @staticmethod
+    def _from_row(row: tuple) -> Dict:
+        vector_id, doc_id, chunk_no, text, extra, content_hash = row
+        meta = json.loads(extra) if extra else {}
+        # После передачи вектора другому документу vector_id не совпадает с make_vector_id(doc_id, chunk_no)
+        meta.update({'vector_id': vector_id, 'doc_id': doc_id, 'chunk_no': chunk_no, 'text': text})
+        if content_hash:
+            meta['content_hash'] = content_hash
+        return meta
+
+    @classmethod
+    def _to_ref(cls, meta: Dict, content_hash: str) -> tuple:
+        return int(meta['doc_id']), int(meta['chunk_no']), content_hash, cls._extra(meta)
+
+    def add(self, vector_ids: Iterable[int], metadata: List[Dict], seq: int = None):
+        # Метаданные из старых снимков и журналов приходят без хэша
+        hashes = [meta.get('content_hash') or hash_chunk(meta.get('text', '')) for meta in metadata]
+        rows = [self._to_row(vector_id, meta, content_hash)
+                for vector_id, meta, content_hash in zip(vector_ids, metadata, hashes)]
+        with self._connect() as conn:
+            # INSERT OR REPLACE поверх существующей строки не должен оставить в FTS старые токены
+            for start in range(0, len(rows), _MAX_SQL_PARAMS):
+                batch = [row[0] for row in rows[start:start + _MAX_SQL_PARAMS]]
+                placeholders = ','.join('?' * len(batch))
+                self._unindex_lexical(conn, conn.execute(
+                    f"SELECT vector_id, text FROM chunks WHERE vector_id IN ({placeholders})", batch
+                ).fetchall())
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunks (vector_id, doc_id, chunk_no, text, extra, content_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.executemany("INSERT INTO chunks_fts (rowid, tokens) VALUES (?, ?)",
+                             [(row[0], self._lexical_tokens(row[3])) for row in rows])
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunk_refs (doc_id, chunk_no, content_hash, extra) VALUES (?, ?, ?, ?)",
+                [self._to_ref(meta, content_hash) for meta, content_hash in zip(metadata, hashes)]
+            )
+            self._mark_applied(conn, seq)
+
+    def add_refs(self, metadata: List[Dict]):
+        """Вхождения чанков, вектор которых уже есть в индексе (content_hash совпал)."""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunk_refs (doc_id, chunk_no, content_hash, extra) VALUES (?, ?, ?, ?)",
+                [self._to_ref(meta, meta['content_hash']) for meta in metadata]
+            )
+
+    def find_hashes(self, hashes: Iterable[str]) -> Dict[str, int]:
+        """{content_hash: vector_id} для хэшей, чьи векторы уже есть в индексе."""
+        hashes = list(set(hashes))
+        conn = self._connect()
+        result = {}
+        for start in range(0, len(hashes), _MAX_SQL_PARAMS):
+            batch = hashes[start:start + _MAX_SQL_PARAMS]
+            placeholders = ','.join('?' * len(batch))
+            result.update(conn.execute(
+                f"SELECT content_hash, vector_id FROM chunks WHERE content_hash IN ({placeholders})", batch
+            ).fetchall())
+        return result
+
+    def get_owners(self, vector_ids: Iterable[int]) -> Dict[int, int]:
+        """{vector_id: doc_id} для id, которые уже заняты."""
+        vector_ids = [int(vector_id) for vector_id in vector_ids]
+        conn = self._connect()
+        result = {}
+        for start in range(0, len(vector_ids), _MAX_SQL_PARAMS):
+            batch = vector_ids[start:start + _MAX_SQL_PARAMS]
+            placeholders = ','.join('?' * len(batch))
+            result.update(conn.execute(
+                f"SELECT vector_id, doc_id FROM chunks WHERE vector_id IN ({placeholders})", batch
+            ).fetchall())
+        return result
+
+    def get_many(self, vector_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Читает только запрошенные строки: {vector_id: метаданные}."""
+        vector_ids = [int(vector_id) for vector_id in vector_ids if vector_id >= 0]
+        if not vector_ids:
+            return {}
+        conn = self._connect()
+        result = {}
+        for start in range(0, len(vector_ids), _MAX_SQL_PARAMS):
+            batch = vector_ids[start:start + _MAX_SQL_PARAMS]
+            placeholders = ','.join('?' * len(batch))
+            rows = conn.execute(
+                f"SELECT vector_id, doc_id, chunk_no, text, extra, content_hash FROM chunks "
+                f"WHERE vector_id IN ({placeholders})",
+                batch
+            ).fetchall()
+            result.update((row[0], self._from_row(row)) for row in rows)
+        return result
+
+    def search_lexical(self, query: str, k: int, vector_ids: Iterable[int] = None) -> List[Tuple[int, float]]:
+        """
+        BM25 по токенам чанков: [(vector_id, score)] по убыванию score (больше — лучше).
+        vector_ids — искать только среди этих векторов (см. get_scope_ids).
+        """
+        match = to_match_query(query)
+        if not match or k <= 0:
+            return []
+        sql = "SELECT rowid, bm25(chunks_fts) AS rank FROM chunks_fts WHERE chunks_fts MATCH ?"
+        params = [match]
+        if vector_ids is not None:
+            # json_each вместо IN (?, ?, ...): область поиска может быть больше лимита параметров
+            sql += " AND rowid IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps([int(vector_id) for vector_id in vector_ids]))
+        # bm25() в FTS5 отрицателен: чем меньше, тем релевантнее
+        rows = self._connect().execute(sql + " ORDER BY rank LIMIT ?", (*params, int(k))).fetchall()
+        return [(vector_id, -rank) for vector_id, rank in rows]
+
+    def get_scope_ids(self, doc_ids: Iterable[int]) -> List[int]:
+        """
+        id векторов, которые видят документы doc_ids: их собственные чанки и чанки,
+        вектор которых после дедупликации принадлежит другому документу (через chunk_refs).
+        """
+        scope = json.dumps(sorted({int(doc_id) for doc_id in doc_ids}))
+        rows = self._connect().execute("""
+            SELECT c.vector_id FROM chunk_refs r JOIN chunks c ON c.content_hash = r.content_hash
+            WHERE r.doc_id IN (SELECT value FROM json_each(?))
+            UNION
+            SELECT vector_id FROM chunks WHERE doc_id IN (SELECT value FROM json_each(?))
+        """, (scope, scope))
+        return [row[0] for row in rows]
+
+    def get_ids_between(self, start: int, end: int) -> List[int]:
+        """id векторов в полуинтервале [start, end), которые ещё есть в хранилище."""
+        rows = self._connect().execute("SELECT vector_id FROM chunks WHERE vector_id >= ? AND vector_id < ?",
+                                       (int(start), int(end)))
+        return [row[0] for row in rows]
+
+    def get_document_ids(self, doc_id: int) -> List[int]:
+        rows = self._connect().execute("SELECT vector_id FROM chunks WHERE doc_id = ?", (int(doc_id),))
+        return [row[0] for row in rows]
+
+    def get_removable_ids(self, doc_id: int) -> List[int]:
+        """id векторов документа, на которые не ссылается ни один другой документ."""
+        rows = self._connect().execute("""
+            SELECT vector_id FROM chunks c
+            WHERE c.doc_id = ? AND (c.content_hash IS NULL OR NOT EXISTS (
+                SELECT 1 FROM chunk_refs r WHERE r.content_hash = c.content_hash AND r.doc_id != c.doc_id
+            ))
+        """, (int(doc_id),))
+        return [row[0] for row in rows]
+
+    def delete_document(self, doc_id: int, seq: int = None) -> List[int]:
+        """
+        Удаляет чанки документа и возвращает id векторов, которые больше никому не нужны.
+        Вектор, текст которого есть в других документах, остаётся в индексе и переходит
+        к самому новому из них (вместе с номером чанка и метаданными вхождения).
+        """
+        doc_id = int(doc_id)
+        removed = []
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chunk_refs WHERE doc_id = ?", (doc_id,))
+            for vector_id, content_hash, text in conn.execute(
+                    "SELECT vector_id, content_hash, text FROM chunks WHERE doc_id = ?", (doc_id,)).fetchall():
+                heir = conn.execute(
+                    "SELECT doc_id, chunk_no, extra FROM chunk_refs WHERE content_hash = ? "
+                    "ORDER BY doc_id DESC, chunk_no LIMIT 1", (content_hash,)
+                ).fetchone() if content_hash else None
+                if heir:
+                    conn.execute("UPDATE chunks SET doc_id = ?, chunk_no = ?, extra = ? WHERE vector_id = ?",
+                                 (*heir, vector_id))
+                else:
+                    conn.execute("DELETE FROM chunks WHERE vector_id = ?", (vector_id,))
+                    self._unindex_lexical(conn, [(vector_id, text)])
+                    removed.append(vector_id)
+            self._mark_applied(conn, seq)
+        return removed
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def count_refs(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM chunk_refs").fetchone()[0]
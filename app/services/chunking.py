@@ -0,0 +1,388 @@
+# app/services/chunking.py
+"""
+Нарезка текста документа на чанки для индекса.
+
+Две стратегии (CHUNK_STRATEGY):
+- chars  — окно CHUNK_SIZE символов с перекрытием CHUNK_OVERLAP, граница по пробелу;
+- tokens — чанк собирается из целых предложений и абзацев, размер считается
+  токенайзером модели эмбеддингов (CHUNK_MAX_TOKENS). Символьное окно на русском
+  тексте часто длиннее окна модели (256 токенов у all-MiniLM-L6-v2) — хвост чанка
+  молча обрезается при кодировании; по токенам чанк всегда влезает целиком.
+
+Чанкер по токенам находит границы за один проход регулярным выражением по
+сегменту, токенизирует весь сегмент одним вызовом (offsets токенов), а число
+токенов каждого предложения и точки разреза получает через NumPy
+(searchsorted / cumsum) — без посимвольных циклов на Python.
+
+Оба чанкера — потоковые: принимают сегменты (страница, текст) из
+document_parser.iter_segments и держат в памяти только текущий хвост. Объекты
+чанкеров сериализуются (pickle) и передаются в процессы разбора документов;
+токенайзер загружается в каждом процессе один раз (get_token_counter).
+"""
+
+import logging
+import re
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHUNK_STRATEGIES = ('chars', 'tokens')
+
+# Граница: абзац (пустая строка), конец предложения, перевод строки. Порядок альтернатив важен:
+# «.\n\n» матчится как конец предложения, и сила границы определяется по тексту матча
+BOUNDARY_RE = re.compile(r'\n[ \t]*\n\s*|[.!?…]+["»”)\]]*\s+|\n\s*')
+BLANK_LINE_RE = re.compile(r'\n[ \t]*\n')
+BOUNDARY_WORD, BOUNDARY_LINE, BOUNDARY_SENTENCE, BOUNDARY_PARAGRAPH = -1, 0, 1, 2
+
+# Чанк режется по самой сильной границе (абзац > предложение > строка), если при этом
+# заполнен хотя бы на MIN_FILL; иначе — по последней влезающей
+MIN_FILL = 0.6
+
+# Оценка без токенайзера: ~4 символа слова на токен, знак препинания — отдельный токен
+FALLBACK_TOKEN_RE = re.compile(r'\w{1,4}|[^\w\s]')
+
+
+# === ТОКЕНАЙЗЕР ===
+
+_counters: Dict[Tuple[str, Optional[str]], Callable[[str], np.ndarray]] = {}
+_counters_lock = threading.Lock()
+
+
+def _fallback_token_starts(text: str) -> np.ndarray:
+    return np.fromiter((m.start() for m in FALLBACK_TOKEN_RE.finditer(text)), dtype=np.int64)
+
+
+def get_token_counter(model_name: str, cache_folder: Optional[str] = None) -> Callable[[str], np.ndarray]:
+    """
+    Возвращает функцию text -> позиции начала токенов (без [CLS]/[SEP]).
+    Токенайзер модели загружается один раз на процесс; без transformers или без
+    скачанной модели — грубая оценка по символам.
+    """
+    key = (model_name, cache_folder)
+    with _counters_lock:
+        counter = _counters.get(key)
+        if counter is None:
+            try:
+                from transformers import AutoTokenizer
+                tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_folder, use_fast=True)
+                # Сегмент целиком длиннее окна модели — это нормально, предупреждение не нужно
+                tokenizer.model_max_length = int(1e9)
+
+                def counter(text: str) -> np.ndarray:
+                    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True,
+                                        return_attention_mask=False, return_token_type_ids=False)['offset_mapping']
+                    return np.array([start for start, _ in offsets], dtype=np.int64)
+            except Exception as e:
+                logger.warning(f"Tokenizer for '{model_name}' unavailable ({e}), token counts are estimated")
+                counter = _fallback_token_starts
+            _counters[key] = counter
+    return counter
+
+
+# === ЧАНКЕР ПО СИМВОЛАМ ===
+
+def iter_chunks(segments: Iterable[Tuple[Optional[int], str]], chunk_size: int,
+                chunk_overlap: int) -> Iterator[Tuple[str, Dict]]:
+    """
+    Режет поток сегментов на чанки по chunk_size символов с перекрытием chunk_overlap,
+    по возможности на границе слова. Возвращает (текст чанка, метаданные) с позициями
+    в документе и страницей начала/конца чанка (page / page_end, если страницы известны).
+    """
+    buffer = ''
+    buffer_start = 0          # позиция buffer[0] в документе
+    trailing_ws = 0           # пробелы в конце буфера: конец документа их срежет (как strip())
+    start = 0                 # позиция начала следующего чанка в документе
+    pages = deque()           # (позиция начала сегмента, страница) для сегментов в буфере
+    chunk_id = 0
+    segments = iter(segments)
+    exhausted = False
+    leading = True
+
+    def page_at(position: int) -> Optional[int]:
+        page = None
+        for segment_start, segment_page in pages:
+            if segment_start > position:
+                break
+            page = segment_page
+        return page
+
+    while True:
+        buffer_end = buffer_start + len(buffer) - trailing_ws
+        # Чанк можно резать, когда за окном есть ещё текст (как в старом алгоритме: end < len(text))
+        # или когда документ закончился
+        if start + chunk_size >= buffer_end and not exhausted:
+            segment = next(segments, None)
+            if segment is None:
+                exhausted = True
+                # Хвостовые пробелы документа не должны давать пустой последний чанк
+                buffer = buffer.rstrip()
+                trailing_ws = 0
+                continue
+            page, text = segment
+            if leading:
+                text = text.lstrip()
+                if not text:
+                    continue
+                leading = False
+            # Отбрасываем уже нарезанный текст: в буфере остаётся только хвост с перекрытием
+            if start > buffer_start:
+                buffer = buffer[start - buffer_start:]
+                buffer_start = start
+                while len(pages) > 1 and pages[1][0] <= buffer_start:
+                    pages.popleft()
+            if page is not None and (not pages or pages[-1][1] != page):
+                pages.append((buffer_start + len(buffer), page))
+            buffer += text
+            stripped = len(text.rstrip())
+            trailing_ws = len(text) - stripped if stripped else trailing_ws + len(text)
+            continue
+
+        if start >= buffer_end:
+            break
+
+        end = start + chunk_size
+        if end < buffer_end:
+            space_pos = buffer.rfind(' ', start - buffer_start, end - buffer_start)
+            if space_pos != -1 and space_pos + buffer_start > start:
+                end = space_pos + buffer_start
+        else:
+            end = buffer_end
+        chunk = buffer[start - buffer_start:end - buffer_start].strip()
+        if chunk:
+            meta = {
+                "chunk_id": f"chunk_{chunk_id}",
+                "text": chunk,
+                "start_char": start,
+                "end_char": end,
+            }
+            first_page = page_at(start)
+            if first_page is not None:
+                meta["page"] = first_page
+                meta["page_end"] = page_at(max(start, end - 1))
+            yield chunk, meta
+            chunk_id += 1
+        if exhausted and end >= buffer_end:
+            # Документ дочитан: перекрытие последнего чанка дало бы только его дубликат-хвост
+            break
+        start = end - chunk_overlap if end - chunk_overlap > start else end
+
+
+# === ЧАНКЕР ПО ТОКЕНАМ ===
+
+def _split_units(region: str, final: bool) -> Tuple[List[Tuple[int, int, int]], int]:
+    """
+    Делит region на единицы (предложения/строки/абзацы): [(начало, конец, сила границы)].
+    Если final=False, текст после последней границы не трогаем — он может продолжиться
+    в следующем сегменте. Возвращает единицы и длину разобранной части region.
+    """
+    units = []
+    position = 0
+    for match in BOUNDARY_RE.finditer(region):
+        if match.end() == position:
+            continue
+        separator = match.group()
+        if BLANK_LINE_RE.search(separator):
+            strength = BOUNDARY_PARAGRAPH
+        elif separator[0] != '\n':
+            strength = BOUNDARY_SENTENCE
+        else:
+            strength = BOUNDARY_LINE
+        units.append((position, match.end(), strength))
+        position = match.end()
+    if final and position < len(region):
+        units.append((position, len(region), BOUNDARY_PARAGRAPH))
+        position = len(region)
+    return units, position
+
+
+def iter_token_chunks(segments: Iterable[Tuple[Optional[int], str]], max_tokens: int, overlap_tokens: int,
+                      count_tokens: Callable[[str], np.ndarray]) -> Iterator[Tuple[str, Dict]]:
+    """
+    Собирает чанки из целых предложений так, чтобы в каждом было не больше max_tokens
+    токенов модели. Чанк режется по абзацу или концу предложения (если он заполнен хотя
+    бы на MIN_FILL), следующий чанк начинается с последних предложений предыдущего
+    общей длиной до overlap_tokens. Предложение длиннее max_tokens режется по словам.
+    Метаданные как у iter_chunks плюс tokens — число токенов в чанке.
+    """
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    buffer = ''
+    buffer_start = 0          # позиция buffer[0] в документе
+    scanned = 0               # до этой позиции документа текст уже разбит на единицы
+    pages = deque()           # (позиция начала сегмента, страница)
+    # Очередь единиц: начало, конец (в документе), токены, сила границы после единицы, страница
+    starts, ends, tokens, strengths, unit_pages = [], [], [], [], []
+    carried = 0               # первые carried единиц очереди — перекрытие, уже попавшее в чанк
+    pending = 0               # сумма токенов в очереди
+    chunk_id = 0
+    leading = True
+
+    def page_at(position: int) -> Optional[int]:
+        page = None
+        for segment_start, segment_page in pages:
+            if segment_start > position:
+                break
+            page = segment_page
+        return page
+
+    def scan(final: bool):
+        """Разбивает новый текст буфера на единицы и считает их токены одним вызовом токенайзера."""
+        nonlocal scanned
+        region = buffer[scanned - buffer_start:]
+        units, consumed = _split_units(region, final)
+        if not units:
+            return
+        region = region[:consumed]
+        token_starts = count_tokens(region)
+        bounds = np.array([unit[1] for unit in units], dtype=np.int64)
+        counts = np.diff(np.searchsorted(token_starts, bounds, side='left'), prepend=0)
+        for (unit_start, unit_end, strength), count in zip(units, counts.tolist()):
+            if not region[unit_start:unit_end].strip():
+                continue
+            if count > max_tokens:
+                # Слишком длинное предложение — режем по началу слова не дальше max_tokens токенов
+                inner = token_starts[(token_starts >= unit_start) & (token_starts < unit_end)]
+                word_start = np.array([t == unit_start or region[t - 1].isspace() for t in inner.tolist()])
+                first = 0
+                while len(inner) - first > max_tokens:
+                    candidates = np.flatnonzero(word_start[first + 1:first + max_tokens + 1]) + first + 1
+                    cut = int(candidates[-1]) if len(candidates) else first + max_tokens
+                    push(scanned + int(inner[first]), scanned + int(inner[cut]), cut - first, BOUNDARY_WORD)
+                    first = cut
+                push(scanned + int(inner[first]), scanned + unit_end, len(inner) - first, strength)
+            elif count:
+                push(scanned + unit_start, scanned + unit_end, count, strength)
+        scanned += consumed
+
+    def push(start: int, end: int, count: int, strength: int):
+        nonlocal pending
+        starts.append(start)
+        ends.append(end)
+        tokens.append(count)
+        pending += count
+        strengths.append(strength)
+        unit_pages.append(page_at(start))
+
+    def cut(final: bool) -> Optional[Tuple[str, Dict]]:
+        """Отдаёт следующий чанк из очереди и оставляет в ней перекрытие."""
+        nonlocal carried, chunk_id, pending
+        # В чанк влезает не больше max_tokens единиц (в каждой хотя бы один токен) —
+        # дальше очередь не смотрим, даже если в ней весь длинный сегмент
+        counts = np.array(tokens[:max_tokens + 1], dtype=np.int64)
+        cumulative = np.cumsum(counts)
+        # Перекрытие вместе со следующей единицей не влезает — перекрытием жертвуем
+        while carried and cumulative[carried] > max_tokens:
+            pending -= tokens[0]
+            for queue in (starts, ends, tokens, strengths, unit_pages):
+                del queue[0]
+            carried -= 1
+            counts = np.array(tokens[:max_tokens + 1], dtype=np.int64)
+            cumulative = np.cumsum(counts)
+        fit = int(np.searchsorted(cumulative, max_tokens, side='right'))
+        if final and fit == len(tokens):
+            take = fit
+        else:
+            sizes = np.arange(1, fit + 1)
+            allowed = (cumulative[:fit] >= MIN_FILL * max_tokens) & (sizes > carried)
+            if allowed.any():
+                # Самая сильная граница, при равенстве — самый длинный чанк
+                score = np.where(allowed, (np.array(strengths[:fit]) - BOUNDARY_WORD + 1) * (fit + 1) + sizes, 0)
+                take = int(np.argmax(score)) + 1
+            else:
+                take = max(fit, carried + 1)
+
+        begin, end = starts[0], ends[take - 1]
+        raw = buffer[begin - buffer_start:end - buffer_start]
+        text = raw.strip()
+        begin += len(raw) - len(raw.lstrip())
+        meta = {
+            "chunk_id": f"chunk_{chunk_id}",
+            "text": text,
+            "start_char": begin,
+            "end_char": begin + len(text),
+            "tokens": int(cumulative[take - 1]),
+        }
+        if unit_pages[0] is not None:
+            meta["page"] = unit_pages[0]
+            meta["page_end"] = unit_pages[take - 1]
+        chunk_id += 1
+
+        # Перекрытие: хвост из целых единиц не длиннее overlap_tokens (но не весь чанк)
+        tail = np.cumsum(counts[:take][::-1])
+        keep = min(int(np.searchsorted(tail, overlap_tokens, side='right')), take - 1) if overlap_tokens else 0
+        drop = take - keep
+        for queue in (starts, ends, tokens, strengths, unit_pages):
+            del queue[:drop]
+        pending -= int(cumulative[drop - 1])
+        carried = keep
+        return text, meta
+
+    for page, text in segments:
+        if leading:
+            text = text.lstrip()
+            if not text:
+                continue
+            leading = False
+        # Отбрасываем текст, который уже не понадобится ни одному чанку
+        keep_from = starts[0] if starts else scanned
+        if keep_from > buffer_start:
+            buffer = buffer[keep_from - buffer_start:]
+            buffer_start = keep_from
+            while len(pages) > 1 and pages[1][0] <= buffer_start:
+                pages.popleft()
+        if page is not None and (not pages or pages[-1][1] != page):
+            pages.append((buffer_start + len(buffer), page))
+        buffer += text
+        scan(final=False)
+        while pending > max_tokens:
+            yield cut(final=False)
+
+    scan(final=True)
+    while len(tokens) > carried:
+        yield cut(final=True)
+
+
+# === ЧАНКЕРЫ ДЛЯ RAGEngine И ПУЛА РАЗБОРА ===
+
+class CharChunker:
+    strategy = 'chars'
+
+    def __init__(self, chunk_size: int, chunk_overlap: int):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def __call__(self, segments: Iterable[Tuple[Optional[int], str]]) -> Iterator[Tuple[str, Dict]]:
+        return iter_chunks(segments, self.chunk_size, self.chunk_overlap)
+
+
+class TokenChunker:
+    strategy = 'tokens'
+
+    def __init__(self, max_tokens: int, overlap_tokens: int, model_name: str, cache_folder: Optional[str] = None):
+        self.max_tokens = max(1, max_tokens)
+        self.overlap_tokens = max(0, overlap_tokens)
+        # Сам токенайзер не храним: объект уходит в процессы разбора через pickle
+        self.model_name = model_name
+        self.cache_folder = cache_folder
+
+    def __call__(self, segments: Iterable[Tuple[Optional[int], str]]) -> Iterator[Tuple[str, Dict]]:
+        count_tokens = get_token_counter(self.model_name, self.cache_folder)
+        return iter_token_chunks(segments, self.max_tokens, self.overlap_tokens, count_tokens)
+
+
+def build_chunker(config):
+    """Чанкер по настройкам CHUNK_STRATEGY / CHUNK_* из конфига."""
+    strategy = config.get('CHUNK_STRATEGY', 'chars')
+    if strategy == 'tokens':
+        return TokenChunker(
+            max_tokens=config.get('CHUNK_MAX_TOKENS', 254),
+            overlap_tokens=config.get('CHUNK_OVERLAP_TOKENS', 32),
+            model_name=config['EMBEDDING_MODEL'],
+            cache_folder=config.get('EMBEDDING_CACHE_FOLDER')
+        )
+    if strategy == 'chars':
+        return CharChunker(config['CHUNK_SIZE'], config['CHUNK_OVERLAP'])
+    raise ValueError(f"Unknown CHUNK_STRATEGY '{strategy}', expected one of {CHUNK_STRATEGIES}")
@@ -0,0 +1,37 @@
+# app/services/content_hash.py
+"""
+SHA-256 содержимого для дедупликации.
+
+- hash_file — файл целиком: повторная загрузка того же файла не индексируется заново.
+- hash_chunk — нормализованный текст чанка: чанк, который уже есть в индексе
+  (в этом или другом документе, например в прошлой версии файла), не эмбеддится
+  повторно и не добавляет в FAISS второй такой же вектор.
+"""
+
+import hashlib
+import unicodedata
+from typing import BinaryIO, Union
+
+_FILE_BLOCK_BYTES = 1024 * 1024
+
+
+def hash_file(source: Union[str, BinaryIO]) -> str:
+    """SHA-256 файла по пути или из открытого бинарного потока (читается блоками, позиция не восстанавливается)."""
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(_FILE_BLOCK_BYTES), b''):
+                digest.update(block)
+    else:
+        for block in iter(lambda: source.read(_FILE_BLOCK_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize_chunk_text(text: str) -> str:
+    """NFKC и схлопывание пробелов: перенос строки или лишний пробел не делают чанк новым."""
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+def hash_chunk(text: str) -> str:
+    return hashlib.sha256(normalize_chunk_text(text).encode('utf-8')).hexdigest()
@@ -0,0 +1,177 @@
+# app/services/conversation_memory.py
+"""
+Ограниченная память диалога для LLM.
+
+Хранит последние реплики в кольцевом буфере с бюджетом токенов: длина каждой
+реплики считается один раз при добавлении, сумма поддерживается инкрементально,
+поэтому сборка промпта не пересчитывает всю историю. Реплики, вытесненные из
+буфера, копятся отдельно и (если включено) сворачиваются в краткое содержание,
+которое идёт в промпт первым системным сообщением.
+"""
+
+import re
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Приблизительное число токенов: слова и знаки препинания. Точный токенизатор
+    у Yandex GPT и моделей Ollama свой, для бюджета истории оценки достаточно.
+    """
+    return len(_TOKEN_RE.findall(text or ''))
+
+
+class ConversationMemory:
+    def __init__(self, max_tokens: int = 1500, max_turns: int = 20, summary_max_tokens: int = 200,
+                 token_counter: Callable[[str], int] = estimate_tokens):
+        self.max_tokens = max_tokens
+        self.max_turns = max(1, max_turns)
+        self.summary_max_tokens = summary_max_tokens
+        self.token_counter = token_counter
+        # (role, content, tokens) — длина считается один раз при добавлении
+        self._turns: deque = deque()
+        self._turn_tokens = 0
+        self.summary = ''
+        self._summary_tokens = 0
+        # Вытесненные реплики, ещё не свёрнутые в summary (не больше max_tokens)
+        self._evicted: deque = deque()
+        self._evicted_tokens = 0
+        # id последнего сообщения из БД, уже попавшего в память (веб-чат)
+        self.last_message_id = 0
+        # Идёт суммаризация: вытесненные реплики уже забраны, summary ещё не обновлено
+        self._summarizing = False
+        # Растёт при clear(): summary, начатое до сброса истории, отбрасывается
+        self._epoch = 0
+        self._summary_epoch = 0
+        self._lock = threading.Lock()
+
+    def add(self, role: str, content: str):
+        tokens = self.token_counter(content)
+        with self._lock:
+            self._turns.append((role, content, tokens))
+            self._turn_tokens += tokens
+            self._trim()
+
+    def extend(self, rows: List[Tuple[int, str, str]]):
+        """
+        Догружает сообщения из БД: rows — (id, role, content) по возрастанию id.
+        Уже учтённые id пропускаются, поэтому параллельные запросы одной сессии
+        не задвоят историю.
+        """
+        counted = [(msg_id, role, content, self.token_counter(content)) for msg_id, role, content in rows]
+        with self._lock:
+            for msg_id, role, content, tokens in counted:
+                if msg_id <= self.last_message_id:
+                    continue
+                self._turns.append((role, content, tokens))
+                self._turn_tokens += tokens
+                self.last_message_id = msg_id
+            self._trim()
+
+    def _trim(self):
+        budget = self.max_tokens - self._summary_tokens
+        # Последнюю реплику оставляем всегда, даже если она одна больше бюджета
+        while len(self._turns) > 1 and (len(self._turns) > self.max_turns or self._turn_tokens > budget):
+            turn = self._turns.popleft()
+            self._turn_tokens -= turn[2]
+            self._evicted.append(turn)
+            self._evicted_tokens += turn[2]
+        while self._evicted_tokens > self.max_tokens:
+            self._evicted_tokens -= self._evicted.popleft()[2]
+
+    def messages(self) -> List[Dict]:
+        """История в формате chat completions: краткое содержание + последние реплики."""
+        with self._lock:
+            result = []
+            if self.summary:
+                result.append({'role': 'system', 'content': f"Краткое содержание предыдущего диалога: {self.summary}"})
+            result.extend({'role': role, 'content': content} for role, content, _ in self._turns)
+            return result
+
+    @property
+    def token_count(self) -> int:
+        return self._summary_tokens + self._turn_tokens
+
+    def has_evicted(self) -> bool:
+        return bool(self._evicted)
+
+    def begin_summary(self) -> List[Dict]:
+        """
+        Забирает вытесненные реплики для суммаризации. Пока она не завершена (finish_summary),
+        возвращает [] — параллельные запросы одной сессии не запустят вторую суммаризацию,
+        которая свернула бы те же реплики от старого summary и затёрла бы результат первой.
+        """
+        with self._lock:
+            if self._summarizing or not self._evicted:
+                return []
+            self._summarizing = True
+            self._summary_epoch = self._epoch
+            turns = [{'role': role, 'content': content} for role, content, _ in self._evicted]
+            self._evicted.clear()
+            self._evicted_tokens = 0
+            return turns
+
+    def finish_summary(self, summary: Optional[str]):
+        """Завершает суммаризацию, начатую begin_summary; None — не удалась, summary прежнее."""
+        with self._lock:
+            self._summarizing = False
+            if summary is None or self._summary_epoch != self._epoch:
+                return
+            self._set_summary(summary)
+
+    def _set_summary(self, summary: str):
+        tokens = self.token_counter(summary)
+        if tokens > self.summary_max_tokens:
+            # Обрезаем по словам, чтобы summary не съело бюджет истории
+            words = summary.split()
+            summary = ' '.join(words[:self.summary_max_tokens])
+            tokens = self.token_counter(summary)
+        self.summary = summary
+        self._summary_tokens = tokens
+        self._trim()
+
+    def set_summary(self, summary: str):
+        with self._lock:
+            self._set_summary(summary)
+
+    def clear(self):
+        with self._lock:
+            self._turns.clear()
+            self._turn_tokens = 0
+            self._evicted.clear()
+            self._evicted_tokens = 0
+            self.summary = ''
+            self._summary_tokens = 0
+            self._epoch += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            'turns': len(self._turns),
+            'tokens': self.token_count,
+            'summary_tokens': self._summary_tokens,
+            'pending_summary_turns': len(self._evicted),
+        }
+
+
+def build_memory(config) -> ConversationMemory:
+    return ConversationMemory(
+        max_tokens=config.get('CONVERSATION_MAX_TOKENS', 1500),
+        max_turns=config.get('CONVERSATION_MAX_TURNS', 20),
+        summary_max_tokens=config.get('CONVERSATION_SUMMARY_MAX_TOKENS', 200)
+    )
+
+
+def format_summary_request(previous_summary: Optional[str], turns: List[Dict]) -> str:
+    """Промпт для сворачивания старых реплик в краткое содержание."""
+    dialog = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    previous = f"Текущее краткое содержание:\n{previous_summary}\n\n" if previous_summary else ""
+    return (
+        "Кратко (не больше 5 предложений) перескажи диалог, сохранив факты, "
+        "имена и договорённости, важные для продолжения разговора.\n\n"
+        f"{previous}Новые реплики:\n{dialog}\n\n"
+        "Краткое содержание:"
+    )
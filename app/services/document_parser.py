@@ -0,0 +1,230 @@
+# app/services/document_parser.py
+"""
+Потоковый разбор документов на чанки.
+
+Раньше файл целиком читался в одну строку (PDF — через `text += page`, что
+квадратично на больших файлах), и только потом резался на чанки. Теперь это
+цепочка генераторов:
+
+    iter_segments(файл) -> чанкер(сегменты) -> батчи эмбеддингов -> индекс
+
+Сегмент — страница PDF, абзац DOCX или блок TXT. Чанкеры (app/services/chunking.py)
+держат в памяти только хвост текста плюс текущий сегмент, поэтому память
+ограничена размером батча индексации, а не размером файла. Номер страницы
+(для PDF) попадает в метаданные чанка.
+
+Извлечение текста из PDF (PyPDF2) и DOCX — чистый Python и упирается в GIL,
+отнимая ядро у Flask и модели эмбеддингов. Поэтому PDF и DOCX разбираются в
+пуле процессов (PARSE_WORKERS): каждый файл — отдельная задача, большие PDF —
+по диапазонам страниц. Обратно чанки текста идут пачками через ограниченную
+очередь, пока воркер ещё разбирает остаток диапазона.
+"""
+
+import multiprocessing
+import mimetypes
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from queue import Empty
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Читаем TXT блоками, а не целиком
+TEXT_BLOCK_CHARS = 64 * 1024
+
+PDF_MIME = 'application/pdf'
+DOCX_MIME = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+def detect_type(file_path: str) -> str:
+    mime_type, _ = mimetypes.guess_type(file_path)
+    if mime_type == PDF_MIME:
+        return 'pdf'
+    if mime_type == DOCX_MIME:
+        return 'docx'
+    if mime_type == 'text/plain' or file_path.endswith('.txt'):
+        return 'txt'
+    raise ValueError(f"Unsupported file type: {mime_type}")
+
+
+def count_pdf_pages(file_path: str) -> int:
+    from PyPDF2 import PdfReader
+    return len(PdfReader(file_path).pages)
+
+
+def iter_segments(file_path: str, page_range: Tuple[int, int] = None) -> Iterator[Tuple[Optional[int], str]]:
+    """
+    Отдаёт (номер страницы или None, текст) по мере чтения файла.
+    Сегменты PDF и DOCX разделяются переводом строки, блоки TXT идут подряд.
+    page_range — (первая, последняя) страница PDF включительно, нумерация с 1.
+    """
+    file_type = detect_type(file_path)
+    if file_type == 'pdf':
+        from PyPDF2 import PdfReader
+        reader = PdfReader(file_path)
+        first, last = page_range or (1, len(reader.pages))
+        for page_no in range(first, min(last, len(reader.pages)) + 1):
+            extracted = reader.pages[page_no - 1].extract_text()
+            if extracted:
+                yield page_no, extracted + "\n"
+    elif file_type == 'docx':
+        from docx import Document as DocxDocument
+        doc = DocxDocument(file_path)
+        for para in doc.paragraphs:
+            if para.text.strip():
+                yield None, para.text + "\n"
+    else:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            while True:
+                block = f.read(TEXT_BLOCK_CHARS)
+                if not block:
+                    break
+                yield None, block
+
+
+# === РАЗБОР В ПУЛЕ ПРОЦЕССОВ ===
+# Воркер отдаёт чанки пачками через очередь задачи, а не одним списком на весь диапазон
+# страниц: индексация начинает эмбеддить с первой пачки, а память родителя и воркера
+# ограничена STREAM_QUEUE_BATCHES пачками — воркер ждёт, пока родитель заберёт прежние
+STREAM_BATCH_CHUNKS = 64
+STREAM_QUEUE_BATCHES = 4
+# Как часто родитель, ожидая пачку, проверяет, не упала ли задача
+_POLL_SEC = 0.5
+
+
+def parse_chunks(file_path: str, chunker: Callable, page_range: Tuple[int, int] = None, out=None,
+                 cancel=None, batch_chunks: int = STREAM_BATCH_CHUNKS) -> int:
+    """
+    Задача для процесса-воркера: файл (или диапазон страниц PDF) -> чанки.
+    chunker — объект из app/services/chunking.py (передаётся в процесс через pickle).
+    Чанки уходят в очередь out списками по batch_chunks, в конце — None. cancel —
+    Event: родитель перестал читать, разбор прекращается. Возвращает длину разобранного
+    текста — она нужна, чтобы сдвинуть start_char/end_char следующего диапазона.
+    """
+    batch = []
+    length = 0
+    for chunk, meta in chunker(iter_segments(file_path, page_range)):
+        batch.append((chunk, meta))
+        length = meta['end_char']
+        if len(batch) >= batch_chunks:
+            if cancel.is_set():
+                return length
+            out.put(batch)
+            batch = []
+    if batch:
+        out.put(batch)
+    out.put(None)
+    return length
+
+
+class ParseTask:
+    """Задача разбора в пуле: future воркера и очередь, через которую приходят пачки чанков."""
+
+    def __init__(self, future: Future, queue, cancel):
+        self.future = future
+        self.queue = queue
+        self.cancel = cancel
+
+    def iter_batches(self) -> Iterator[List[Tuple[str, Dict]]]:
+        while True:
+            try:
+                batch = self.queue.get(timeout=_POLL_SEC)
+            except Empty:
+                # Упавший воркер не пришлёт None — исключение задачи пробрасываем
+                if self.future.done():
+                    self.future.result()
+                continue
+            if batch is None:
+                return
+            yield batch
+
+    def stop(self):
+        """Останавливает недочитанную задачу: иначе воркер навсегда повиснет на полной очереди."""
+        if self.future.done() or self.future.cancel():
+            return
+        self.cancel.set()
+        while not self.future.done():
+            try:
+                self.queue.get(timeout=_POLL_SEC)
+            except Empty:
+                pass
+
+
+def submit_parsing(pool: ProcessPoolExecutor, file_path: str, chunker: Callable,
+                   pages_per_task: int = 32) -> Optional[List[ParseTask]]:
+    """
+    Ставит разбор PDF/DOCX в пул: PDF длиннее pages_per_task страниц — несколькими
+    задачами по диапазонам. TXT разбирается потоком на месте (None): он не упирается в CPU.
+    Чанк не переходит границу диапазона страниц.
+    """
+    file_type = detect_type(file_path)
+    if file_type == 'txt':
+        return None
+    page_ranges = [None]
+    if file_type == 'pdf':
+        pages = count_pdf_pages(file_path)
+        if pages > pages_per_task:
+            page_ranges = [(first, min(first + pages_per_task - 1, pages))
+                           for first in range(1, pages + 1, pages_per_task)]
+    manager = get_parse_manager()
+    tasks = []
+    for page_range in page_ranges:
+        queue, cancel = manager.Queue(STREAM_QUEUE_BATCHES), manager.Event()
+        tasks.append(ParseTask(pool.submit(parse_chunks, file_path, chunker, page_range, queue, cancel),
+                               queue, cancel))
+    return tasks
+
+
+def iter_parsed_chunks(tasks: List[ParseTask]) -> Iterator[Tuple[str, Dict]]:
+    """
+    Чанки задач по порядку по мере разбора; позиции в документе сдвигаются на длину
+    предыдущих диапазонов. Если чтение прервано, недочитанные задачи останавливаются.
+    """
+    offset = 0
+    chunk_id = 0
+    try:
+        for task in tasks:
+            for batch in task.iter_batches():
+                for chunk, meta in batch:
+                    meta["chunk_id"] = f"chunk_{chunk_id}"
+                    meta["start_char"] += offset
+                    meta["end_char"] += offset
+                    chunk_id += 1
+                    yield chunk, meta
+            offset += task.future.result()
+    finally:
+        stop_parsing(tasks)
+
+
+def stop_parsing(tasks: Optional[List[ParseTask]]):
+    """Останавливает задачи разбора, чанки которых уже не нужны (завершённые не трогает)."""
+    for task in tasks or ():
+        task.stop()
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_manager = None
+_pool_lock = threading.Lock()
+
+
+def get_parse_pool(workers: int) -> Optional[ProcessPoolExecutor]:
+    """Общий для процесса пул разбора документов; None, если workers <= 0."""
+    global _pool
+    if workers <= 0:
+        return None
+    with _pool_lock:
+        # Упавший воркер (например, OOM на кривом PDF) ломает весь пул — пересоздаём
+        if _pool is not None and getattr(_pool, '_broken', False):
+            _pool.shutdown(wait=False)
+            _pool = None
+        if _pool is None:
+            # spawn, а не fork: fork процесса с живыми потоками Flask/FAISS может зависнуть
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def get_parse_manager():
+    """Процесс-менеджер очередей, через которые воркеры пула отдают чанки (один на процесс)."""
+    global _manager
+    with _pool_lock:
+        if _manager is None:
+            _manager = multiprocessing.get_context('spawn').Manager()
+    return _manager
@@ -0,0 +1,145 @@
+# app/services/embedding_batcher.py
+"""
+Микробатчинг вызовов модели эмбеддингов.
+
+На CPU прямой проход SentenceTransformer по одной строке почти так же дорог, как
+по нескольким десяткам: параллельные /api/chat, /api/search, кэш ответов LLM и
+бот кодируют по одному запросу и простаивают на блокировке модели. EmbeddingBatcher
+собирает запросы из всех потоков (и корутин — через aencode) в течение нескольких
+миллисекунд или до max_batch текстов и делает один батчевый проход.
+
+Ожидание адаптивное: пока запросы приходят по одному (средний размер последних
+батчей около 1), батчер не ждёт и отдаёт запрос в модель сразу — одиночный клиент
+не платит задержкой. Под нагрузкой запросы копятся, пока модель занята, и батчер
+дожидается попутчиков до max_wait_ms.
+
+Запросы пользователей (priority='query') идут вперёд фоновой индексации
+(priority='bulk'): bulk-запросы режутся на куски по max_batch // 4 текстов,
+которые добивают батч после запросов пользователей.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_QUERY = 'query'
+PRIORITY_BULK = 'bulk'
+
+
+class _Request:
+    __slots__ = ('texts', 'future', 'enqueued_at')
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class EmbeddingBatcher:
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], max_batch: int = 64, max_wait_ms: float = 5.0):
+        # encode_fn(texts) -> float32-матрица (len(texts), dimension), один проход модели
+        self.encode_fn = encode_fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queues = {PRIORITY_QUERY: deque(), PRIORITY_BULK: deque()}
+        self._pending_texts = 0
+        # Скользящее среднее размера батча: по нему решаем, есть ли смысл ждать попутчиков
+        self._avg_batch = 1.0
+        self._cond = threading.Condition()
+        self._worker = None
+
+        # === Статистика ===
+        self.batches = 0
+        self.batched_texts = 0
+        self.max_queue_wait = 0.0
+
+    def submit(self, texts: List[str], priority: str = PRIORITY_QUERY) -> List[Future]:
+        """Ставит тексты в очередь; bulk-запросы режутся на куски по max_batch // 4."""
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority '{priority}'")
+        step = len(texts) if priority == PRIORITY_QUERY else max(1, self.max_batch // 4)
+        requests = [_Request(texts[i:i + step]) for i in range(0, len(texts), max(1, step))]
+        with self._cond:
+            self._ensure_worker()
+            self._queues[priority].extend(requests)
+            self._pending_texts += len(texts)
+            self._cond.notify()
+        return [request.future for request in requests]
+
+    def encode(self, texts: List[str], priority: str = PRIORITY_QUERY) -> np.ndarray:
+        futures = self.submit(texts, priority)
+        return np.concatenate([future.result() for future in futures])
+
+    async def aencode(self, texts: List[str], priority: str = PRIORITY_QUERY) -> np.ndarray:
+        """encode для asyncio-кода: корутина ждёт батч, не занимая event loop."""
+        futures = self.submit(texts, priority)
+        results = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        return np.concatenate(results)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+            self._worker.start()
+
+    def _take_batch(self) -> List[_Request]:
+        """Вызывается под self._cond: сначала запросы пользователей, остаток батча — bulk."""
+        batch, size = [], 0
+        for queue in (self._queues[PRIORITY_QUERY], self._queues[PRIORITY_BULK]):
+            while queue and (not batch or size + len(queue[0].texts) <= self.max_batch):
+                request = queue.popleft()
+                batch.append(request)
+                size += len(request.texts)
+        self._pending_texts -= size
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending_texts:
+                    self._cond.wait()
+                # Первый запрос пришёл — под нагрузкой ждём попутчиков, пока батч не наполнится
+                # или не выйдет время. Если в очереди уже есть bulk, ждать нечего
+                deadline = time.monotonic() + (self.max_wait if self._avg_batch >= 1.5 else 0.0)
+                while self._pending_texts < self.max_batch and not self._queues[PRIORITY_BULK]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+
+            started = time.perf_counter()
+            texts = [text for request in batch for text in request.texts]
+            try:
+                embeddings = self.encode_fn(texts)
+            except Exception as e:
+                logger.error(f"Batched encode failed ({len(texts)} texts): {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.batched_texts += len(texts)
+            self._avg_batch = 0.8 * self._avg_batch + 0.2 * len(texts)
+            self.max_queue_wait = max(self.max_queue_wait, started - min(r.enqueued_at for r in batch))
+            offset = 0
+            for request in batch:
+                request.future.set_result(embeddings[offset:offset + len(request.texts)])
+                offset += len(request.texts)
+
+    def get_stats(self) -> Dict:
+        return {
+            'max_batch': self.max_batch,
+            'max_wait_ms': round(self.max_wait * 1000, 2),
+            'batches': self.batches,
+            'avg_batch_size': round(self.batched_texts / self.batches, 2) if self.batches else 0.0,
+            'max_queue_wait_ms': round(self.max_queue_wait * 1000, 1),
+            'queued_texts': self._pending_texts,
+        }
@@ -0,0 +1,220 @@
+# app/services/embedding_service.py
+"""
+Общая для всего процесса модель эмбеддингов.
+
+VectorDB, RAGEngine, фоновая обработка документов и Telegram-бот (в режиме
+`python run.py both` он живёт в том же процессе) получают один и тот же
+экземпляр, поэтому веса SentenceTransformer загружаются в память ровно один раз.
+Создаёт сервис только build_embedding_service(config) — так настройки из конфига
+не теряются, кто бы ни обратился к модели первым; find_embedding_service()
+лишь возвращает уже созданный сервис (или None). Вызовы encode из разных потоков сводятся
+в общие батчи (см. app/services/embedding_batcher.py).
+
+Бэкенд модели выбирается в конфиге (EMBEDDING_BACKEND):
+- torch      — PyTorch, как раньше;
+- torch_int8 — та же модель с динамической int8-квантизацией Linear-слоёв;
+- onnx       — ONNX Runtime (sentence-transformers>=3.2 и optimum[onnxruntime]);
+- onnx_int8  — квантизованный ONNX-файл из репозитория модели (EMBEDDING_ONNX_FILE).
+Веса те же, поэтому при совпадении эмбеддингов (benchmarks/embedding_parity_check.py)
+бэкенд меняется без переиндексации.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from app.services.embedding_batcher import EmbeddingBatcher, PRIORITY_QUERY
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKENDS = ('torch', 'torch_int8', 'onnx', 'onnx_int8')
+# Квантизованный файл, который sentence-transformers публикует для all-MiniLM-L6-v2 и других моделей
+DEFAULT_ONNX_INT8_FILE = 'onnx/model_qint8_avx2.onnx'
+
+
+class EmbeddingService:
+    def __init__(self, model_name: str, cache_folder: Optional[str] = None, batch_size: int = 32,
+                 batching: bool = True, max_batch: int = 64, batch_wait_ms: float = 5.0,
+                 backend: str = 'torch', onnx_file: Optional[str] = None, num_threads: int = 0):
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{backend}'. Available: {list(EMBEDDING_BACKENDS)}")
+        self.model_name = model_name
+        self.cache_folder = cache_folder
+        self.batch_size = batch_size
+        self.backend = backend
+        self.onnx_file = onnx_file
+        self.num_threads = num_threads  # 0 — число потоков по умолчанию (все ядра)
+        self._model = None
+        self._load_lock = threading.Lock()
+        # Токенизатор HuggingFace не допускает одновременных вызовов из разных потоков
+        self._encode_lock = threading.Lock()
+        # Микробатчинг: None — каждый encode идёт в модель сам по себе.
+        # Собранный батч (не больше max_batch текстов) — один проход модели
+        self.batcher = EmbeddingBatcher(
+            lambda texts: self._encode_batch(texts, batch_size=len(texts)),
+            max_batch=max_batch,
+            max_wait_ms=batch_wait_ms
+        ) if batching else None
+
+        # === Статистика ===
+        self.load_time = None      # секунды на загрузку модели
+        self.memory_bytes = None   # размер весов модели в байтах
+        self.encode_calls = 0
+        self.encoded_texts = 0
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def model(self):
+        """Модель загружается лениво при первом обращении (double-checked locking)."""
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    def _load_model(self):
+        from sentence_transformers import SentenceTransformer
+
+        started = time.perf_counter()
+        if self.backend in ('onnx', 'onnx_int8'):
+            model = SentenceTransformer(
+                self.model_name,
+                cache_folder=self.cache_folder,
+                device='cpu',
+                backend='onnx',
+                model_kwargs=self._onnx_model_kwargs()
+            )
+        else:
+            if self.num_threads:
+                import torch
+                torch.set_num_threads(self.num_threads)
+            model = SentenceTransformer(self.model_name, cache_folder=self.cache_folder)
+            if self.backend == 'torch_int8':
+                import torch
+                # Веса Linear-слоёв в int8, активации квантуются на лету — только CPU
+                torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.load_time = time.perf_counter() - started
+        # У ONNX-модели нет torch-параметров — размер весов неизвестен
+        self.memory_bytes = sum(p.numel() * p.element_size() for p in model.parameters()) or None
+        logger.info(
+            f"Embedding model '{self.model_name}' ({self.backend}) loaded in {self.load_time:.2f}s"
+            + (f" ({self.memory_bytes / 1024 / 1024:.1f} MB)" if self.memory_bytes else "")
+        )
+        return model
+
+    def _onnx_model_kwargs(self) -> Dict:
+        model_kwargs = {}
+        file_name = self.onnx_file or (DEFAULT_ONNX_INT8_FILE if self.backend == 'onnx_int8' else None)
+        if file_name:
+            model_kwargs['file_name'] = file_name
+        if self.num_threads:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = self.num_threads
+            model_kwargs['session_options'] = session_options
+        return model_kwargs
+
+    def get_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: Union[str, List[str]], batch_size: Optional[int] = None,
+               priority: str = PRIORITY_QUERY) -> np.ndarray:
+        """
+        Кодирует один текст или список текстов батчами.
+        Возвращает float32-матрицу (n, dimension); для одной строки — вектор (dimension,).
+        priority — 'query' для запросов пользователей, 'bulk' для индексации документов:
+        при включённом батчинге запросы обгоняют индексацию. С явным batch_size модель
+        вызывается напрямую, мимо батчера.
+        """
+        single = isinstance(texts, str)
+        batch = [texts] if single else list(texts)
+        if not batch:
+            return np.zeros((0, self.get_dimension()), dtype=np.float32)
+
+        if self.batcher is not None and batch_size is None:
+            embeddings = self.batcher.encode(batch, priority)
+        else:
+            embeddings = self._encode_batch(batch, batch_size)
+        return embeddings[0] if single else embeddings
+
+    async def aencode(self, texts: Union[str, List[str]], priority: str = PRIORITY_QUERY) -> np.ndarray:
+        """encode для asyncio-кода (бот): ждёт общий батч, не блокируя event loop."""
+        single = isinstance(texts, str)
+        batch = [texts] if single else list(texts)
+        if not batch:
+            return np.zeros((0, self.get_dimension()), dtype=np.float32)
+        if self.batcher is not None:
+            embeddings = await self.batcher.aencode(batch, priority)
+        else:
+            embeddings = await asyncio.to_thread(self._encode_batch, batch)
+        return embeddings[0] if single else embeddings
+
+    def _encode_batch(self, batch: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """Один вызов модели; батчер вызывает его из своего потока."""
+        model = self.model
+        with self._encode_lock:
+            embeddings = model.encode(
+                batch,
+                batch_size=batch_size or self.batch_size,
+                show_progress_bar=False,
+                convert_to_numpy=True
+            )
+            self.encode_calls += 1
+            self.encoded_texts += len(batch)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def get_stats(self) -> Dict:
+        return {
+            'model_name': self.model_name,
+            'backend': self.backend,
+            'num_threads': self.num_threads or None,
+            'loaded': self.is_loaded,
+            'load_time_sec': round(self.load_time, 3) if self.load_time is not None else None,
+            'memory_mb': round(self.memory_bytes / 1024 / 1024, 1) if self.memory_bytes is not None else None,
+            'encode_calls': self.encode_calls,
+            'encoded_texts': self.encoded_texts,
+            'batching': self.batcher.get_stats() if self.batcher is not None else None,
+        }
+
+
+# === РЕЕСТР СЕРВИСОВ (один на процесс) ===
+_services: Dict[str, EmbeddingService] = {}
+_services_lock = threading.Lock()
+
+
+def find_embedding_service(model_name: str) -> Optional[EmbeddingService]:
+    """Уже созданный сервис модели или None — ничего не создаёт и не загружает."""
+    return _services.get(model_name)
+
+
+def build_embedding_service(config) -> EmbeddingService:
+    """
+    Общий для процесса EmbeddingService с настройками из конфига приложения —
+    единственный путь создания сервиса. Повторный вызов возвращает тот же экземпляр.
+    """
+    model_name = config['EMBEDDING_MODEL']
+    service = _services.get(model_name)
+    if service is None:
+        with _services_lock:
+            service = _services.get(model_name)
+            if service is None:
+                service = EmbeddingService(
+                    model_name,
+                    cache_folder=config.get('EMBEDDING_CACHE_FOLDER'),
+                    batch_size=config.get('EMBEDDING_BATCH_SIZE', 32),
+                    batching=config.get('EMBEDDING_BATCHING_ENABLED', True),
+                    max_batch=config.get('EMBEDDING_MAX_BATCH', 64),
+                    batch_wait_ms=config.get('EMBEDDING_BATCH_WAIT_MS', 5),
+                    backend=config.get('EMBEDDING_BACKEND', 'torch'),
+                    onnx_file=config.get('EMBEDDING_ONNX_FILE'),
+                    num_threads=config.get('EMBEDDING_NUM_THREADS', 0)
+                )
+                _services[model_name] = service
+    return service
@@ -0,0 +1,112 @@
+# app/services/index_wal.py
+"""
+Журнал изменений (WAL) для индекса FAISS и атомарная запись файлов.
+
+Каждое изменение индекса (добавление векторов, удаление документа) дописывается
+в конец wal.log одной записью: заголовок <длина, crc32> + pickle. Полный снимок
+индекса (checkpoint) пишется только периодически; при старте снимок загружается,
+а записи журнала после него применяются повторно. Оборванная при сбое запись в
+хвосте журнала распознаётся по crc и отбрасывается.
+"""
+
+import os
+import pickle
+import struct
+import zlib
+from typing import Callable, Iterator
+
+_HEADER = struct.Struct('<II')  # длина payload, crc32
+
+
+def atomic_write(path: str, write_fn: Callable[[str], None]):
+    """
+    Пишет файл через временный файл рядом и os.replace — читатель видит
+    либо старую, либо новую версию целиком.
+    """
+    # pid в имени: несколько процессов могут писать один и тот же снимок одновременно
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write_fn(tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class WriteAheadLog:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        return self._file
+
+    @staticmethod
+    def _write_record(f, record: dict):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+        f.write(payload)
+
+    def append(self, record: dict):
+        """Дописывает запись и сбрасывает её на диск (fsync)."""
+        f = self._open()
+        self._write_record(f, record)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def replay(self) -> Iterator[dict]:
+        """
+        Читает записи по порядку. На первой повреждённой или неполной записи
+        останавливается и обрезает журнал до последней целой записи.
+        """
+        if not os.path.exists(self.path):
+            return
+        good_offset = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, crc = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                good_offset = f.tell()
+                yield pickle.loads(payload)
+            truncated = f.seek(0, os.SEEK_END) != good_offset
+        if truncated:
+            self.close()
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_offset)
+
+    def size_bytes(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def reset(self):
+        """Очищает журнал после успешного checkpoint."""
+        self.close()
+        with open(self.path, 'wb') as f:
+            os.fsync(f.fileno())
+
+    def drop_through(self, seq: int):
+        """
+        Убирает записи с номером <= seq (они уже в снимке). Записи, дописанные,
+        пока снимок писался на диск, остаются в журнале.
+        """
+        tail = [record for record in self.replay() if record['seq'] > seq]
+        if not tail:
+            self.reset()
+            return
+
+        def write_tail(tmp):
+            with open(tmp, 'wb') as f:
+                for record in tail:
+                    self._write_record(f, record)
+
+        self.close()
+        atomic_write(self.path, write_tail)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
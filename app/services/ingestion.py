@@ -0,0 +1,220 @@
+# app/services/ingestion.py
+"""
+Долгоживущая очередь индексации документов.
+
+Загрузка файла только ставит задачу в ограниченную очередь; пул потоков
+забирает задачи пачками, потоком режет документы пачки на чанки, эмбеддит
+их общими батчами (INGESTION_CHUNK_BATCH) и пишет в живой индекс того же
+RAGEngine, которым пользуется веб-процесс. Если очередь заполнена, submit() бросает IngestionQueueFull —
+роут отвечает 429. Задача с replaces — новая версия документа: после успешной
+индексации старая версия удаляется (её неизменённые чанки к этому моменту уже
+переиспользованы новой версией без повторного эмбеддинга).
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Статусы задачи
+JOB_QUEUED = 'queued'
+JOB_PROCESSING = 'processing'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+def allocate_document_path(folder: str, filename: str) -> Tuple[str, str]:
+    """Свободный путь в папке документов: при коллизии имён — name_1.ext, name_2.ext, ..."""
+    file_path = os.path.join(folder, filename)
+    name, ext = os.path.splitext(filename)
+    counter = 1
+    while os.path.exists(file_path):
+        filename = f"{name}_{counter}{ext}"
+        file_path = os.path.join(folder, filename)
+        counter += 1
+    return file_path, filename
+
+
+class IngestionQueueFull(Exception):
+    """Очередь индексации заполнена — клиенту стоит повторить запрос позже."""
+
+
+class IngestionJob:
+    def __init__(self, doc_id: int, file_path: str, replaces: Optional[int] = None):
+        self.job_id = uuid.uuid4().hex
+        self.doc_id = doc_id
+        self.file_path = file_path
+        # id документа, который эта загрузка заменяет (новая версия файла)
+        self.replaces = replaces
+        self.status = JOB_QUEUED
+        self.error = None
+        self.chunks = 0
+        self.reused_chunks = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self) -> Dict:
+        return {
+            'job_id': self.job_id,
+            'doc_id': self.doc_id,
+            'status': self.status,
+            'error': self.error,
+            'chunks': self.chunks,
+            'reused_chunks': self.reused_chunks,
+            'replaces': self.replaces,
+            'queued_sec': round((self.started_at or time.time()) - self.created_at, 3),
+            'processing_sec': round((self.finished_at or time.time()) - self.started_at, 3)
+            if self.started_at else None,
+        }
+
+
+class IngestionQueue:
+    def __init__(self, app, engine_getter: Callable, workers: int = 2, max_queue: int = 32, batch_docs: int = 4,
+                 max_tracked_jobs: int = 1000):
+        self.app = app
+        # Возвращает RAGEngine из app.config — тот же, что обслуживает поиск в чате
+        self.engine_getter = engine_getter
+        self.workers = max(1, workers)
+        self.batch_docs = max(1, batch_docs)
+        self.max_tracked_jobs = max_tracked_jobs
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._jobs_by_doc: Dict[int, str] = {}
+        self._jobs_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"ingestion-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Ingestion queue started: {self.workers} workers, queue size {self._queue.maxsize}")
+
+    def is_full(self) -> bool:
+        return self._queue.full()
+
+    def submit(self, doc_id: int, file_path: str, replaces: Optional[int] = None) -> IngestionJob:
+        job = IngestionJob(doc_id, file_path, replaces)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise IngestionQueueFull(f"Ingestion queue is full ({self._queue.maxsize} jobs)")
+        self._track(job)
+        return job
+
+    def get_job(self, job_id: str) -> Optional[IngestionJob]:
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def get_job_for_doc(self, doc_id: int) -> Optional[IngestionJob]:
+        with self._jobs_lock:
+            job_id = self._jobs_by_doc.get(doc_id)
+            return self._jobs.get(job_id) if job_id else None
+
+    def get_stats(self) -> Dict:
+        with self._jobs_lock:
+            counts = {JOB_QUEUED: 0, JOB_PROCESSING: 0, JOB_DONE: 0, JOB_FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return {
+            'workers': self.workers,
+            'batch_docs': self.batch_docs,
+            'queue_size': self._queue.qsize(),
+            'queue_capacity': self._queue.maxsize,
+            'jobs': counts,
+        }
+
+    def _track(self, job: IngestionJob):
+        with self._jobs_lock:
+            self._jobs[job.job_id] = job
+            self._jobs_by_doc[job.doc_id] = job.job_id
+            # Храним только последние задачи, чтобы память не росла бесконечно
+            while len(self._jobs) > self.max_tracked_jobs:
+                _, old = self._jobs.popitem(last=False)
+                if self._jobs_by_doc.get(old.doc_id) == old.job_id:
+                    del self._jobs_by_doc[old.doc_id]
+
+    def _next_batch(self) -> List[IngestionJob]:
+        """Ждёт первую задачу, затем без ожидания добирает пачку из очереди."""
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_docs:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker_loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with self.app.app_context():
+                    self._process_batch(batch)
+            except Exception as e:
+                logger.error(f"Ingestion batch failed: {e}", exc_info=True)
+                for job in batch:
+                    if job.status != JOB_DONE:
+                        job.status = JOB_FAILED
+                        job.error = str(e)
+                        job.finished_at = time.time()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _process_batch(self, batch: List[IngestionJob]):
+        from app import db
+        from app.models import Document
+
+        for job in batch:
+            job.status = JOB_PROCESSING
+            job.started_at = time.time()
+
+        rag_engine = self.engine_getter()
+        results = rag_engine.add_documents([(job.file_path, job.doc_id) for job in batch])
+
+        for job in batch:
+            result = results.get(job.doc_id, {'success': False, 'chunks': 0, 'reused': 0, 'error': 'No result'})
+            job.chunks = result['chunks']
+            job.reused_chunks = result.get('reused', 0)
+            job.error = result['error']
+            job.status = JOB_DONE if result['success'] else JOB_FAILED
+            job.finished_at = time.time()
+
+            doc = Document.query.get(job.doc_id)
+            if doc:
+                doc.processed = result['success']
+            elif result['success']:
+                # Документ удалили, пока он индексировался — убираем его векторы
+                rag_engine.delete_document(job.doc_id)
+            if result['success'] and job.replaces:
+                self._remove_replaced(rag_engine, job.replaces)
+            if result['success']:
+                logger.info(f"Document {job.doc_id} indexed: {job.chunks} chunks, {job.reused_chunks} reused")
+            else:
+                logger.warning(f"Failed to process document {job.doc_id}: {job.error}")
+        db.session.commit()
+
+    @staticmethod
+    def _remove_replaced(rag_engine, doc_id: int):
+        """Удаляет старую версию документа: векторы общих чанков переходят к новой версии."""
+        from app import db
+        from app.models import Document
+
+        rag_engine.delete_document(doc_id)
+        old = Document.query.get(doc_id)
+        if old:
+            if os.path.exists(old.file_path):
+                try:
+                    os.remove(old.file_path)
+                except OSError as e:
+                    logger.warning(f"Failed to delete file {old.file_path}: {e}")
+            db.session.delete(old)
+        logger.info(f"Document {doc_id} replaced by a new version")
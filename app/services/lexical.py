@@ -0,0 +1,109 @@
+# app/services/lexical.py
+"""
+Токенизация для лексического (BM25) поиска по чанкам.
+
+Плотный поиск плохо находит точные идентификаторы, артикулы и редкие термины,
+поэтому рядом с FAISS живёт инвертированный индекс (FTS5 в хранилище чанков,
+см. ChunkStore). Текст и запрос проходят один и тот же разбор:
+
+- NFKC, casefold, ё -> е;
+- коды вида AB-12.3, v2.1, 10/20 остаются одним токеном и дополнительно
+  индексируются по частям;
+- русские и английские слова приводятся к основе лёгким стеммером
+  (отсечение окончаний): «договора», «договоров», «договору» -> «договор».
+  Токены с цифрами не стеммятся.
+
+Из запроса (но не из индекса) выбрасываются стоп-слова: иначе «что», «the»
+или «для» находят почти каждый чанк и забивают BM25-кандидатов шумом.
+
+При изменении правил разбора текста нужно увеличить TOKENIZER_VERSION — хранилище
+чанков пересоберёт лексический индекс при старте. Список стоп-слов на индекс
+не влияет.
+"""
+
+import re
+import unicodedata
+from typing import List
+
+TOKENIZER_VERSION = 1
+
+# Слово или код: части из букв/цифр, соединённые - . / (AB-12.3, 2024/05, e-mail)
+_TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+_PART_RE = re.compile(r"[-./_]")
+_CYRILLIC_RE = re.compile(r"[а-я]")
+
+# Окончания от длинных к коротким: отсекается самое длинное, если основа не короче _MIN_STEM
+_RU_ENDINGS = sorted((
+    'иями', 'иям', 'ями', 'ами', 'иях', 'ии', 'ией', 'ием', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ешь', 'ишь', 'ете', 'ите', 'ует', 'уют', 'ать', 'ять', 'ить', 'еть', 'ться', 'тся',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ую', 'юю', 'ом', 'ем',
+    'ах', 'ях', 'ам', 'ям', 'ов', 'ев', 'ия', 'ию', 'ью', 'ья', 'ье', 'ут', 'ют', 'ат',
+    'ят', 'ет', 'ит', 'ал', 'ял', 'ил', 'ла', 'ли', 'ло',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+_EN_ENDINGS = ('ations', 'ation', 'ings', 'ing', 'ies', 'ed', 'es', 's')
+_MIN_STEM = 3
+
+# Служебные слова запроса (после нормализации, до стемминга)
+STOP_WORDS = frozenset((
+    'а', 'без', 'был', 'была', 'были', 'было', 'быть', 'бы', 'в', 'вам', 'во', 'вот', 'все', 'всех',
+    'вы', 'где', 'да', 'для', 'до', 'его', 'ее', 'если', 'есть', 'еще', 'же', 'за', 'и', 'из', 'или',
+    'им', 'их', 'к', 'как', 'какая', 'какие', 'какой', 'ко', 'когда', 'кто', 'ли', 'либо', 'мне',
+    'можно', 'мы', 'на', 'над', 'нам', 'не', 'нет', 'ни', 'но', 'нужно', 'о', 'об', 'он', 'она',
+    'они', 'оно', 'от', 'по', 'под', 'при', 'про', 'с', 'со', 'так', 'такая', 'также', 'такие',
+    'такое', 'такой', 'там', 'то', 'тоже', 'тут', 'ты', 'у', 'уже', 'чем', 'что', 'чтобы', 'это',
+    'эти', 'этот', 'я',
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'does', 'for', 'from', 'how', 'in', 'is',
+    'it', 'its', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where',
+    'which', 'who', 'why', 'with',
+))
+
+
+def stem(word: str) -> str:
+    """Лёгкий стемминг одного слова (без цифр и разделителей)."""
+    if _CYRILLIC_RE.search(word):
+        endings = _RU_ENDINGS
+    elif word.isascii() and word.isalpha():
+        if word.endswith('ss'):
+            return word
+        endings = _EN_ENDINGS
+    else:
+        return word
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+
+
+def tokenize(text: str, skip_stop_words: bool = False) -> List[str]:
+    """
+    Токены текста в порядке появления (с повторами — для частоты терма в BM25).
+    skip_stop_words — без STOP_WORDS (для запросов).
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(_normalize(text)):
+        token = match.group()
+        if skip_stop_words and token in STOP_WORDS:
+            continue
+        if _PART_RE.search(token):
+            # Код целиком — для точного совпадения, части — если в запросе только часть кода
+            tokens.append(token)
+            tokens.extend(part for part in _PART_RE.split(token) if part)
+        elif any(ch.isdigit() for ch in token):
+            tokens.append(token)
+        else:
+            tokens.append(stem(token))
+    return tokens
+
+
+def to_match_query(text: str) -> str:
+    """
+    Выражение FTS5 MATCH: любой из значимых токенов запроса (OR), ранжирование — BM25.
+    '' — искать нечего (пустой запрос или одни стоп-слова).
+    """
+    terms = dict.fromkeys(tokenize(text, skip_stop_words=True))
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
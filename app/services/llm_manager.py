@@ -1,125 +1,597 @@
 # app/services/llm_manager.py
 import openai
 import os
-from flask import current_app
+import hashlib
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Dict, Iterator
+import httpx
+from app.services.response_cache import get_response_cache
+from app.services.llm_routing import ROUTING_MODES, get_hedge_executor, get_provider_health
+from app.services.conversation_memory import format_summary_request
+
+# Провайдеры общие для веб-процесса и бота (вне контекста Flask), поэтому логгер модуля
+logger = logging.getLogger(__name__)
+
+
+def iter_stream_text(response) -> Iterator[str]:
+    """Достаёт текст из чанков потокового ответа OpenAI-совместимого API."""
+    for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+
+def as_messages(prompt: str, history: list = None) -> list:
+    """История диалога ({'role', 'content'}) + текущий запрос пользователя."""
+    return list(history or []) + [{"role": "user", "content": prompt}]
+
+
+def make_openai_clients(base_url: str, api_key: str, http_settings: dict = None):
+    """
+    Синхронный и асинхронный клиенты OpenAI-совместимого API с пулом keep-alive
+    соединений: повторные запросы идут по уже открытым (TLS) соединениям.
+    """
+    settings = http_settings or {}
+    limits = httpx.Limits(
+        max_connections=settings.get('max_connections', 100),
+        max_keepalive_connections=settings.get('max_keepalive_connections', 20),
+        keepalive_expiry=settings.get('keepalive_expiry', 30)
+    )
+    timeout = httpx.Timeout(settings.get('timeout', 120), connect=settings.get('connect_timeout', 10))
+    max_retries = settings.get('max_retries', 2)
+    client = openai.OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=max_retries,
+        http_client=openai.DefaultHttpxClient(limits=limits, timeout=timeout)
+    )
+    async_client = openai.AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=max_retries,
+        http_client=openai.DefaultAsyncHttpxClient(limits=limits, timeout=timeout)
+    )
+    return client, async_client
+
 
 class YandexGPTProvider:
-    def __init__(self, api_key: str, folder_id: str, model_name: str = 'yandexgpt-lite'):
+    def __init__(self, api_key: str, folder_id: str, model_name: str = 'yandexgpt-lite', http_settings: dict = None):
         if not api_key or not folder_id:
             raise ValueError("Yandex API key and folder ID are required")
-        self.client = openai.OpenAI(
-            api_key=api_key,
-            base_url="https://llm.api.cloud.yandex.net/v1",
+        # Асинхронный клиент — для бота: не блокирует event loop на время запроса
+        self.client, self.async_client = make_openai_clients(
+            "https://llm.api.cloud.yandex.net/v1", api_key, http_settings
         )
         self.model = f"gpt://{folder_id}/{model_name}"
         self.name = "yandex_gpt"
 
-    def generate(self, prompt: str, temperature: float = 0.7, max_tokens: int = 2000) -> str:
+    def generate(self, prompt: str, temperature: float = 0.7, max_tokens: int = 2000, history: list = None) -> str:
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
-                messages=[{"role": "user", "content": prompt}],
+                messages=as_messages(prompt, history),
                 temperature=temperature,
                 max_tokens=max_tokens
             )
             return response.choices[0].message.content.strip()
         except Exception as e:
-            current_app.logger.error(f"Yandex GPT API error: {e}")
+            logger.error(f"Yandex GPT API error: {e}")
+            raise RuntimeError(f"Yandex GPT request failed: {str(e)}")
+
+    async def agenerate(self, prompt: str, temperature: float = 0.7, max_tokens: int = 2000, history: list = None) -> str:
+        try:
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=as_messages(prompt, history),
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.error(f"Yandex GPT API error: {e}")
+            raise RuntimeError(f"Yandex GPT request failed: {str(e)}")
+
+    def stream(self, prompt: str, temperature: float = 0.7, max_tokens: int = 2000, history: list = None) -> Iterator[str]:
+        """Отдаёт текст ответа по частям по мере генерации (stream=True)."""
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=as_messages(prompt, history),
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            yield from iter_stream_text(response)
+        except Exception as e:
+            logger.error(f"Yandex GPT API error: {e}")
             raise RuntimeError(f"Yandex GPT request failed: {str(e)}")
 
 
 class LocalLLMProvider:
-    def __init__(self, base_url: str, model_name: str):
-        self.client = openai.OpenAI(
-            base_url=f"{base_url.rstrip('/')}/v1",
-            api_key="ollama"
-        )
+    def __init__(self, base_url: str, model_name: str, http_settings: dict = None):
+        self.client, self.async_client = make_openai_clients(f"{base_url.rstrip('/')}/v1", "ollama", http_settings)
         self.model_name = model_name
         self.name = "local_llm"
 
-    def generate(self, prompt: str, temperature: float = 0.7, max_tokens: int = 1000) -> str:
+    def generate(self, prompt: str, temperature: float = 0.7, max_tokens: int = 1000, history: list = None) -> str:
         try:
             response = self.client.chat.completions.create(
                 model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
+                messages=as_messages(prompt, history),
                 temperature=temperature,
                 max_tokens=max_tokens
             )
             return response.choices[0].message.content.strip()
         except Exception as e:
-            current_app.logger.error(f"Local LLM (Ollama) error: {e}")
+            logger.error(f"Local LLM (Ollama) error: {e}")
             raise RuntimeError(f"Local LLM request failed: {str(e)}")
 
+    async def agenerate(self, prompt: str, temperature: float = 0.7, max_tokens: int = 1000, history: list = None) -> str:
+        try:
+            response = await self.async_client.chat.completions.create(
+                model=self.model_name,
+                messages=as_messages(prompt, history),
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.error(f"Local LLM (Ollama) error: {e}")
+            raise RuntimeError(f"Local LLM request failed: {str(e)}")
 
-class LLMManager:    
-    def __init__(self, config):
-        self.config = config
-        self.providers = {}
-        self.current_provider = None
-
-        # Yandex GPT
-        yandex_key = config.get('YANDEX_API_KEY')
-        yandex_folder = config.get('YANDEX_FOLDER_ID')
-        if yandex_key and yandex_folder:
-            self.providers['yandex_gpt'] = YandexGPTProvider(
-                api_key=yandex_key,
-                folder_id=yandex_folder,
-                model_name=config.get('YANDEX_GPT_MODEL', 'yandexgpt-lite')
+    def stream(self, prompt: str, temperature: float = 0.7, max_tokens: int = 1000, history: list = None) -> Iterator[str]:
+        """Отдаёт текст ответа по частям по мере генерации (stream=True)."""
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=as_messages(prompt, history),
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
             )
-        else:
-            current_app.logger.warning("Yandex GPT not configured")
-
-        # Local LLM
-        ollama_url = config.get('OLLAMA_BASE_URL', 'http://localhost:11434')
-        local_model = config.get('LOCAL_MODEL_NAME', 'local_llm')  # ← Теперь 'local_llm' по умолчанию
-        self.providers['local_llm'] = LocalLLMProvider(
-            base_url=ollama_url,
-            model_name=local_model
+            yield from iter_stream_text(response)
+        except Exception as e:
+            logger.error(f"Local LLM (Ollama) error: {e}")
+            raise RuntimeError(f"Local LLM request failed: {str(e)}")
+
+
+# === РЕЕСТР ПРОВАЙДЕРОВ (один на процесс) ===
+# Клиенты с пулами соединений создаются один раз и переиспользуются всеми
+# LLMManager: веб-роутами и всеми пользователями бота
+_providers: Dict[str, object] = {}
+_providers_lock = threading.Lock()
+
+
+def get_llm_providers(config) -> Dict[str, object]:
+    """Возвращает общие для процесса провайдеры {имя: провайдер}."""
+    if not _providers:
+        with _providers_lock:
+            if not _providers:
+                _providers.update(_create_providers(config))
+    return _providers
+
+
+def _create_providers(config) -> Dict[str, object]:
+    http_settings = {
+        'max_connections': config.get('LLM_HTTP_MAX_CONNECTIONS', 100),
+        'max_keepalive_connections': config.get('LLM_HTTP_MAX_KEEPALIVE', 20),
+        'keepalive_expiry': config.get('LLM_HTTP_KEEPALIVE_EXPIRY', 30),
+        'timeout': config.get('LLM_HTTP_TIMEOUT', 120),
+        'connect_timeout': config.get('LLM_HTTP_CONNECT_TIMEOUT', 10),
+        # При fallback / hedged повторяет маршрутизация (следующим провайдером): повторы SDK
+        # с паузами внутри одной попытки съели бы таймаут провайдера до перехода к следующему
+        'max_retries': (config.get('LLM_MAX_RETRIES', 2)
+                        if config.get('LLM_ROUTING_MODE', 'single') == 'single' else 0),
+    }
+    # Таймаут запроса у каждого провайдера свой: облачный отвечает быстрее локального,
+    # а при fallback медленный провайдер не должен съедать всё время запроса
+    timeouts = config.get('LLM_PROVIDER_TIMEOUTS') or {}
+    providers = {}
+
+    # Yandex GPT
+    yandex_key = config.get('YANDEX_API_KEY')
+    yandex_folder = config.get('YANDEX_FOLDER_ID')
+    if yandex_key and yandex_folder:
+        providers['yandex_gpt'] = YandexGPTProvider(
+            api_key=yandex_key,
+            folder_id=yandex_folder,
+            model_name=config.get('YANDEX_GPT_MODEL', 'yandexgpt-lite'),
+            http_settings=dict(http_settings, timeout=timeouts.get('yandex_gpt', http_settings['timeout']))
         )
+    else:
+        logger.warning("Yandex GPT not configured")
+
+    # Local LLM
+    ollama_url = config.get('OLLAMA_BASE_URL', 'http://localhost:11434')
+    local_model = config.get('LOCAL_MODEL_NAME', 'local_llm')  # ← Теперь 'local_llm' по умолчанию
+    providers['local_llm'] = LocalLLMProvider(
+        base_url=ollama_url,
+        model_name=local_model,
+        http_settings=dict(http_settings, timeout=timeouts.get('local_llm', http_settings['timeout']))
+    )
+    return providers
+
+
+class LLMManager:
+    def __init__(self, config):
+        self.config = config
+        # Провайдеры и их HTTP-клиенты общие для процесса — сам LLMManager лёгкий
+        self.providers = get_llm_providers(config)
+        # Семантический кэш ответов (None, если RESPONSE_CACHE_ENABLED выключен)
+        self.response_cache = get_response_cache(config)
+        # Сколько последних реплик истории входит в ключ кэша ответов
+        self.cache_history_messages = max(1, int(config.get('RESPONSE_CACHE_HISTORY_MESSAGES', 6)))
+
+        # Модель для вызовов без model=. Менеджер общий для всех запросов, поэтому
+        # модель выбирается на каждый запрос, а не переключается в самом менеджере
+        self.default_model = 'yandex_gpt' if 'yandex_gpt' in self.providers else 'local_llm'
 
-        # Выбор по умолчанию
-        self.switch_model('yandex_gpt' if 'yandex_gpt' in self.providers else 'local_llm')
+        # single — только выбранная модель; fallback / hedged — см. app/services/llm_routing.py
+        self.routing_mode = config.get('LLM_ROUTING_MODE', 'single')
+        if self.routing_mode not in ROUTING_MODES:
+            logger.warning(f"Unknown LLM_ROUTING_MODE '{self.routing_mode}', using 'single'")
+            self.routing_mode = 'single'
+        self.fallback_chain = [name for name in config.get('LLM_FALLBACK_CHAIN', []) if name in self.providers]
 
-    def switch_model(self, model_name: str):
+    def get_provider(self, model: str = None):
+        """Провайдер для одного запроса: по имени модели или по умолчанию."""
+        model_name = model or self.default_model
         if model_name not in self.providers:
             available = list(self.providers.keys())
             raise ValueError(f"Model '{model_name}' not available. Available: {available}")
-        self.current_provider = self.providers[model_name]
+        return self.providers[model_name]
 
-    def generate_response(self, prompt: str, use_rag: bool = False, rag_context: str = "", chat_history: list = None) -> dict:
+    @staticmethod
+    def _build_prompt(prompt: str, use_rag: bool = False, rag_context: str = "") -> str:
+        """
+        Текст последнего сообщения пользователя. История диалога в промпт не склеивается —
+        она уходит провайдеру отдельными сообщениями (см. as_messages).
+        """
         if use_rag and rag_context.strip():
-            full_prompt = (
+            return (
                 "Используй следующий контекст для ответа на вопрос. "
                 "Если контекст не содержит ответа, скажи, что не знаешь.\n\n"
                 f"Контекст:\n{rag_context}\n\n"
                 f"Вопрос:\n{prompt}\n\n"
                 "Ответ:"
             )
-        else:
-            if chat_history and isinstance(chat_history, list):
-                history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in chat_history])
-                full_prompt = (
-                    "Ты полезный ассистент. Вот история нашего диалога:\n"
-                    f"{history_text}\n\n"
-                    f"Новый вопрос пользователя:\n{prompt}\n\n"
-                    "Ответ:"
-                )
-
-            full_prompt = prompt
-
-        if self.current_provider is None:
-            raise RuntimeError("No LLM provider selected")        
+        return prompt
+
+    def generate_response(self, prompt: str, use_rag: bool = False, rag_context: str = "", chat_history: list = None,
+                          context_hashes: list = None, model: str = None) -> dict:
+        """
+        model — имя провайдера для этого запроса (по умолчанию default_model). Метод не
+        меняет состояние менеджера и безопасен для параллельных запросов к разным моделям.
+        context_hashes — хеши содержимого чанков, из которых собран rag_context; вместе с
+        моделью, последними репликами истории и эмбеддингом вопроса они образуют ключ
+        семантического кэша ответов.
+        chat_history — предыдущие реплики [{'role', 'content'}] (ConversationMemory.messages()).
+        """
+        provider = self.get_provider(model)
+        full_prompt = self._build_prompt(prompt, use_rag, rag_context)
+
+        # === СЕМАНТИЧЕСКИЙ КЭШ ===
+        context_key = self._context_key(use_rag, rag_context, context_hashes, chat_history)
+        cache_embedding = self._cache_embedding(prompt)
+        cached = self._cached_response(provider, context_key, cache_embedding)
+        if cached is not None:
+            return cached
+
         try:
-            response_text = self.current_provider.generate(full_prompt)
-            model_name = getattr(self.current_provider, 'name', 'unknown_model')
-            return {
-                'response': response_text,
-                'model_used': self.current_provider.name # <-- Добавляем имя модели
-            }
+            provider, response_text = self._generate_routed(provider, full_prompt, chat_history)
         except Exception as e:
-            current_app.logger.error(f"LLM generation error: {e}")
+            logger.error(f"LLM generation error: {e}")
             raise RuntimeError(f"Failed to generate response: {str(e)}")
 
+        return self._finish_response(provider, context_key, cache_embedding, response_text)
+
+    async def agenerate_response(self, prompt: str, use_rag: bool = False, rag_context: str = "",
+                                 chat_history: list = None, context_hashes: list = None, model: str = None) -> dict:
+        """Асинхронный generate_response для asyncio-кода (Telegram-бот)."""
+        provider = self.get_provider(model)
+        full_prompt = self._build_prompt(prompt, use_rag, rag_context)
+
+        context_key = self._context_key(use_rag, rag_context, context_hashes, chat_history)
+        cache_embedding = None
+        if self.response_cache is not None:
+            # Эмбеддинг считается на CPU: корутина ждёт общий батч модели (EmbeddingService.aencode)
+            cache_embedding = await self.response_cache.aembed(prompt)
+        cached = self._cached_response(provider, context_key, cache_embedding)
+        if cached is not None:
+            return cached
+
+        try:
+            provider, response_text = await self._agenerate_routed(provider, full_prompt, chat_history)
+        except Exception as e:
+            logger.error(f"LLM generation error: {e}")
+            raise RuntimeError(f"Failed to generate response: {str(e)}")
+
+        return self._finish_response(provider, context_key, cache_embedding, response_text)
+
+    def _cache_embedding(self, prompt: str):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.embed(prompt)
+
+    def _cached_response(self, provider, context_key, cache_embedding):
+        if cache_embedding is None:
+            return None
+        cached = self.response_cache.lookup(provider.name, context_key, cache_embedding)
+        if cached is None:
+            return None
+        response_text, similarity = cached
+        return {
+            'response': response_text,
+            'model_used': provider.name,
+            'cached': True,
+            'cache_similarity': round(similarity, 4)
+        }
+
+    def _finish_response(self, provider, context_key, cache_embedding, response_text: str) -> dict:
+        if cache_embedding is not None and response_text:
+            self.response_cache.store(provider.name, context_key, cache_embedding, response_text)
+        return {
+            'response': response_text,
+            'model_used': provider.name,  # <-- Добавляем имя модели
+            'cached': False
+        }
+
+    def stream_response(self, prompt: str, use_rag: bool = False, rag_context: str = "", chat_history: list = None,
+                        context_hashes: list = None, model: str = None) -> Iterator[Dict]:
+        """
+        Потоковый вариант generate_response. Отдаёт события:
+        {'token': '...'} по мере генерации и в конце {'done': True, 'response': полный текст,
+        'model_used', 'cached', 'ttft_ms' — время до первого токена, 'total_ms'}.
+        """
+        started = time.perf_counter()
+        provider = self.get_provider(model)
+        full_prompt = self._build_prompt(prompt, use_rag, rag_context)
+
+        context_key = self._context_key(use_rag, rag_context, context_hashes, chat_history)
+        cache_embedding = self._cache_embedding(prompt)
+        cached = self._cached_response(provider, context_key, cache_embedding)
+        if cached is not None:
+            elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+            yield {'token': cached['response']}
+            yield dict(cached, done=True, ttft_ms=elapsed_ms, total_ms=elapsed_ms)
+            return
+
+        parts = []
+        ttft_ms = None
+        last_error = None
+        # Переключиться на другого провайдера можно только до первого токена
+        for provider in self._available_providers(provider):
+            health = self._health(provider)
+            try:
+                for delta in provider.stream(full_prompt, history=chat_history):
+                    if ttft_ms is None:
+                        ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                    parts.append(delta)
+                    yield {'token': delta}
+            except Exception as e:
+                if health is not None:
+                    health.record(ok=False)
+                if parts or self.routing_mode == 'single':
+                    logger.error(f"LLM streaming error: {e}")
+                    raise RuntimeError(f"Failed to generate response: {str(e)}")
+                logger.warning(f"LLM provider {provider.name} failed before first token, trying next: {e}")
+                last_error = e
+                continue
+            if health is not None:
+                health.record(ok=True)
+            break
+        else:
+            logger.error(f"LLM streaming error: {last_error}")
+            raise RuntimeError(f"Failed to generate response: {self._chain_error(last_error)}")
+
+        result = self._finish_response(provider, context_key, cache_embedding, ''.join(parts).strip())
+        yield dict(result, done=True, ttft_ms=ttft_ms, total_ms=round((time.perf_counter() - started) * 1000, 1))
+
+    # === МАРШРУТИЗАЦИЯ: FALLBACK / HEDGED / CIRCUIT BREAKER ===
+    def _health(self, provider):
+        if self.routing_mode == 'single':
+            return None
+        return get_provider_health(provider.name, self.config)
+
+    def _available_providers(self, primary) -> Iterator:
+        """
+        Провайдеры для запроса по порядку: выбранная модель, затем LLM_FALLBACK_CHAIN.
+        Провайдер с открытым circuit breaker пропускается. Генератор ленивый: breaker
+        спрашивается только тогда, когда до провайдера действительно дошла очередь.
+        """
+        if self.routing_mode == 'single':
+            yield primary
+            return
+        for name in [primary.name] + [name for name in self.fallback_chain if name != primary.name]:
+            provider = self.providers[name]
+            if self._health(provider).breaker.allow_request():
+                yield provider
+            else:
+                logger.info(f"LLM provider {name} skipped: circuit open")
+
+    @staticmethod
+    def _chain_error(last_error) -> str:
+        return str(last_error) if last_error is not None else "all providers unavailable (circuit open)"
+
+    def _hedge_delay(self, provider) -> float:
+        """Сколько ждать провайдера, прежде чем дублировать запрос: его p95 (или значение по умолчанию)."""
+        delay = self._health(provider).latency.percentile(self.config.get('LLM_HEDGE_PERCENTILE', 95))
+        if delay is None:
+            delay = self.config.get('LLM_HEDGE_DELAY_SEC', 3.0)
+        return max(delay, self.config.get('LLM_HEDGE_MIN_DELAY_SEC', 0.2))
+
+    def _timed_generate(self, provider, full_prompt: str, chat_history: list = None) -> str:
+        health = self._health(provider)
+        started = time.perf_counter()
+        try:
+            response_text = provider.generate(full_prompt, history=chat_history)
+        except Exception:
+            if health is not None and time.perf_counter() - started <= health.timeout:
+                health.record(ok=False)
+            raise
+        elapsed = time.perf_counter() - started
+        # Попытку, не уложившуюся в таймаут провайдера, _generate_routed уже засчитал как ошибку
+        if health is not None and elapsed <= health.timeout:
+            health.record(ok=True, elapsed=elapsed)
+        return response_text
+
+    def _generate_routed(self, primary, full_prompt: str, chat_history: list = None):
+        """
+        Возвращает (провайдер, который ответил, текст ответа). При fallback / hedged каждая
+        попытка идёт в пуле потоков и ограничена таймаутом своего провайдера целиком: не
+        ответивший вовремя провайдер считается упавшим, и запрос уходит следующему.
+        """
+        if self.routing_mode == 'single':
+            return primary, self._timed_generate(primary, full_prompt, chat_history)
+
+        candidates = self._available_providers(primary)
+        hedged = self.routing_mode == 'hedged'
+        executor = get_hedge_executor(self.config)
+        pending = {}    # future -> (провайдер, дедлайн попытки по time.monotonic())
+        last_error = None
+        waiting_on = None
+
+        def launch():
+            provider = next(candidates, None)
+            if provider is not None:
+                future = executor.submit(self._timed_generate, provider, full_prompt, chat_history)
+                pending[future] = (provider, time.monotonic() + self._health(provider).timeout)
+            return provider
+
+        waiting_on = launch()
+        while pending:
+            timeout = max(min(deadline for _, deadline in pending.values()) - time.monotonic(), 0)
+            if hedged and waiting_on:
+                # Пока есть кого подключить, ждём последнего запущенного не дольше его p95
+                timeout = min(timeout, self._hedge_delay(waiting_on))
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                provider, _ = pending.pop(future)
+                try:
+                    # Проигравшие запросы не отменить — они доработают в фоне и попадут в статистику
+                    return provider, future.result()
+                except Exception as e:
+                    logger.warning(f"LLM provider {provider.name} failed: {e}")
+                    last_error = e
+
+            now = time.monotonic()
+            expired = [future for future, (_, deadline) in pending.items() if deadline <= now]
+            for future in expired:
+                # Поток не прервать: ответ после дедлайна просто никто не ждёт
+                provider, _ = pending.pop(future)
+                health = self._health(provider)
+                health.record(ok=False)
+                logger.warning(f"LLM provider {provider.name} timed out after {health.timeout}s")
+                last_error = TimeoutError(f"{provider.name} did not answer within {health.timeout}s")
+
+            if not pending:
+                waiting_on = launch()
+            elif hedged and not done and not expired:
+                hedged_from = waiting_on
+                waiting_on = launch()
+                if waiting_on is not None:
+                    self._health(hedged_from).hedges += 1
+                    logger.info(f"LLM hedge: {hedged_from.name} is slow, also asking {waiting_on.name}")
+        raise RuntimeError(self._chain_error(last_error))
+
+    async def _atimed_generate(self, provider, full_prompt: str, chat_history: list = None) -> str:
+        health = self._health(provider)
+        started = time.perf_counter()
+        try:
+            if health is None:
+                return await provider.agenerate(full_prompt, history=chat_history)
+            response_text = await asyncio.wait_for(provider.agenerate(full_prompt, history=chat_history),
+                                                   timeout=health.timeout)
+        except asyncio.CancelledError:
+            # Проигравший hedged-запрос — это не ошибка провайдера
+            raise
+        except Exception:
+            if health is not None:
+                health.record(ok=False)
+            raise
+        health.record(ok=True, elapsed=time.perf_counter() - started)
+        return response_text
+
+    async def _agenerate_routed(self, primary, full_prompt: str, chat_history: list = None):
+        """Асинхронный _generate_routed: параллельные запросы — задачи asyncio, проигравшие отменяются."""
+        candidates = self._available_providers(primary)
+        hedged = self.routing_mode == 'hedged'
+        pending = {}
+        last_error = None
+        waiting_on = None
+
+        def launch():
+            provider = next(candidates, None)
+            if provider is not None:
+                pending[asyncio.ensure_future(self._atimed_generate(provider, full_prompt, chat_history))] = provider
+            return provider
+
+        waiting_on = launch()
+        try:
+            while pending:
+                timeout = self._hedge_delay(waiting_on) if hedged and waiting_on else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged_from = waiting_on
+                    waiting_on = launch()
+                    if waiting_on is not None:
+                        self._health(hedged_from).hedges += 1
+                        logger.info(f"LLM hedge: {hedged_from.name} is slow, also asking {waiting_on.name}")
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    try:
+                        return provider, task.result()
+                    except Exception as e:
+                        if self.routing_mode == 'single':
+                            raise
+                        logger.warning(f"LLM provider {provider.name} failed: {e}")
+                        last_error = e
+                if not pending:
+                    waiting_on = launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise RuntimeError(self._chain_error(last_error))
+
+    # === СУММАРИЗАЦИЯ ИСТОРИИ ===
+    def summarize(self, previous_summary: str, turns: list, model: str = None) -> str:
+        """Сворачивает вытесненные из памяти реплики (и прошлое summary) в краткое содержание."""
+        provider = self.get_provider(model)
+        return provider.generate(format_summary_request(previous_summary, turns), temperature=0.3, max_tokens=300)
+
+    async def asummarize(self, previous_summary: str, turns: list, model: str = None) -> str:
+        provider = self.get_provider(model)
+        return await provider.agenerate(format_summary_request(previous_summary, turns), temperature=0.3, max_tokens=300)
+
+    def _context_key(self, use_rag: bool, rag_context: str, context_hashes: list = None, chat_history: list = None):
+        """
+        Ключ контекста: набор хешей содержимого чанков (а если их не передали — хеш текста
+        контекста) и хеш последних cache_history_messages реплик. Хеши содержимого, в отличие
+        от id векторов, не меняются при переиндексации и не переходят к другому тексту.
+        Ответ, зависящий от истории диалога, достаётся только при той же недавней истории.
+        """
+        if not use_rag or not rag_context.strip():
+            context = ()
+        elif context_hashes is not None:
+            context = tuple(sorted(context_hashes))
+        else:
+            context = hashlib.sha256(rag_context.encode('utf-8')).hexdigest()
+        if not chat_history:
+            return context
+        digest = hashlib.sha256()
+        for message in chat_history[-self.cache_history_messages:]:
+            digest.update(f"{message['role']}\0{message['content']}\0".encode('utf-8'))
+        return context, digest.hexdigest()
+
     def get_available_models(self) -> list:
         models = []
         if 'yandex_gpt' in self.providers:
@@ -0,0 +1,178 @@
+# app/services/llm_routing.py
+"""
+Отказоустойчивый вызов нескольких LLM-провайдеров.
+
+- fallback — провайдеры пробуются по цепочке: если первый упал или не уложился
+  в свой таймаут, запрос уходит следующему, а не пользователю в виде 500;
+- hedged — если первый провайдер не ответил за задержку, равную его p95 латентности,
+  параллельно запускается следующий, и берётся ответ, пришедший первым. Хвост
+  латентности срезается ценой небольшой доли дублированных запросов;
+- circuit breaker — провайдер, упавший N раз подряд, исключается из цепочки на
+  LLM_CIRCUIT_RESET_SEC, потом пропускается один пробный запрос.
+
+Состояние (латентности, breaker'ы) общее для процесса, как и сами провайдеры.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ROUTING_MODES = ('single', 'fallback', 'hedged')
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.total_failures = 0
+        self.rejected = 0
+        # Время запуска пробного запроса в half_open; если его отменили и он ничего
+        # не записал, через reset_timeout пропускаем новый
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            # В half_open пропускаем один пробный запрос, остальные — мимо провайдера
+            if self.state == self.HALF_OPEN:
+                now = time.monotonic()
+                if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                    self._probe_started = now
+                    return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit closed after successful probe")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            self._probe_started = None
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def get_stats(self) -> Dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'total_failures': self.total_failures,
+            'rejected': self.rejected,
+        }
+
+
+class LatencyWindow:
+    """Скользящее окно последних латентностей успешных ответов."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self._samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """None, пока замеров меньше min_samples — оценке p95 по паре точек верить нельзя."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            return float(np.percentile(np.fromiter(self._samples, dtype=np.float64), q))
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class ProviderHealth:
+    def __init__(self, name: str, timeout: float, breaker: CircuitBreaker, latency: LatencyWindow):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = breaker
+        self.latency = latency
+        self.hedges = 0
+
+    def record(self, ok: bool, elapsed: float = None):
+        """elapsed — латентность полного ответа; для потоковых ответов не передаётся."""
+        if ok:
+            if elapsed is not None:
+                self.latency.add(elapsed)
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def get_stats(self) -> Dict:
+        p50 = self.latency.percentile(50)
+        p95 = self.latency.percentile(95)
+        return dict(
+            self.breaker.get_stats(),
+            timeout_sec=self.timeout,
+            samples=len(self.latency),
+            p50_ms=round(p50 * 1000, 1) if p50 is not None else None,
+            p95_ms=round(p95 * 1000, 1) if p95 is not None else None,
+            hedges_started=self.hedges,
+        )
+
+
+# === СОСТОЯНИЕ ПРОВАЙДЕРОВ (одно на процесс) ===
+_health: Dict[str, ProviderHealth] = {}
+_health_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_provider_health(name: str, config) -> ProviderHealth:
+    health = _health.get(name)
+    if health is None:
+        with _health_lock:
+            health = _health.get(name)
+            if health is None:
+                timeouts = config.get('LLM_PROVIDER_TIMEOUTS') or {}
+                health = ProviderHealth(
+                    name,
+                    timeout=timeouts.get(name, config.get('LLM_HTTP_TIMEOUT', 120)),
+                    breaker=CircuitBreaker(
+                        failure_threshold=config.get('LLM_CIRCUIT_FAILURES', 5),
+                        reset_timeout=config.get('LLM_CIRCUIT_RESET_SEC', 30)
+                    ),
+                    latency=LatencyWindow(size=config.get('LLM_LATENCY_WINDOW', 200))
+                )
+                _health[name] = health
+    return health
+
+
+def get_hedge_executor(config) -> ThreadPoolExecutor:
+    """Потоки для синхронных попыток fallback / hedged из веб-роутов (с дедлайном на попытку)."""
+    global _executor
+    if _executor is None:
+        with _health_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=config.get('LLM_HEDGE_WORKERS', 32),
+                    thread_name_prefix='llm-hedge'
+                )
+    return _executor
@@ -1,95 +1,382 @@
 # app/services/rag_engine.py
-import os
-import mimetypes
-from pathlib import Path
-from typing import List, Dict, Tuple
-from sentence_transformers import SentenceTransformer
-from PyPDF2 import PdfReader
-from docx import Document as DocxDocument
+from typing import List, Dict, Iterable, Iterator, Tuple
 from app.services.vector_db import VectorDB
+from app.services.embedding_service import build_embedding_service
+from app.services.embedding_batcher import PRIORITY_BULK
+from app.services.cache import LRUCache
+from app.services.chunking import CharChunker, build_chunker
+from app.services.content_hash import hash_chunk
+from app.services.document_parser import (iter_segments, iter_parsed_chunks, submit_parsing, get_parse_pool,
+                                          stop_parsing)
+
+
+def build_rag_engine(config) -> "RAGEngine":
+    """Создаёт VectorDB + RAGEngine поверх общей для процесса модели эмбеддингов."""
+    embedding_service = build_embedding_service(config)
+    vector_db = VectorDB(
+        index_path=config['FAISS_INDEX_PATH'],
+        embedding_model_name=config['EMBEDDING_MODEL'],
+        embedding_service=embedding_service,
+        index_type=config.get('FAISS_INDEX_TYPE', 'flat'),
+        promote_threshold=config.get('FAISS_PROMOTE_THRESHOLD', 50000),
+        nlist=config.get('FAISS_NLIST'),
+        nprobe=config.get('FAISS_NPROBE', 16),
+        hnsw_m=config.get('FAISS_HNSW_M', 32),
+        ef_search=config.get('FAISS_EF_SEARCH', 64),
+        pq_m=config.get('FAISS_PQ_M', 16),
+        metric=config.get('FAISS_METRIC', 'ip'),
+        compaction_ratio=config.get('FAISS_COMPACTION_RATIO', 0.2),
+        checkpoint_wal_bytes=config.get('FAISS_CHECKPOINT_WAL_MB', 64) * 1024 * 1024,
+        checkpoint_interval=config.get('FAISS_CHECKPOINT_INTERVAL_SEC', 300),
+        use_mmap=config.get('FAISS_MMAP', True),
+        filter_exact_max=config.get('FAISS_FILTER_EXACT_MAX', 4096)
+    )
+    vector_db.initialize_index()
+    return RAGEngine(
+        vector_db=vector_db,
+        embedding_model_name=config['EMBEDDING_MODEL'],
+        chunk_size=config['CHUNK_SIZE'],
+        chunk_overlap=config['CHUNK_OVERLAP'],
+        chunker=build_chunker(config),
+        min_score=config.get('RAG_MIN_SCORE'),
+        relative_score=config.get('RAG_RELATIVE_SCORE'),
+        query_cache_size=config.get('QUERY_CACHE_SIZE', 1024),
+        query_cache_ttl=config.get('QUERY_CACHE_TTL_SEC', 3600),
+        retrieval_cache_size=config.get('RETRIEVAL_CACHE_SIZE', 1024),
+        retrieval_cache_ttl=config.get('RETRIEVAL_CACHE_TTL_SEC', 600),
+        index_batch_size=config.get('INGESTION_CHUNK_BATCH', 256),
+        parse_workers=config.get('PARSE_WORKERS', 0),
+        parse_pages_per_task=config.get('PARSE_PAGES_PER_TASK', 32),
+        lexical_weight=config.get('RAG_LEXICAL_WEIGHT', 0.0),
+        lexical_min_score=config.get('RAG_LEXICAL_MIN_SCORE', 0.0),
+        rrf_k=config.get('RAG_RRF_K', 60),
+        hybrid_candidates=config.get('RAG_HYBRID_CANDIDATES', 20)
+    )
+
 
 class RAGEngine:
-    def __init__(self, vector_db, embedding_model_name, chunk_size, chunk_overlap):
-        # Убедимся, что модель загружена локально
-        self.embedding_model = SentenceTransformer(embedding_model_name, cache_folder=os.path.expanduser("~/.cache/sentence_transformers"))
+    def __init__(self, vector_db, embedding_model_name, chunk_size, chunk_overlap, chunker=None,
+                 min_score: float = None, relative_score: float = None,
+                 query_cache_size: int = 1024, query_cache_ttl: float = 3600,
+                 retrieval_cache_size: int = 1024, retrieval_cache_ttl: float = 600,
+                 index_batch_size: int = 256, parse_workers: int = 0, parse_pages_per_task: int = 32,
+                 lexical_weight: float = 0.0, lexical_min_score: float = 0.0, rrf_k: int = 60,
+                 hybrid_candidates: int = 20):
+        # Используем ту же модель, что и VectorDB (одна копия весов на процесс)
+        self.embedding_service = vector_db.embedding_service
         self.vector_db = vector_db
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        # Стратегия нарезки (app/services/chunking.py); по умолчанию — окно chunk_size символов
+        self.chunker = chunker or CharChunker(chunk_size, chunk_overlap)
+        # Сколько чанков копится перед эмбеддингом и записью в индекс при индексации
+        self.index_batch_size = max(1, index_batch_size)
+        # Процессы для разбора PDF/DOCX (0 — разбор в потоке индексации)
+        self.parse_workers = parse_workers
+        self.parse_pages_per_task = max(1, parse_pages_per_task)
+        # Отсечка по косинусной близости: нерелевантные чанки не попадают в промпт
+        self.min_score = min_score
+        # Адаптивный k: берём только хиты не хуже relative_score * лучший скор
+        self.relative_score = relative_score
+        # Гибридный поиск: доля BM25 в reciprocal rank fusion с FAISS (0 — только векторный поиск).
+        # Из каждого поиска берётся не меньше hybrid_candidates кандидатов, после слияния — top-k
+        self.lexical_weight = min(max(lexical_weight or 0.0, 0.0), 1.0)
+        # Минимальный BM25: совпадение по одному частому слову даёт скор около нуля
+        self.lexical_min_score = lexical_min_score or 0.0
+        self.rrf_k = rrf_k
+        self.hybrid_candidates = hybrid_candidates
+
+        # === КЭШИ ДЛЯ ПОВТОРЯЮЩИХСЯ ЗАПРОСОВ ===
+        # Эмбеддинг зависит только от текста запроса — индекс на него не влияет
+        self.query_cache = LRUCache(query_cache_size, query_cache_ttl)
+        # Результаты поиска привязаны к поколению индекса: добавление/удаление документов
+        # меняет vector_db.generation, и старые записи больше не совпадают по ключу
+        self.retrieval_cache = LRUCache(retrieval_cache_size, retrieval_cache_ttl)
+        self._cache_generation = vector_db.generation
 
-    def _read_text_from_file(self, file_path: str) -> str:
-        mime_type, _ = mimetypes.guess_type(file_path)
-        text = ""
-
-        if mime_type == 'application/pdf':
-            reader = PdfReader(file_path)
-            for page in reader.pages:
-                extracted = page.extract_text()
-                if extracted:
-                    text += extracted
-        elif mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-            doc = DocxDocument(file_path)
-            text = "\n".join([para.text for para in doc.paragraphs if para.text.strip()])
-        elif mime_type == 'text/plain' or file_path.endswith('.txt'):
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                text = f.read()
+    def process_document(self, text: str) -> Tuple[List[str], List[Dict]]:
+        """Режет готовую строку на чанки (для файлов используется iter_document_chunks)."""
+        chunks, metadata = [], []
+        for chunk, meta in self.chunker([(None, text)]):
+            chunks.append(chunk)
+            metadata.append(meta)
+        return chunks, metadata
+
+    def iter_document_chunks(self, file_path: str, doc_id: int, parsing: List = None) -> Iterator[Tuple[str, Dict]]:
+        """
+        Отдаёт чанки документа по одному, не собирая весь текст. parsing — задачи разбора
+        в пуле процессов (submit_parsing); без них файл читается потоком в этом же потоке.
+        """
+        if parsing is not None:
+            chunks = iter_parsed_chunks(parsing)
         else:
-            raise ValueError(f"Unsupported file type: {mime_type}")
+            chunks = self.chunker(iter_segments(file_path))
+        for chunk_no, (chunk, meta) in enumerate(chunks):
+            # doc_id и номер чанка — из них VectorDB строит стабильный id вектора
+            meta["doc_id"] = doc_id
+            meta["chunk_no"] = chunk_no
+            # По хэшу текста чанк, который уже есть в индексе, не эмбеддится повторно
+            meta["content_hash"] = hash_chunk(chunk)
+            yield chunk, meta
 
-        return text.strip()
+    def add_documents(self, documents: List[Tuple[str, int]]) -> Dict[int, Dict]:
+        """
+        Индексирует несколько документов потоком: чанки всех документов копятся в батч
+        по index_batch_size, каждый батч — один проход модели эмбеддингов и одна запись
+        в индекс. Память ограничена размером батча, а не размером файлов.
+        Чанки, текст которых уже есть в индексе (в этом или другом документе, например
+        в прошлой версии файла), не эмбеддятся и не добавляют вектор — только ссылку.
+        Полный снимок индекса на диск пишется только периодически (см. VectorDB.maybe_checkpoint).
+        Возвращает {doc_id: {'success': bool, 'chunks': int, 'reused': int, 'error': str|None}},
+        reused — сколько чанков обошлись без эмбеддинга.
+        """
+        from flask import current_app
 
-    def process_document(self, text: str) -> Tuple[List[str], List[Dict]]:
-        chunks = []
-        metadata = []
-
-        start = 0
-        chunk_id = 0
-        while start < len(text):
-            end = start + self.chunk_size
-            if end < len(text):
-                space_pos = text.rfind(' ', start, end)
-                if space_pos != -1 and space_pos > start:
-                    end = space_pos
-            chunk = text[start:end].strip()
-            if chunk:
-                chunks.append(chunk)
-                metadata.append({
-                    "chunk_id": f"chunk_{chunk_id}",
-                    "text": chunk,  # ← сохраняем текст чанка!
-                    "start_char": start,
-                    "end_char": end,
-                })
-                chunk_id += 1
-            start = end - self.chunk_overlap if end - self.chunk_overlap > start else end
+        counts = {}
+        reused = {}
+        errors = {}
+        written = set()      # документы, часть векторов которых уже в индексе
+        batch_chunks, batch_metadata = [], []
 
-        return chunks, metadata
+        def flush():
+            if not batch_chunks:
+                return
+            batch_docs = {meta['doc_id'] for meta in batch_metadata}
+            try:
+                # Эмбеддим только первое вхождение каждого текста, которого ещё нет в индексе
+                known = self.vector_db.find_chunks(meta['content_hash'] for meta in batch_metadata)
+                fresh, seen = [], set(known)
+                for i, meta in enumerate(batch_metadata):
+                    if meta['content_hash'] not in seen:
+                        seen.add(meta['content_hash'])
+                        fresh.append(i)
+                embeddings = (self.embedding_service.encode([batch_chunks[i] for i in fresh], priority=PRIORITY_BULK)
+                              if fresh else [])
+
+                # Единственный писатель живого индекса: запись в журнал и индекс под одной блокировкой
+                with self.vector_db.lock:
+                    # Пока шёл эмбеддинг, тот же текст мог добавить другой воркер индексации
+                    added = self.vector_db.find_chunks(batch_metadata[i]['content_hash'] for i in fresh)
+                    keep = [n for n, i in enumerate(fresh) if batch_metadata[i]['content_hash'] not in added]
+                    if keep:
+                        self.vector_db.add_embeddings([embeddings[n] for n in keep],
+                                                      [batch_metadata[fresh[n]] for n in keep])
+                    new = {fresh[n] for n in keep}
+                    refs = [meta for i, meta in enumerate(batch_metadata) if i not in new]
+                    if refs:
+                        self.vector_db.add_chunk_refs(refs)
+                for meta in refs:
+                    reused[meta['doc_id']] = reused.get(meta['doc_id'], 0) + 1
+                written.update(batch_docs)
+            except Exception as e:
+                current_app.logger.error(f"Error in add_documents (doc_ids={sorted(batch_docs)}): {e}")
+                for doc_id in batch_docs:
+                    errors.setdefault(doc_id, str(e))
+            batch_chunks.clear()
+            batch_metadata.clear()
+
+        # Разбор PDF/DOCX всех документов пачки сразу уходит в пул процессов и идёт
+        # параллельно, пока здесь эмбеддятся чанки уже разобранных документов
+        parsing = {}
+        pool = get_parse_pool(self.parse_workers)
+        if pool is not None:
+            for file_path, doc_id in documents:
+                try:
+                    parsing[doc_id] = submit_parsing(pool, file_path, self.chunker, self.parse_pages_per_task)
+                except Exception as e:
+                    current_app.logger.error(f"Error in add_documents (doc_id={doc_id}): {e}")
+                    errors[doc_id] = str(e)
 
-    def add_document(self, file_path: str, doc_id: int) -> bool:
         try:
-            text = self._read_text_from_file(file_path)
-            if not text:
-                return False
-
-            chunks, metadata_list = self.process_document(text)
-
-            # Добавляем doc_id в каждую запись
-            for meta in metadata_list:
-                meta["doc_id"] = doc_id
-
-            embeddings = self.embedding_model.encode(chunks, show_progress_bar=False).tolist()
-            self.vector_db.add_embeddings(embeddings, metadata_list)
-            self.vector_db.save_index()
-            return True
-        except Exception as e:
-            from flask import current_app
-            current_app.logger.error(f"Error in add_document (doc_id={doc_id}): {e}")
-            return False
-
-    def search_similar(self, query: str, k: int = 3) -> List[Dict]:
-        query_embedding = self.embedding_model.encode(query).tolist()
-        _, metadata_list = self.vector_db.search_vectors(query_embedding, k=k)
-        return metadata_list
-
-    def augment_prompt(self, query: str, k: int = 3) -> str:
-        similar_chunks = self.search_similar(query, k=k)
-        context_parts = [item["text"] for item in similar_chunks if "text" in item]
-        return "\n\n".join(context_parts) if context_parts else ""
\ No newline at end of file
+            for file_path, doc_id in documents:
+                counts[doc_id] = 0
+                reused[doc_id] = 0
+                if doc_id in errors:
+                    continue
+                try:
+                    for chunk, meta in self.iter_document_chunks(file_path, doc_id, parsing.get(doc_id)):
+                        if doc_id in errors:
+                            break
+                        batch_chunks.append(chunk)
+                        batch_metadata.append(meta)
+                        counts[doc_id] += 1
+                        if len(batch_chunks) >= self.index_batch_size:
+                            flush()
+                except Exception as e:
+                    current_app.logger.error(f"Error in add_documents (doc_id={doc_id}): {e}")
+                    errors[doc_id] = str(e)
+                    # Уже накопленные чанки этого документа в индекс не пойдут
+                    kept = [(chunk, meta) for chunk, meta in zip(batch_chunks, batch_metadata)
+                            if meta['doc_id'] != doc_id]
+                    batch_chunks[:] = [chunk for chunk, _ in kept]
+                    batch_metadata[:] = [meta for _, meta in kept]
+            flush()
+        finally:
+            # Разбор документов, до которых дело не дошло или которые бросили на середине,
+            # останавливаем: воркер пула иначе ждёт, пока кто-то прочитает его очередь
+            for tasks in parsing.values():
+                stop_parsing(tasks)
+
+        self.vector_db.maybe_checkpoint()
+
+        results = {}
+        for _, doc_id in documents:
+            if doc_id in errors:
+                # Документ проиндексирован частично — убираем то, что успели записать
+                if doc_id in written:
+                    self.delete_document(doc_id)
+                results[doc_id] = {'success': False, 'chunks': 0, 'reused': 0, 'error': errors[doc_id]}
+            elif not counts[doc_id]:
+                results[doc_id] = {'success': False, 'chunks': 0, 'reused': 0, 'error': 'Empty document'}
+            else:
+                results[doc_id] = {'success': True, 'chunks': counts[doc_id], 'reused': reused[doc_id], 'error': None}
+        return results
+
+    def add_document(self, file_path: str, doc_id: int) -> bool:
+        return self.add_documents([(file_path, doc_id)])[doc_id]['success']
+
+    def delete_document(self, doc_id: int) -> int:
+        """Удаляет векторы документа из индекса; при необходимости запускает компактизацию в фоне."""
+        removed = self.vector_db.delete_document(doc_id)
+        # Снимок пишется вне блокировки индекса — поиск в это время не ждёт
+        self.vector_db.maybe_checkpoint()
+        self.vector_db.maybe_compact_async()
+        return removed
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Ключ кэша: регистр и пробелы не влияют на эмбеддинг (MiniLM — uncased)."""
+        return ' '.join(query.split()).casefold()
+
+    def _encode_queries(self, queries: List[str]):
+        """Эмбеддинги нормализованных запросов; модель вызывается только для промахов кэша."""
+        embeddings = [self.query_cache.get(query) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = self.embedding_service.encode([queries[i] for i in missing])
+            for i, embedding in zip(missing, encoded):
+                self.query_cache.set(queries[i], embedding)
+                embeddings[i] = embedding
+        return embeddings
+
+    def _retrieval_key(self, query: str, k: int, min_score: float, doc_ids: frozenset = None) -> tuple:
+        vector_db = self.vector_db
+        generation = vector_db.generation
+        if generation != self._cache_generation:
+            # Индекс изменился — записи старого поколения уже не найдутся, освобождаем память
+            self.retrieval_cache.clear()
+            self._cache_generation = generation
+        return (query, k, min_score, generation, vector_db.nprobe, vector_db.ef_search, self.lexical_weight,
+                doc_ids)
+
+    def search_similar(self, query: str, k: int = 3, min_score: float = None,
+                       doc_ids: Iterable[int] = None) -> List[Dict]:
+        """
+        Возвращает до k чанков с полем 'score' по убыванию: косинусная близость или, в
+        гибридном режиме, скор слияния (см. fuse_hits). Векторные хиты ниже min_score
+        (по умолчанию self.min_score) отбрасываются. doc_ids — искать только в этих
+        документах (None — по всему индексу).
+        """
+        return self.search_similar_batch([query], k=k, min_score=min_score, doc_ids=doc_ids)[0]
+
+    def search_similar_batch(self, queries: List[str], k: int = 3, min_score: float = None,
+                             doc_ids: Iterable[int] = None) -> List[List[Dict]]:
+        """
+        Пакетный вариант search_similar: все запросы кодируются одним проходом модели
+        и ищутся одним вызовом FAISS. Возвращает список хитов на каждый запрос.
+        Повторные запросы отдаются из кэша результатов поиска.
+        Фильтр doc_ids применяется внутри FAISS и BM25, а не после поиска.
+        """
+        if not queries:
+            return []
+        min_score = self.min_score if min_score is None else min_score
+        doc_ids = frozenset(int(doc_id) for doc_id in doc_ids) if doc_ids is not None else None
+        queries = [self.normalize_query(query) for query in queries]
+        keys = [self._retrieval_key(query, k, min_score, doc_ids) for query in queries]
+
+        results = [self.retrieval_cache.get(key) for key in keys]
+        missing = [i for i, hits in enumerate(results) if hits is None]
+        if missing:
+            hybrid = self.lexical_weight > 0
+            candidates = max(k, self.hybrid_candidates) if hybrid else k
+            vector_ids = self.vector_db.scope_vector_ids(doc_ids) if doc_ids is not None else None
+            query_embeddings = self._encode_queries([queries[i] for i in missing])
+            found = self.vector_db.search_vectors_batch(query_embeddings, k=candidates, min_score=min_score,
+                                                        vector_ids=vector_ids)
+            lexical = (self.vector_db.search_lexical_batch([queries[i] for i in missing], k=candidates,
+                                                           vector_ids=vector_ids)
+                       if hybrid else [None] * len(missing))
+            for i, (scores, metadata_list), lexical_hits in zip(missing, found, lexical):
+                hits = [dict(meta, score=score) for score, meta in zip(scores, metadata_list)]
+                if hybrid:
+                    hits = self.fuse_hits(hits, lexical_hits, k)
+                results[i] = tuple(hits)
+                self.retrieval_cache.set(keys[i], results[i])
+
+        # Копии: вызывающий код не должен менять закэшированные словари
+        return [[dict(hit) for hit in hits] for hits in results]
+
+    def fuse_hits(self, dense_hits: List[Dict], lexical_hits: Tuple[List[float], List[Dict]], k: int) -> List[Dict]:
+        """
+        Reciprocal rank fusion векторных и BM25-хитов: вклад хита — вес / (rrf_k + ранг),
+        вес BM25 — lexical_weight, векторного поиска — 1 - lexical_weight. 'score' нормирован
+        так, что первое место в обоих списках даёт 1.0; исходные скоры — в 'dense_score'
+        (косинус) и 'lexical_score' (BM25), None — если хит не нашёлся этим поиском.
+
+        Отсечки применяются к каждому списку до слияния (min_score векторных хитов — уже в
+        FAISS): скор слияния зависит только от рангов, и хит, найденный одним BM25, по нему
+        не отличить от шума. Шум при этом не занимает места в top-k.
+        """
+        dense_hits = self._cut_relative(dense_hits, [hit['score'] for hit in dense_hits])
+        lexical = [(score, meta) for score, meta in zip(*lexical_hits) if score >= self.lexical_min_score]
+        lexical = self._cut_relative(lexical, [score for score, _ in lexical])
+
+        fused = {}
+        for rank, hit in enumerate(dense_hits, 1):
+            entry = fused.setdefault(hit['vector_id'],
+                                     dict(hit, dense_score=hit['score'], lexical_score=None, score=0.0))
+            entry['score'] += (1.0 - self.lexical_weight) / (self.rrf_k + rank)
+        for rank, (score, meta) in enumerate(lexical, 1):
+            entry = fused.setdefault(meta['vector_id'],
+                                     dict(meta, dense_score=None, score=0.0))
+            entry['lexical_score'] = score
+            entry['score'] += self.lexical_weight / (self.rrf_k + rank)
+        for entry in fused.values():
+            entry['score'] *= self.rrf_k + 1
+        return sorted(fused.values(), key=lambda hit: hit['score'], reverse=True)[:k]
+
+    def get_cache_stats(self) -> Dict:
+        return {
+            'query_embeddings': self.query_cache.get_stats(),
+            'retrieval': self.retrieval_cache.get_stats(),
+        }
+
+    def _cut_relative(self, items: list, scores: List[float]) -> list:
+        """items, чей скор не хуже relative_score * лучший (scores — по убыванию, как items)."""
+        if not items or not self.relative_score:
+            return items
+        cutoff = scores[0] * self.relative_score
+        return [item for item, score in zip(items, scores) if score >= cutoff]
+
+    def select_context(self, hits: List[Dict]) -> List[Dict]:
+        """
+        Адаптивный k: отрезает хвост, который заметно хуже лучшего хита. Гибридные хиты
+        уже отсечены по каждому поиску в fuse_hits — скор слияния для этого не годится.
+        """
+        if hits and 'lexical_score' in hits[0]:
+            return hits
+        return self._cut_relative(hits, [hit['score'] for hit in hits])
+
+    def build_context(self, query: str, k: int = 3, min_score: float = None,
+                      doc_ids: Iterable[int] = None) -> Tuple[str, List[str]]:
+        """
+        Контекст для промпта и хеши содержимого чанков, из которых он собран (ключ кэша
+        ответов LLMManager); doc_ids — область поиска.
+        """
+        hits = self.search_similar(query, k=k, min_score=min_score, doc_ids=doc_ids)
+        similar_chunks = [item for item in self.select_context(hits) if "text" in item]
+        context = "\n\n".join(item["text"] for item in similar_chunks)
+        return context, [item.get('content_hash') or hash_chunk(item['text']) for item in similar_chunks]
+
+    def augment_prompt(self, query: str, k: int = 3, min_score: float = None, doc_ids: Iterable[int] = None) -> str:
+        return self.build_context(query, k=k, min_score=min_score, doc_ids=doc_ids)[0]
\ No newline at end of file
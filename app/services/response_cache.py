@@ -0,0 +1,143 @@
+# app/services/response_cache.py
+"""
+Семантический кэш ответов LLM.
+
+Запрос к Yandex GPT / Ollama стоит 1–10 с и денег, а пользователи веб-чата и
+бота часто задают почти одинаковые вопросы. Ответ берётся из кэша, если для той
+же модели и того же набора найденных чанков уже есть вопрос с косинусной
+близостью не ниже порога. Кэш общий для процесса, ограничен по размеру (LRU) и
+времени жизни записей, и сбрасывается целиком или для одной модели.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+from app.services.embedding_service import build_embedding_service
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticResponseCache:
+    def __init__(self, embedding_service, threshold: float = 0.95, max_size: int = 512,
+                 ttl: Optional[float] = 86400):
+        self.embedding_service = embedding_service
+        self.threshold = threshold
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        # entry_id -> (model, context_key, embedding, response, expires_at); порядок — LRU
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # (model, context_key) -> id записей: сравниваем вопрос только с ответами на том же контексте
+        self._groups: Dict[Tuple[str, Hashable], Dict[int, None]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def embed(self, prompt: str) -> np.ndarray:
+        return self._normalize(self.embedding_service.encode(' '.join(prompt.split())))
+
+    async def aembed(self, prompt: str) -> np.ndarray:
+        """embed для asyncio-кода: вопрос уходит в общий батч модели, event loop не блокируется."""
+        return self._normalize(await self.embedding_service.aencode(' '.join(prompt.split())))
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def lookup(self, model: str, context_key: Hashable, embedding: np.ndarray) -> Optional[Tuple[str, float]]:
+        """Возвращает (ответ, близость) самого похожего вопроса или None."""
+        now = time.monotonic()
+        with self._lock:
+            group = self._groups.get((model, context_key))
+            if group:
+                for entry_id in [entry_id for entry_id in group if self._entries[entry_id][4] <= now]:
+                    self._remove(entry_id)
+            if not group:
+                self.misses += 1
+                return None
+
+            entry_ids = list(group)
+            similarities = np.stack([self._entries[entry_id][2] for entry_id in entry_ids]) @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_ids[best])
+            self.hits += 1
+            return self._entries[entry_ids[best]][3], float(similarities[best])
+
+    def store(self, model: str, context_key: Hashable, embedding: np.ndarray, response: str):
+        expires_at = time.monotonic() + self.ttl if self.ttl else float('inf')
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (model, context_key, embedding, response, expires_at)
+            self._groups.setdefault((model, context_key), {})[entry_id] = None
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_id: int):
+        model, context_key, _, _, _ = self._entries.pop(entry_id)
+        group = self._groups[(model, context_key)]
+        del group[entry_id]
+        if not group:
+            del self._groups[(model, context_key)]
+
+    def invalidate(self, model: str = None) -> int:
+        """Удаляет ответы одной модели (или все) и возвращает число удалённых записей."""
+        with self._lock:
+            entry_ids = [entry_id for entry_id, entry in self._entries.items() if model is None or entry[0] == model]
+            for entry_id in entry_ids:
+                self._remove(entry_id)
+        if entry_ids:
+            logger.info(f"Response cache invalidated for {model or 'all models'}: {len(entry_ids)} entries")
+        return len(entry_ids)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            per_model: Dict[str, int] = {}
+            for entry in self._entries.values():
+                per_model[entry[0]] = per_model.get(entry[0], 0) + 1
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_sec': self.ttl,
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'entries_per_model': per_model,
+            }
+
+
+# === ОБЩИЙ КЭШ ПРОЦЕССА (веб-чат и бот) ===
+_cache: Optional[SemanticResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache(config) -> Optional[SemanticResponseCache]:
+    """Возвращает общий кэш ответов или None, если он выключен (RESPONSE_CACHE_ENABLED)."""
+    global _cache
+    if not config.get('RESPONSE_CACHE_ENABLED'):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticResponseCache(
+                    build_embedding_service(config),
+                    threshold=config.get('RESPONSE_CACHE_THRESHOLD', 0.95),
+                    max_size=config.get('RESPONSE_CACHE_SIZE', 512),
+                    ttl=config.get('RESPONSE_CACHE_TTL_SEC', 86400)
+                )
+    return _cache
@@ -0,0 +1,77 @@
+# app/services/search_scope.py
+"""
+Область поиска RAG: какие документы участвуют в выдаче.
+
+Фильтры запроса (doc_ids, uploaded_after / uploaded_before) и область документов
+сессии чата (ChatSession.document_scope) сводятся здесь к набору id документов.
+Дальше RAGEngine передаёт его в поиск: FAISS и BM25 просматривают только векторы
+этих документов, а не фильтруют глобальный top-k задним числом.
+"""
+
+import json
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+FILTER_KEYS = ('doc_ids', 'uploaded_after', 'uploaded_before')
+
+
+def parse_doc_ids(value) -> Optional[List[int]]:
+    """Список id документов из JSON; None — фильтра нет. ValueError, если формат неверный."""
+    if value is None:
+        return None
+    if not isinstance(value, list) or not all(isinstance(doc_id, int) and not isinstance(doc_id, bool)
+                                              for doc_id in value):
+        raise ValueError('doc_ids must be a list of document ids')
+    return value
+
+
+def _parse_datetime(name: str, value) -> Optional[datetime]:
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an ISO 8601 date or datetime')
+
+
+def parse_search_filters(data: Dict) -> Dict:
+    """
+    {"doc_ids": [1, 2], "uploaded_after": "2024-01-01", "uploaded_before": "2024-06-30T12:00"}
+    -> фильтры для resolve_document_scope. Отсутствующие ключи — None.
+    """
+    return {
+        'doc_ids': parse_doc_ids(data.get('doc_ids')),
+        'uploaded_after': _parse_datetime('uploaded_after', data.get('uploaded_after')),
+        'uploaded_before': _parse_datetime('uploaded_before', data.get('uploaded_before')),
+    }
+
+
+def load_session_scope(session) -> Optional[List[int]]:
+    return json.loads(session.document_scope) if session.document_scope else None
+
+
+def dump_session_scope(doc_ids: Optional[Iterable[int]]) -> Optional[str]:
+    return json.dumps(sorted(set(doc_ids))) if doc_ids is not None else None
+
+
+def resolve_document_scope(doc_ids: Iterable[int] = None, uploaded_after: datetime = None,
+                           uploaded_before: datetime = None) -> Optional[Set[int]]:
+    """
+    id проиндексированных документов, подходящих под все заданные условия.
+    None — ни одного условия нет, искать по всему индексу; пустое множество — искать негде.
+    """
+    from app.models import Document
+
+    if doc_ids is None and uploaded_after is None and uploaded_before is None:
+        return None
+    query = Document.query.with_entities(Document.id).filter(Document.processed.is_(True))
+    if doc_ids is not None:
+        doc_ids = list(set(doc_ids))
+        if not doc_ids:
+            return set()
+        query = query.filter(Document.id.in_(doc_ids))
+    if uploaded_after is not None:
+        query = query.filter(Document.uploaded_at >= uploaded_after)
+    if uploaded_before is not None:
+        query = query.filter(Document.uploaded_at <= uploaded_before)
+    return {row.id for row in query}
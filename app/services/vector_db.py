@@ -1,76 +1,835 @@
 # app/services/vector_db.py
 
 import os
+import time
 import pickle
+import logging
+import threading
 import numpy as np
+from contextlib import contextmanager
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
 import faiss
+from app.services.embedding_service import EmbeddingService, find_embedding_service
+from app.services.index_wal import WriteAheadLog, atomic_write
+from app.services.chunk_store import ChunkStore
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые типы индекса
+INDEX_FLAT = 'flat'
+INDEX_IVF_FLAT = 'ivf_flat'
+INDEX_HNSW = 'hnsw'
+INDEX_IVF_PQ = 'ivf_pq'
+INDEX_TYPES = (INDEX_FLAT, INDEX_IVF_FLAT, INDEX_HNSW, INDEX_IVF_PQ)
+
+# Метрики: ip — скалярное произведение нормированных векторов (= косинус), l2 — старый режим
+METRIC_IP = 'ip'
+METRIC_L2 = 'l2'
+FAISS_METRICS = {METRIC_IP: faiss.METRIC_INNER_PRODUCT, METRIC_L2: faiss.METRIC_L2}
+
+# Стабильный id вектора: старшие биты — doc_id, младшие CHUNK_ID_BITS — номер чанка.
+# Все векторы документа лежат в диапазоне [doc_id << CHUNK_ID_BITS, (doc_id + 1) << CHUNK_ID_BITS)
+CHUNK_ID_BITS = 20
+
+# Минимум обучающих векторов на один центроид (рекомендация FAISS)
+MIN_POINTS_PER_CENTROID = 39
+
+# IO_FLAG_MMAP отображает в память только инвертированные списки IVF. Коды flat и
+# хранилище HNSW отображаются с IO_FLAG_MMAP_IFC (FAISS >= 1.9); граф HNSW и таблица
+# id IndexIDMap2 в любом случае читаются в память процесса
+IO_FLAG_MMAP_IFC = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+
+
+def make_vector_id(doc_id: int, chunk_no: int) -> int:
+    if not 0 <= chunk_no < (1 << CHUNK_ID_BITS):
+        raise ValueError(f"chunk_no {chunk_no} does not fit into {CHUNK_ID_BITS} bits")
+    return (int(doc_id) << CHUNK_ID_BITS) | int(chunk_no)
+
+
+def doc_id_range(doc_id: int) -> tuple:
+    """Полуинтервал id векторов документа: [start, end)."""
+    return int(doc_id) << CHUNK_ID_BITS, (int(doc_id) + 1) << CHUNK_ID_BITS
+
+
+def default_nlist(n_vectors: int) -> int:
+    """Число кластеров IVF: ~4*sqrt(N), но не больше, чем позволяет обучающая выборка."""
+    nlist = int(4 * np.sqrt(max(n_vectors, 1)))
+    return max(1, min(nlist, n_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def create_faiss_index(index_type: str, dimension: int, n_vectors: int = 0, nlist: int = None,
+                       hnsw_m: int = 32, pq_m: int = 16, metric: str = METRIC_IP):
+    """Создаёт пустой индекс указанного типа (IVF-индексы ещё нужно обучить)."""
+    if metric not in FAISS_METRICS:
+        raise ValueError(f"Unknown metric '{metric}'. Available: {list(FAISS_METRICS)}")
+    faiss_metric = FAISS_METRICS[metric]
+    if index_type == INDEX_FLAT:
+        return faiss.IndexFlat(dimension, faiss_metric)
+    if index_type == INDEX_HNSW:
+        return faiss.IndexHNSWFlat(dimension, hnsw_m, faiss_metric)
+    if index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        nlist = nlist or default_nlist(n_vectors)
+        quantizer = faiss.IndexFlat(dimension, faiss_metric)
+        if index_type == INDEX_IVF_FLAT:
+            return faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss_metric)
+        if dimension % pq_m != 0:
+            raise ValueError(f"PQ: dimension {dimension} is not divisible by pq_m={pq_m}")
+        return faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, 8, faiss_metric)
+    raise ValueError(f"Unknown index type '{index_type}'. Available: {list(INDEX_TYPES)}")
+
+
+def mmap_read_flags(index_type: str = None) -> int:
+    """
+    Флаги read_index для снимка типа index_type. Вместе IO_FLAG_MMAP и IO_FLAG_MMAP_IFC
+    IVF не читается ("mmap only supported for File objects"), поэтому флаг выбирается
+    по типу. Тип неизвестен (снимок старой версии) — IO_FLAG_MMAP: его понимают все типы.
+    """
+    if index_type in (INDEX_FLAT, INDEX_HNSW) and IO_FLAG_MMAP_IFC:
+        return IO_FLAG_MMAP_IFC
+    return faiss.IO_FLAG_MMAP
+
+
+def base_index(index):
+    """Снимает обёртку IndexIDMap/IndexIDMap2 и возвращает внутренний индекс."""
+    while isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def supports_remove(index) -> bool:
+    """HNSW не умеет удалять векторы — для него используются tombstones и компактизация."""
+    return not isinstance(base_index(index), faiss.IndexHNSW)
+
+
+def apply_search_params(index, nprobe: int = None, ef_search: int = None):
+    """Выставляет параметры поиска (nprobe для IVF, efSearch для HNSW)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    hnsw = base_index(index)
+    if isinstance(hnsw, faiss.IndexHNSW) and ef_search:
+        hnsw.hnsw.efSearch = ef_search
+
+
+def get_index_metric(index) -> str:
+    return METRIC_IP if index.metric_type == faiss.METRIC_INNER_PRODUCT else METRIC_L2
+
+
+def get_index_type(index) -> str:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # try_extract_index_ivf возвращает базовый IndexIVF — подкласс виден только после downcast
+        return INDEX_IVF_PQ if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else INDEX_IVF_FLAT
+    if isinstance(base_index(index), faiss.IndexHNSW):
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+class ReadWriteLock:
+    """
+    Много читателей или один писатель. Писатель, ждущий блокировку, не пропускает
+    вперёд новых читателей — иначе поток поисков мог бы бесконечно откладывать запись.
+    Не реентерабельна.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
 
 class VectorDB:
-    def __init__(self, index_path: str, embedding_model_name: str):
+    def __init__(self, index_path: str, embedding_model_name: str, embedding_service: EmbeddingService = None,
+                 index_type: str = INDEX_FLAT, promote_threshold: int = 50000, nlist: int = None,
+                 nprobe: int = 16, hnsw_m: int = 32, ef_search: int = 64, pq_m: int = 16,
+                 metric: str = METRIC_IP, compaction_ratio: float = 0.2,
+                 checkpoint_wal_bytes: int = 64 * 1024 * 1024, checkpoint_interval: float = 300,
+                 use_mmap: bool = True, filter_exact_max: int = 4096):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type '{index_type}'. Available: {list(INDEX_TYPES)}")
+        if metric not in FAISS_METRICS:
+            raise ValueError(f"Unknown metric '{metric}'. Available: {list(FAISS_METRICS)}")
         self.index_path = index_path
         self.embedding_model_name = embedding_model_name
-        self.embedding_model = SentenceTransformer(embedding_model_name)
+        # Модель общая для процесса — здесь нужна только размерность векторов
+        self.embedding_service = embedding_service or find_embedding_service(embedding_model_name)
+        if self.embedding_service is None:
+            raise ValueError(f"Embedding service for '{embedding_model_name}' is not built: "
+                             f"call build_embedding_service(config) first")
         self.index = None
-        self.metadata = []  # список метаданных, синхронизированный с индексом FAISS
-        self.dimension = self.embedding_model.get_sentence_embedding_dimension()
+        # Текст и метаданные чанков — в SQLite, читаются по id только для найденных хитов
+        self.chunks = None
+        # lock — блокировка писателей: журнал, хранилище чанков, сборка нового индекса.
+        # Поиск её не берёт: сам объект индекса защищён index_lock, поиски идут параллельно
+        # под read(), а писатель берёт write() только на время изменения индекса в памяти
+        # (add / remove / подмена собранного индекса). Порядок захвата: lock, затем index_lock.
+        self.lock = threading.RLock()
+        self.index_lock = ReadWriteLock()
+        # Снимки пишутся по одному; файл пишется на диск вне lock и index_lock
+        self._checkpoint_lock = threading.Lock()
+        self.dimension = self.embedding_service.get_dimension()
+        # Растёт при каждом изменении индекса (добавление, удаление, перестройка)
+        self.generation = 0
+
+        # === Параметры ANN ===
+        # Индекс начинается как flat и переходит на index_type, когда ntotal >= promote_threshold
+        self.index_type = index_type
+        self.promote_threshold = promote_threshold
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.pq_m = pq_m
+        # Поиск с фильтром: область до filter_exact_max векторов ищется точно, без обхода индекса
+        self.filter_exact_max = filter_exact_max
+        # Метрика для новых индексов; уже сохранённый индекс сохраняет свою
+        self.metric = metric
+
+        # === Удаление ===
+        # id, которые индекс не может удалить физически (HNSW): исключаются из поиска
+        # и вычищаются компактизацией, когда их доля превышает compaction_ratio
+        self.tombstones = set()
+        self.compaction_ratio = compaction_ratio
+        self._tombstone_selector = None
+        # (ключ состояния индекса, отсортированные id IndexIDMap2) — для проверки области поиска
+        self._indexed_ids = None
+        self._compaction_thread = None
+
+        # === Персистентность ===
+        # Изменения дописываются в wal.log; полный снимок (checkpoint) пишется, когда журнал
+        # вырос до checkpoint_wal_bytes или с прошлого снимка прошло checkpoint_interval секунд
+        self.wal = WriteAheadLog(os.path.join(index_path, 'wal.log'))
+        self.wal_seq = 0           # номер последней записи журнала
+        self.checkpoint_seq = 0    # номер записи, до которой включительно изменения есть в снимке
+        self.checkpoint_no = 0
+        self.index_file = None     # имя файла индекса текущего снимка
+        self.index_file_type = None  # тип индекса в нём (по нему выбираются флаги mmap)
+        self.checkpoint_wal_bytes = checkpoint_wal_bytes
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        # Снимок открывается через mmap: страницы файла делят все процессы-читатели,
+        # а копия в памяти процесса создаётся только перед первой записью
+        self.use_mmap = use_mmap
+        self._mmapped = False
 
     def initialize_index(self):
-        """Загружает индекс с диска или создаёт новый."""
-        index_file = os.path.join(self.index_path, 'index.faiss')
+        """Загружает последний снимок индекса с диска (или создаёт пустой) и применяет журнал."""
         meta_file = os.path.join(self.index_path, 'metadata.pkl')
 
         # ГАРАНТИРУЕМ, ЧТО ПАПКА СУЩЕСТВУЕТ
         Path(self.index_path).mkdir(parents=True, exist_ok=True)
+        self.chunks = ChunkStore(os.path.join(self.index_path, 'chunks.sqlite3'))
 
-        if os.path.exists(index_file) and os.path.exists(meta_file):
-            self.index = faiss.read_index(index_file)
+        migrated = False
+        state = None
+        if os.path.exists(meta_file):
             with open(meta_file, 'rb') as f:
-                self.metadata = pickle.load(f)
+                state = pickle.load(f)
+            # Старые версии писали index.faiss без ссылки на него из метаданных
+            self.index_file = 'index.faiss' if isinstance(state, list) else state.get('index_file', 'index.faiss')
+            if not os.path.exists(os.path.join(self.index_path, self.index_file)):
+                logger.warning(f"Index file {self.index_file} is missing, starting from an empty index")
+                state = None
+
+        if state is not None:
+            if isinstance(state, list):
+                self.index = faiss.read_index(os.path.join(self.index_path, self.index_file))
+                self._migrate_legacy(state)
+                migrated = True
+            else:
+                self.index_file_type = state.get('index_type')
+                self._read_checkpoint_index()
+                if 'metadata' in state:
+                    # Снимки до переноса метаданных в SQLite хранили их в pickle
+                    self.chunks.add(state['metadata'].keys(), list(state['metadata'].values()))
+                    migrated = True
+                self.tombstones = set(state.get('tombstones', ()))
+                self.checkpoint_seq = state.get('wal_seq', 0)
+                self.checkpoint_no = state.get('checkpoint_no', 0)
+            apply_search_params(self.index, self.nprobe, self.ef_search)
         else:
-            # Создаём пустой индекс L2
-            self.index = faiss.IndexFlatL2(self.dimension)
-            self.metadata = []
+            # Создаём пустой flat-индекс (до достижения порога promote_threshold)
+            self.index = self._build_index(INDEX_FLAT, self._empty_vectors(), self._empty_ids(), self.metric)
+            self.tombstones = set()
+
+        self.wal_seq = self.checkpoint_seq
+        replayed = self._replay_wal()
+        # Порог мог быть понижен в конфиге после прошлого запуска
+        promoted = self._maybe_promote()
+        if migrated or promoted or replayed:
+            self.save_index()
+
+    def _read_checkpoint_index(self, mmap: bool = None):
+        path = os.path.join(self.index_path, self.index_file)
+        mmap = self.use_mmap if mmap is None else mmap
+        flags = mmap_read_flags(self.index_file_type)
+        index = faiss.read_index(path, flags) if mmap else faiss.read_index(path)
+        # Без IO_FLAG_MMAP_IFC flat и HNSW прочитаны в память целиком — копировать перед записью нечего
+        mmap = mmap and (flags == IO_FLAG_MMAP_IFC or faiss.try_extract_index_ivf(index) is not None)
+        apply_search_params(index, self.nprobe, self.ef_search)
+        with self.index_lock.write():
+            self.index = index
+            self._mmapped = bool(mmap)
+
+    def _ensure_writable(self):
+        """
+        Перед изменением индекса переходим с mmap на копию в памяти: отображённые
+        в память списки IVF и коды flat/HNSW доступны только на чтение. Индекс до этого не менялся, так что файл снимка актуален.
+        """
+        if self._mmapped:
+            self._read_checkpoint_index(mmap=False)
+
+    def _replay_wal(self) -> int:
+        """Применяет записи журнала, которых ещё нет в снимке. Возвращает их число."""
+        replayed = 0
+        for record in self.wal.replay():
+            if record['seq'] <= self.wal_seq:
+                continue
+            self._apply(record)
+            self.wal_seq = record['seq']
+            replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} WAL records on top of checkpoint #{self.checkpoint_no}")
+        return replayed
+
+    def _log_and_apply(self, record: dict):
+        """Сначала запись в журнал (write-ahead), затем изменение индекса в памяти."""
+        with self.lock:
+            record['seq'] = self.wal_seq + 1
+            self.wal.append(record)
+            self.wal_seq = record['seq']
+            return self._apply(record)
+
+    def _apply(self, record: dict):
+        seq = record.get('seq')
+        # SQLite с чанками переживает рестарт сам: записи журнала, которые он уже применил,
+        # при старте меняют только индекс FAISS
+        stored = seq is not None and seq <= self.chunks.applied_seq()
+        if record['op'] == 'add':
+            return self._apply_add(record['ids'], record['vectors'], record['metadata'], seq, stored)
+        if record['op'] == 'delete':
+            return self._apply_delete(record['doc_id'], record.get('ids'), seq, stored)
+        raise ValueError(f"Unknown WAL operation: {record['op']}")
+
+    def _empty_vectors(self) -> np.ndarray:
+        return np.zeros((0, self.dimension), dtype=np.float32)
+
+    @staticmethod
+    def _empty_ids() -> np.ndarray:
+        return np.zeros(0, dtype=np.int64)
+
+    def _build_index(self, index_type: str, vectors: np.ndarray, ids: np.ndarray, metric: str):
+        """
+        Строит индекс с внешними id. IVF хранит id сам, flat и HNSW оборачиваются в IndexIDMap2.
+        """
+        index = create_faiss_index(
+            index_type, self.dimension, n_vectors=len(vectors),
+            nlist=self.nlist, hnsw_m=self.hnsw_m, pq_m=self.pq_m, metric=metric
+        )
+        if not index.is_trained:
+            index.train(vectors)
+        if faiss.try_extract_index_ivf(index) is None:
+            index = faiss.IndexIDMap2(index)
+        if len(vectors):
+            index.add_with_ids(vectors, ids)
+        apply_search_params(index, self.nprobe, self.ef_search)
+        return index
+
+    def _export_vectors(self):
+        """Возвращает (vectors, ids) всех векторов flat/HNSW-индекса, включая tombstones."""
+        if not isinstance(self.index, faiss.IndexIDMap):
+            raise RuntimeError("Export is supported only for IndexIDMap-based indexes")
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        vectors = base_index(self.index).reconstruct_n(0, self.index.ntotal)
+        return vectors, ids
+
+    def _migrate_legacy(self, metadata_list: list):
+        """
+        Старый формат: последовательные id и список метаданных.
+        Перестраивает индекс со стабильными id (doc_id, номер чанка).
+        """
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        count = min(self.index.ntotal, len(metadata_list))
+        vectors = self.index.reconstruct_n(0, count) if count else self._empty_vectors()
+
+        chunk_counters = {}
+        ids = []
+        for meta in metadata_list[:count]:
+            doc_id = meta.get('doc_id', 0)
+            chunk_no = chunk_counters.get(doc_id, 0)
+            chunk_counters[doc_id] = chunk_no + 1
+            meta['chunk_no'] = chunk_no
+            ids.append(make_vector_id(doc_id, chunk_no))
+        ids = np.array(ids, dtype=np.int64)
+
+        self.index = self._build_index(get_index_type(self.index), vectors, ids, get_index_metric(self.index))
+        self.chunks.add(ids, metadata_list[:count])
+        self.tombstones = set()
+        logger.info(f"Migrated legacy FAISS index: {count} vectors now have stable ids")
 
     def add_embeddings(self, embeddings: list, metadata: list):
-        """Добавляет эмбеддинги и метаданные в индекс."""
+        """
+        Добавляет эмбеддинги и метаданные в индекс.
+        Каждая запись метаданных должна содержать doc_id и chunk_no — из них строится id вектора.
+        """
         if len(embeddings) != len(metadata):
             raise ValueError("Количество эмбеддингов и метаданных должно совпадать")
 
         embeddings_np = np.array(embeddings, dtype=np.float32)
-        faiss.normalize_L2(embeddings_np)  # опционально, если используется косинусное расстояние
-        self.index.add(embeddings_np)
-        self.metadata.extend(metadata)
+        faiss.normalize_L2(embeddings_np)  # на нормированных векторах inner product = косинус
+        ids = np.array([make_vector_id(meta['doc_id'], meta['chunk_no']) for meta in metadata], dtype=np.int64)
+        # Вектор удалённого документа мог перейти к другому документу под прежним id:
+        # INSERT OR REPLACE затёр бы его строку, а add_with_ids задвоил бы id в индексе
+        owners = self.chunks.get_owners(ids.tolist())
+        taken = [vector_id for vector_id, meta in zip(ids.tolist(), metadata)
+                 if owners.get(vector_id, meta['doc_id']) != meta['doc_id']]
+        if taken:
+            raise ValueError(f"Vector ids {taken[:5]} already belong to other documents")
+        self._log_and_apply({'op': 'add', 'ids': ids, 'vectors': embeddings_np, 'metadata': metadata})
+
+    def _apply_add(self, ids: np.ndarray, vectors: np.ndarray, metadata: list,
+                   seq: int = None, stored: bool = False):
+        """seq — номер записи журнала; stored — хранилище чанков уже содержит это изменение."""
+        with self.lock:
+            self._ensure_writable()
+            if self.tombstones and not self.tombstones.isdisjoint(ids.tolist()):
+                # id вернулся в индекс (например, id документа переиспользован старой БД без
+                # AUTOINCREMENT): прежний вектор под ним физически ещё в HNSW и ожил бы вместе с ним
+                self._purge_tombstones()
+            if not stored:
+                self.chunks.add(ids, metadata, seq=seq)
+            with self.index_lock.write():
+                self.index.add_with_ids(vectors, ids)
+                self.generation += 1
+            self._maybe_promote()
+
+    def find_chunks(self, hashes) -> dict:
+        """{content_hash: vector_id} для чанков, векторы которых уже есть в индексе."""
+        return self.chunks.find_hashes(hashes)
+
+    def add_chunk_refs(self, metadata: list):
+        """Регистрирует чанки документа, чьи векторы уже есть в индексе (без нового вектора)."""
+        self.chunks.add_refs(metadata)
+
+    def delete_document(self, doc_id: int) -> int:
+        """
+        Удаляет векторы и метаданные документа. Возвращает число удалённых векторов.
+        Векторы, текст которых есть в других документах, остаются и переходят к ним.
+        Если индекс не поддерживает удаление (HNSW), векторы помечаются tombstones.
+        """
+        with self.lock:
+            vector_ids = self.chunks.get_removable_ids(doc_id)
+            return self._log_and_apply({'op': 'delete', 'doc_id': int(doc_id), 'ids': vector_ids})
+
+    def _apply_delete(self, doc_id: int, vector_ids: list = None, seq: int = None, stored: bool = False) -> int:
+        start, end = doc_id_range(doc_id)
+        with self.lock:
+            self._ensure_writable()
+            deleted_ids = [] if stored else self.chunks.delete_document(doc_id, seq=seq)
+            # Записи журнала старого формата не содержат список id
+            legacy = vector_ids is None and stored
+            vector_ids = deleted_ids if vector_ids is None else vector_ids
+            with self.index_lock.write():
+                if supports_remove(self.index):
+                    if legacy:
+                        # Весь диапазон документа удалять нельзя: в нём могут быть векторы,
+                        # перешедшие к другим документам, — они остались в хранилище чанков
+                        selector = range_selector = faiss.IDSelectorRange(start, end)
+                        kept = np.array(self.chunks.get_ids_between(start, end), dtype=np.int64)
+                        if len(kept):
+                            # Составные селекторы не владеют вложенными: держим ссылки до remove_ids
+                            kept_selector = faiss.IDSelectorBatch(kept)
+                            not_kept = faiss.IDSelectorNot(kept_selector)
+                            selector = faiss.IDSelectorAnd(range_selector, not_kept)
+                        self.index.remove_ids(selector)
+                    elif vector_ids:
+                        self.index.remove_ids(np.array(vector_ids, dtype=np.int64))
+                else:
+                    self.tombstones.update(vector_ids)
+                    self._tombstone_selector = None
+                self.generation += 1
+        return len(vector_ids)
+
+    def tombstone_ratio(self) -> float:
+        with self.index_lock.read():
+            return len(self.tombstones) / max(self.index.ntotal, 1)
+
+    def compact(self) -> bool:
+        """
+        Перестраивает индекс без tombstones. Сборка идёт вне блокировок, поэтому ни поиск,
+        ни запись не простаивают; если индекс успел измениться, результат отбрасывается.
+        """
+        with self.lock:
+            if not self.tombstones:
+                return False
+            generation = self.generation
+            vectors, ids = self._export_vectors()
+            dead = np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones))
+            index_type, metric = get_index_type(self.index), get_index_metric(self.index)
+
+        keep = ~np.isin(ids, dead)
+        new_index = self._build_index(index_type, vectors[keep], ids[keep], metric)
+
+        with self.lock:
+            if self.generation != generation:
+                logger.info("Index changed during compaction, will retry on next delete")
+                return False
+            with self.index_lock.write():
+                self.index = new_index
+                self._mmapped = False
+                self.tombstones = set()
+                self._tombstone_selector = None
+                self.generation += 1
+        self.save_index()
+        logger.info(f"Index compacted: removed {len(dead)} tombstones, {self.index.ntotal} vectors left")
+        return True
+
+    def _purge_tombstones(self):
+        """Синхронная компактизация под lock: индекс перестраивается без tombstones."""
+        vectors, ids = self._export_vectors()
+        dead = np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones))
+        keep = ~np.isin(ids, dead)
+        new_index = self._build_index(get_index_type(self.index), vectors[keep], ids[keep],
+                                      get_index_metric(self.index))
+        with self.index_lock.write():
+            self.index = new_index
+            self._mmapped = False
+            self.tombstones = set()
+            self._tombstone_selector = None
+            self.generation += 1
+        logger.info(f"Index compacted before re-adding tombstoned ids: removed {len(dead)} vectors")
 
-    def search_vectors(self, query_embedding: list, k: int = 3):
-        """Ищет k ближайших соседей по эмбеддингу запроса."""
-        if self.index is None or self.index.ntotal == 0:
-            return [], []
+    def maybe_compact_async(self) -> bool:
+        """Запускает компактизацию в фоне, если доля tombstones превысила compaction_ratio."""
+        if not self.tombstones or self.tombstone_ratio() < self.compaction_ratio:
+            return False
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return False
+        self._compaction_thread = threading.Thread(target=self.compact, name="faiss-compaction")
+        self._compaction_thread.daemon = True
+        self._compaction_thread.start()
+        return True
 
-        query_np = np.array([query_embedding], dtype=np.float32)
-        faiss.normalize_L2(query_np)  # опционально
-        distances, indices = self.index.search(query_np, k)
+    def _maybe_promote(self) -> bool:
+        """
+        Переводит flat-индекс на ANN-индекс (index_type), когда векторов стало достаточно.
+        Возвращает True, если индекс был перестроен.
+        """
+        if self.index_type == INDEX_FLAT or get_index_type(self.index) != INDEX_FLAT:
+            return False
+        ntotal = self.index.ntotal
+        # IVF-PQ обучает 256 центроидов на каждый подвектор
+        min_train = 256 if self.index_type == INDEX_IVF_PQ else MIN_POINTS_PER_CENTROID
+        if ntotal < max(self.promote_threshold, min_train):
+            return False
 
-        results_meta = []
-        results_distances = []
+        with self.lock:
+            # Обучение идёт под lock (индекс не меняется), поиск тем временем работает по старому
+            vectors, ids = self._export_vectors()
+            new_index = self._build_index(self.index_type, vectors, ids, get_index_metric(self.index))
+            with self.index_lock.write():
+                self.index = new_index
+                self._mmapped = False
+                self.generation += 1
+        return True
 
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.metadata):
-                results_meta.append(self.metadata[idx])
-                results_distances.append(float(distances[0][i]))
+    def set_search_params(self, nprobe: int = None, ef_search: int = None):
+        """Меняет nprobe / efSearch на лету (компромисс recall ↔ latency)."""
+        with self.lock, self.index_lock.write():
+            if nprobe:
+                self.nprobe = nprobe
+            if ef_search:
+                self.ef_search = ef_search
+            apply_search_params(self.index, self.nprobe, self.ef_search)
 
-        return results_distances, results_meta
+    def get_index_info(self) -> dict:
+        with self.index_lock.read():
+            info = {
+                'type': get_index_type(self.index) if self.index is not None else None,
+                'metric': get_index_metric(self.index) if self.index is not None else self.metric,
+                'target_type': self.index_type,
+                'promote_threshold': self.promote_threshold,
+                'ntotal': self.index.ntotal if self.index is not None else 0,
+                'tombstones': len(self.tombstones),
+                'generation': self.generation,
+                'checkpoint_no': self.checkpoint_no,
+                'wal_records': self.wal_seq - self.checkpoint_seq,
+                'wal_bytes': self.wal.size_bytes(),
+                'chunks': self.chunks.count() if self.chunks is not None else 0,
+                # Вхождения чанков в документы; разница с chunks — векторы, сэкономленные дедупликацией
+                'chunk_refs': self.chunks.count_refs() if self.chunks is not None else 0,
+                'mmap': self._mmapped,
+            }
+            ivf = faiss.try_extract_index_ivf(self.index) if self.index is not None else None
+            if ivf is not None:
+                info.update({'nlist': ivf.nlist, 'nprobe': ivf.nprobe})
+            hnsw = base_index(self.index) if self.index is not None else None
+            if isinstance(hnsw, faiss.IndexHNSW):
+                info.update({'hnsw_m': self.hnsw_m, 'ef_search': hnsw.hnsw.efSearch})
+            return info
+
+    def _search_params(self, vector_ids: np.ndarray = None):
+        """
+        SearchParameters, исключающие tombstones и, если задан vector_ids, все векторы вне него
+        (None, если фильтровать нечего).
+        """
+        if not self.tombstones and vector_ids is None:
+            return None
+        selector = None
+        referenced = []
+        if self.tombstones:
+            tombstone_selector = self._tombstone_selector
+            if tombstone_selector is None:
+                dead = np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones))
+                batch = faiss.IDSelectorBatch(dead)
+                # Держим ссылку на batch: IDSelectorNot не владеет вложенным селектором
+                tombstone_selector = self._tombstone_selector = (batch, faiss.IDSelectorNot(batch))
+            # Параллельный поиск может пересобрать кэш — эта пара должна дожить до конца нашего
+            referenced.append(tombstone_selector)
+            selector = tombstone_selector[1]
+        if vector_ids is not None:
+            scope = faiss.IDSelectorBatch(vector_ids)
+            referenced.append(scope)
+            if selector is not None:
+                selector = faiss.IDSelectorAnd(scope, selector)
+                referenced.append(selector)
+            else:
+                selector = scope
+
+        index = base_index(self.index)
+        if isinstance(index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+        else:
+            ivf = faiss.try_extract_index_ivf(self.index)
+            if ivf is not None:
+                # Небольшая область может лежать в любых кластерах — просматриваем все списки,
+                # расстояния всё равно считаются только для векторов области
+                small_scope = vector_ids is not None and len(vector_ids) <= self.filter_exact_max
+                nprobe = ivf.nlist if small_scope else ivf.nprobe
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+        # SearchParameters не владеет селекторами — они должны жить до конца поиска
+        params.referenced_objects = referenced
+        return params
+
+    def _in_index(self, vector_ids: np.ndarray) -> np.ndarray:
+        """
+        Те из vector_ids, что есть в IndexIDMap2. Область поиска читается из хранилища чанков
+        без index_lock: строки чанков записываются до add_with_ids, а индекс другого процесса
+        может отставать от общего хранилища. Вызывать под index_lock.
+        """
+        key = (self.generation, id(self.index), self.index.ntotal)
+        cached = self._indexed_ids
+        if cached is None or cached[0] != key:
+            cached = self._indexed_ids = (key, np.sort(faiss.vector_to_array(self.index.id_map)))
+        indexed = cached[1]
+        if len(indexed) == 0:
+            return vector_ids[:0]
+        positions = np.minimum(np.searchsorted(indexed, vector_ids), len(indexed) - 1)
+        return vector_ids[indexed[positions] == vector_ids]
+
+    def _search_exact(self, query_np: np.ndarray, k: int, vector_ids: np.ndarray):
+        """
+        Точный поиск только по векторам области: они восстанавливаются из IndexIDMap2
+        (flat / HNSW), остальной индекс не просматривается.
+        """
+        # reconstruct_batch падает на id, которого нет в индексе
+        vector_ids = self._in_index(vector_ids)
+        if len(vector_ids) == 0:
+            return (np.empty((len(query_np), 0), dtype=np.float32),
+                    np.empty((len(query_np), 0), dtype=np.int64))
+        vectors = self.index.reconstruct_batch(vector_ids)
+        metric = FAISS_METRICS[get_index_metric(self.index)]
+        distances, positions = faiss.knn(query_np, vectors, min(k, len(vector_ids)), metric=metric)
+        ids = np.where(positions >= 0, vector_ids[np.maximum(positions, 0)], -1)
+        return distances, ids
+
+    def scope_vector_ids(self, doc_ids) -> np.ndarray:
+        """id векторов, по которым ищут документы doc_ids (для vector_ids в search_*_batch)."""
+        return np.array(self.chunks.get_scope_ids(doc_ids), dtype=np.int64)
+
+    def _to_similarity(self, distances: np.ndarray) -> np.ndarray:
+        """Приводит результат FAISS к косинусной близости (больше — лучше)."""
+        if get_index_metric(self.index) == METRIC_IP:
+            return distances
+        # Для нормированных векторов ||a - b||^2 = 2 - 2*cos(a, b)
+        return 1.0 - distances / 2.0
+
+    def search_vectors(self, query_embedding: list, k: int = 3, min_score: float = None, doc_ids=None):
+        """
+        Ищет k ближайших соседей по эмбеддингу запроса.
+        Возвращает (scores, metadata): scores — косинусная близость по убыванию,
+        хиты ниже min_score отбрасываются. doc_ids — искать только в чанках этих документов.
+        """
+        vector_ids = self.scope_vector_ids(doc_ids) if doc_ids is not None else None
+        return self.search_vectors_batch([query_embedding], k=k, min_score=min_score, vector_ids=vector_ids)[0]
+
+    def search_vectors_batch(self, query_embeddings, k: int = 3, min_score: float = None,
+                             vector_ids: np.ndarray = None) -> list:
+        """
+        Один вызов FAISS на всю матрицу запросов и один запрос в хранилище чанков.
+        Возвращает список (scores, metadata) — по одному на запрос.
+        vector_ids (см. scope_vector_ids) — фильтр внутри FAISS: векторы вне области не
+        попадают в top-k. Небольшая область (до filter_exact_max) flat/HNSW-индекса
+        просматривается точным поиском только по её векторам.
+        """
+        query_np = np.array(query_embeddings, dtype=np.float32).reshape(-1, self.dimension)
+        if len(query_np) == 0 or (vector_ids is not None and len(vector_ids) == 0):
+            return [([], []) for _ in range(len(query_np))]
+
+        faiss.normalize_L2(query_np)
+        # Только блокировка чтения: поиски идут параллельно (FAISS отпускает GIL),
+        # запись в журнал и снимки на диск их не задерживают
+        with self.index_lock.read():
+            if self.index is None or self.index.ntotal == 0:
+                return [([], []) for _ in range(len(query_np))]
+            if vector_ids is not None and self.tombstones:
+                vector_ids = vector_ids[~np.isin(vector_ids, list(self.tombstones))]
+            if vector_ids is None:
+                distances, ids = self.index.search(query_np, k, params=self._search_params())
+            elif len(vector_ids) <= self.filter_exact_max and isinstance(self.index, faiss.IndexIDMap2):
+                distances, ids = self._search_exact(query_np, k, vector_ids)
+            else:
+                distances, ids = self.index.search(query_np, k, params=self._search_params(vector_ids))
+            scores = self._to_similarity(distances)
+
+        # Из хранилища читаем только top-k строк (IVF/HNSW возвращают -1, если кандидатов меньше k)
+        hits = [
+            [(float(score), int(vector_id)) for score, vector_id in zip(row_scores, row_ids)
+             if vector_id >= 0 and (min_score is None or score >= min_score)]
+            for row_scores, row_ids in zip(scores, ids)
+        ]
+        chunks = self.chunks.get_many({vector_id for row in hits for _, vector_id in row})
+
+        results = []
+        for row in hits:
+            results_meta = []
+            results_scores = []
+            for score, vector_id in row:
+                meta = chunks.get(vector_id)
+                if meta is None:
+                    continue
+                results_meta.append(meta)
+                results_scores.append(score)
+            results.append((results_scores, results_meta))
+        return results
+
+    def search_lexical_batch(self, queries: list, k: int = 3, vector_ids: np.ndarray = None) -> list:
+        """
+        BM25-поиск по тексту чанков (FTS5 в хранилище чанков), без FAISS и без блокировки индекса.
+        Возвращает список (scores, metadata) — по одному на запрос; score — BM25, больше — лучше.
+        vector_ids — та же область поиска, что и в search_vectors_batch.
+        """
+        if vector_ids is not None and len(vector_ids) == 0:
+            return [([], []) for _ in queries]
+        found = [self.chunks.search_lexical(query, k, vector_ids) for query in queries]
+        chunks = self.chunks.get_many({vector_id for row in found for vector_id, _ in row})
+        results = []
+        for row in found:
+            hits = [(score, chunks[vector_id]) for vector_id, score in row if vector_id in chunks]
+            results.append(([score for score, _ in hits], [meta for _, meta in hits]))
+        return results
 
     def save_index(self):
-        """Сохраняет индекс и метаданные на диск."""
-        index_file = os.path.join(self.index_path, 'index.faiss')
-        meta_file = os.path.join(self.index_path, 'metadata.pkl')
+        """
+        Checkpoint: атомарно пишет снимок индекса и его состояния (tombstones, номер записи журнала)
+        и убирает из журнала вошедшие в снимок записи. Чанки уже лежат в SQLite и в снимок не входят.
+        Точка фиксации — замена metadata.pkl: до неё при старте читается старый снимок + журнал.
+
+        Под lock индекс только сериализуется в память (копия размером с индекс); запись
+        на диск и fsync идут без блокировок — поиск и индексация в это время продолжаются.
+        Вызывающий не должен держать lock.
+        """
+        with self._checkpoint_lock:
+            with self.lock, self.index_lock.read():
+                data = faiss.serialize_index(self.index)
+                wal_seq = self.wal_seq
+                checkpoint_no = self.checkpoint_no + 1
+                state = {
+                    'tombstones': set(self.tombstones),
+                    'index_file': f"index-{checkpoint_no:06d}.faiss",
+                    'index_type': get_index_type(self.index),
+                    'wal_seq': wal_seq,
+                    'checkpoint_no': checkpoint_no,
+                }
+
+            index_file = state['index_file']
+            atomic_write(os.path.join(self.index_path, index_file), data.tofile)
+            del data
+
+            def write_state(tmp):
+                with open(tmp, 'wb') as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            with self.lock:
+                atomic_write(os.path.join(self.index_path, 'metadata.pkl'), write_state)
+
+                # Снимок зафиксирован: старый файл индекса и записи журнала до wal_seq больше не нужны
+                previous = self.index_file
+                self.index_file = index_file
+                self.index_file_type = state['index_type']
+                self.checkpoint_no = checkpoint_no
+                self.checkpoint_seq = wal_seq
+                self.last_checkpoint = time.time()
+                if self.wal_seq == wal_seq:
+                    self.wal.reset()
+                else:
+                    self.wal.drop_through(wal_seq)
+            previous_path = os.path.join(self.index_path, previous) if previous else None
+            if previous_path and previous != index_file and os.path.exists(previous_path):
+                try:
+                    os.remove(previous_path)
+                except OSError as e:
+                    # Windows не даёт удалить файл, пока он отображён в память другим процессом
+                    logger.warning(f"Failed to remove old index file {previous_path}: {e}")
 
-        faiss.write_index(self.index, index_file)
-        with open(meta_file, 'wb') as f:
-            pickle.dump(self.metadata, f)
+    def maybe_checkpoint(self) -> bool:
+        """
+        Пишет снимок, если журнал вырос или давно не было checkpoint. Возвращает True, если записал.
+        Вызывающий не должен держать lock (см. save_index).
+        """
+        with self.lock:
+            if self.wal_seq == self.checkpoint_seq:
+                return False
+            if (self.wal.size_bytes() < self.checkpoint_wal_bytes
+                    and time.time() - self.last_checkpoint < self.checkpoint_interval):
+                return False
+        self.save_index()
+        return True
 
     def load_index(self):
         """Явная загрузка индекса (обычно вызывается через initialize_index)."""
-        self.initialize_index()
\ No newline at end of file
+        self.initialize_index()
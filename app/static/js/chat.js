@@ -180,42 +180,92 @@ function setupChatForm(sessionId) {
         chatHistory.appendChild(loadingIndicator);
         scrollToBottom();
 
-        // Отправляем на сервер
-        fetch('/api/chat', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ message: messageText, session_id: sessionId })
-        })
-        .then(res => res.json())
-        .then(data => {
-            // --- НАЧАЛО: Удаляем индикатор ожидания ---
+        // Отправляем на сервер: ответ приходит по частям (SSE), токены дописываются в сообщение
+        let aiContent = null;
+        let aiText = '';
+
+        const removeIndicator = () => {
             const indicatorToRemove = document.getElementById('loadingIndicator');
             if (indicatorToRemove) {
                 indicatorToRemove.remove();
             }
-            //--- КОНЕЦ: Удаляем индикатор ожидания ---
+        };
 
-            if (data.error) {
+        const handleEvent = (eventName, data) => {
+            if (eventName === 'token') {
+                if (!aiContent) {
+                    removeIndicator();
+                    aiContent = appendMessage('', false, false, null).querySelector('.message-content');
+                }
+                aiText += data.text;
+                aiContent.textContent = aiText;
+                scrollToBottom();
+            } else if (eventName === 'done') {
+                removeIndicator();
+                if (!aiContent) {
+                    aiContent = appendMessage('', false, false, null).querySelector('.message-content');
+                }
+                const messageDiv = aiContent.closest('.message');
+                if (data.used_rag) messageDiv.classList.add('rag-used');
+                messageDiv.querySelector('.avatar').src = avatarForModel(data.model_used);
+            } else if (eventName === 'error') {
+                removeIndicator();
                 appendMessage('❌ Ошибка: ' + data.error, false, false, null);
-            } else {
-                appendMessage(data.response, false, data.used_rag, data.model_used);
             }
             scrollToBottom();
+        };
+
+        fetch('/api/chat/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ message: messageText, session_id: sessionId })
         })
-        .catch(err => {
-            // --- НАЧАЛО: Удаляем индикатор ожидания и показываем ошибку ---
-            const indicatorToRemove = document.getElementById('loadingIndicator');
-            if (indicatorToRemove) {
-                indicatorToRemove.remove();
+        .then(async res => {
+            if (!res.ok) {
+                const data = await res.json().catch(() => ({ error: `HTTP ${res.status}` }));
+                handleEvent('error', data);
+                return;
+            }
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                // События SSE разделены пустой строкой
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    let eventName = 'message';
+                    let dataLines = [];
+                    rawEvent.split('\n').forEach(line => {
+                        if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+                    });
+                    if (dataLines.length) handleEvent(eventName, JSON.parse(dataLines.join('\n')));
+                }
             }
+        })
+        .catch(err => {
+            removeIndicator();
             appendMessage('❌ Не удалось получить ответ от сервера.', false, false, null);
             console.error(err);
             scrollToBottom();
-            // --- КОНЕЦ: Удаляем индикатор ожидания и показываем ошибку ---
         });
     });
 }
 
+function avatarForModel(modelUsed) {
+    if (modelUsed === 'yandex_gpt') {
+        return '/static/images/yandex-avatar.png';
+    } else if (modelUsed === 'local_llm') {
+        return '/static/images/local-avatar.png';
+    }
+    return '/static/images/default-ai-avatar.png';
+}
+
 function appendMessage(text, isUser, usedRag, modelUsed) {
     const chatHistory = document.getElementById('chatHistory');
 
@@ -253,6 +303,7 @@ function appendMessage(text, isUser, usedRag, modelUsed) {
     }
 
     chatHistory.appendChild(messageDiv);
+    return messageDiv;
 }
 
 function scrollToBottom() {
@@ -298,6 +349,14 @@ function initUploadPage() {
                     loadDocuments();
                     fileInput.value = ''; // сброс
                 });
+            } else if (res.status === 200) {
+                // Такой же файл уже загружен — повторно не индексируется
+                return res.json().then(data => {
+                    alert(`Документ "${data.filename}" уже загружен.`);
+                    fileInput.value = '';
+                });
+            } else if (res.status === 429) {
+                throw new Error('Очередь обработки заполнена, попробуйте позже');
             } else {
                 return res.json().then(err => {
                     throw new Error(err.error || 'Неизвестная ошибка');
@@ -326,7 +385,13 @@ function initUploadPage() {
                 let html = '<div class="list-group">';
                 docs.forEach(doc => {
                     const statusClass = doc.processed ? 'status-processed' : 'status-processing';
-                    const statusText = doc.processed ? 'Обработан' : 'В обработке';
+                    const statusLabels = {
+                        queued: 'В очереди',
+                        processing: 'В обработке',
+                        done: 'Обработан',
+                        failed: 'Ошибка обработки'
+                    };
+                    const statusText = statusLabels[doc.status] || (doc.processed ? 'Обработан' : 'В обработке');
                     html += `
                         <div class="list-group-item d-flex justify-content-between align-items-center">
                             <div>
@@ -0,0 +1,95 @@
+# benchmarks/ann_benchmark.py
+"""
+Recall vs latency для типов индекса VectorDB относительно flat-индекса.
+
+Векторы синтетические (кластеризованные, нормированные — как эмбеддинги
+MiniLM), поэтому модель не нужна. Пример:
+
+    python benchmarks/ann_benchmark.py --n 200000 --queries 500 --k 5 --nprobe 8 16 32 --ef 32 64 128
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import faiss
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from app.services.vector_db import (
+    INDEX_FLAT, INDEX_IVF_FLAT, INDEX_HNSW, INDEX_IVF_PQ,
+    create_faiss_index, apply_search_params
+)
+
+
+def make_vectors(n: int, dimension: int, n_clusters: int, rng) -> np.ndarray:
+    centers = rng.standard_normal((n_clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, size=n)
+    vectors = centers[labels] + 0.3 * rng.standard_normal((n, dimension)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def timed_search(index, queries: np.ndarray, k: int):
+    # По одному запросу — как в /api/chat
+    started = time.perf_counter()
+    results = np.vstack([index.search(queries[i:i + 1], k)[1] for i in range(len(queries))])
+    latency_ms = (time.perf_counter() - started) / len(queries) * 1000
+    return results, latency_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall/latency бенчмарк ANN-индексов FAISS.')
+    parser.add_argument('--n', type=int, default=100000, help='Число векторов в индексе')
+    parser.add_argument('--dim', type=int, default=384, help='Размерность (MiniLM-L6 = 384)')
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--ef', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--pq-m', type=int, default=16)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    vectors = make_vectors(args.n, args.dim, n_clusters=max(10, args.n // 1000), rng=rng)
+    queries = make_vectors(args.queries, args.dim, n_clusters=max(10, args.n // 1000), rng=rng)
+
+    flat = create_faiss_index(INDEX_FLAT, args.dim)
+    flat.add(vectors)
+    truth, flat_latency = timed_search(flat, queries, args.k)
+    print(f"{'index':<10} {'param':<14} {'build s':>8} {'recall@' + str(args.k):>9} {'ms/query':>9}")
+    print(f"{INDEX_FLAT:<10} {'-':<14} {0:>8.2f} {1.0:>9.3f} {flat_latency:>9.3f}")
+
+    for index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ, INDEX_HNSW):
+        started = time.perf_counter()
+        index = create_faiss_index(index_type, args.dim, n_vectors=args.n, hnsw_m=args.hnsw_m, pq_m=args.pq_m)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        build_sec = time.perf_counter() - started
+
+        if index_type == INDEX_HNSW:
+            settings = [('efSearch', ef, {'ef_search': ef}) for ef in args.ef]
+        else:
+            settings = [('nprobe', nprobe, {'nprobe': nprobe}) for nprobe in args.nprobe]
+
+        for name, value, params in settings:
+            apply_search_params(index, **params)
+            found, latency = timed_search(index, queries, args.k)
+            print(f"{index_type:<10} {name + '=' + str(value):<14} {build_sec:>8.2f} "
+                  f"{recall_at_k(found, truth):>9.3f} {latency:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# benchmarks/batch_search_benchmark.py
+"""
+Пропускная способность пакетного поиска RAGEngine.search_similar_batch против
+цикла по search_similar (один запрос — один проход модели и один вызов FAISS).
+
+Индекс строится во временной папке из синтетических чанков, эмбеддинги считает
+настоящая модель из Config.EMBEDDING_MODEL. Пример:
+
+    python benchmarks/batch_search_benchmark.py --chunks 5000 --queries 256 --batch 1 8 32 64
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services.embedding_service import build_embedding_service
+from app.services.vector_db import VectorDB
+from app.services.rag_engine import RAGEngine
+
+WORDS = (
+    "документ индекс поиск модель вектор запрос ответ данные файл текст система "
+    "пользователь сервер память диск сеть кластер задача очередь отчёт договор "
+    "index search model vector query answer data file text system user server memory"
+).split()
+
+
+def make_text(rng: random.Random, n_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def build_engine(index_dir: str, n_chunks: int, rng: random.Random) -> RAGEngine:
+    service = build_embedding_service(vars(Config))
+    vector_db = VectorDB(index_path=index_dir, embedding_model_name=Config.EMBEDDING_MODEL,
+                         embedding_service=service, index_type=Config.FAISS_INDEX_TYPE)
+    vector_db.initialize_index()
+
+    texts = [make_text(rng, 60) for _ in range(n_chunks)]
+    metadata = [{'doc_id': i // 100 + 1, 'chunk_no': i % 100, 'text': text} for i, text in enumerate(texts)]
+    vector_db.add_embeddings(service.encode(texts), metadata)
+    return RAGEngine(vector_db, Config.EMBEDDING_MODEL, Config.CHUNK_SIZE, Config.CHUNK_OVERLAP, min_score=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пакетный поиск против поиска по одному запросу.')
+    parser.add_argument('--chunks', type=int, default=2000, help='Число чанков в индексе')
+    parser.add_argument('--queries', type=int, default=128)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 8, 32, 64], help='Размеры батча')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as index_dir:
+        started = time.perf_counter()
+        engine = build_engine(index_dir, args.chunks, rng)
+        print(f"Index: {args.chunks} chunks, built in {time.perf_counter() - started:.1f}s")
+
+        queries = [make_text(rng, 8) for _ in range(args.queries)]
+        # Прогрев: первая загрузка модели и первый вызов FAISS не должны попадать в замер
+        engine.search_similar_batch(queries[:8], k=args.k)
+
+        started = time.perf_counter()
+        for query in queries:
+            engine.search_similar(query, k=args.k)
+        loop_sec = time.perf_counter() - started
+        print(f"{'mode':<12} {'batch':>6} {'queries/s':>10} {'ms/query':>9} {'speedup':>8}")
+        print(f"{'loop':<12} {1:>6} {len(queries) / loop_sec:>10.1f} {loop_sec / len(queries) * 1000:>9.2f} {1.0:>8.2f}")
+
+        for batch_size in args.batch:
+            started = time.perf_counter()
+            for start in range(0, len(queries), batch_size):
+                engine.search_similar_batch(queries[start:start + batch_size], k=args.k)
+            batch_sec = time.perf_counter() - started
+            print(f"{'batch':<12} {batch_size:>6} {len(queries) / batch_sec:>10.1f} "
+                  f"{batch_sec / len(queries) * 1000:>9.2f} {loop_sec / batch_sec:>8.2f}")
+
+        engine.vector_db.wal.close()
+
+
+if __name__ == '__main__':
+    main()
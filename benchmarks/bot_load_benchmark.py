@@ -0,0 +1,128 @@
+# benchmarks/bot_load_benchmark.py
+"""
+Нагрузочный тест обработчика сообщений Telegram-бота с замоканной LLM.
+
+Запросы к OpenAI-совместимому API заменены задержкой (--latency), Telegram —
+заглушками Update/Message, так что ни сеть, ни токен не нужны. Сравниваются:
+
+- sync  — старое поведение: handle_message вызывает синхронный generate_response
+          и держит event loop на всё время запроса;
+- async — agenerate_response через AsyncOpenAI с лимитом BOT_MAX_CONCURRENT_REQUESTS.
+
+    python benchmarks/bot_load_benchmark.py --users 50 --messages 2 --latency 0.5 --limit 16
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.bot import telegram_bot
+from app.services.llm_manager import LLMManager
+from app.services.conversation_memory import build_memory
+
+
+def make_completion(text: str):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+def mock_llm_clients(llm_manager: LLMManager, latency: float):
+    """Подменяет HTTP-вызовы провайдеров задержкой latency секунд."""
+    def create(**kwargs):
+        time.sleep(latency)
+        return make_completion(f"ответ {kwargs['model']}")
+
+    async def acreate(**kwargs):
+        await asyncio.sleep(latency)
+        return make_completion(f"ответ {kwargs['model']}")
+
+    for provider in llm_manager.providers.values():
+        provider.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        provider.async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=acreate)))
+
+
+class FakeMessage:
+    def __init__(self, text: str):
+        self.text = text
+        self.replies = []
+        self.chat = SimpleNamespace(send_action=self._send_action)
+
+    async def _send_action(self, action):
+        pass
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def make_update(user_id: int, text: str):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=FakeMessage(text))
+
+
+async def run_load(users: int, messages: int) -> float:
+    """Все пользователи пишут одновременно; сообщения одного пользователя идут по очереди."""
+    async def user_session(user_id: int):
+        for i in range(messages):
+            update = make_update(user_id, f"вопрос {i} от {user_id}")
+            await telegram_bot.handle_message(update, None)
+            # Обработчик отвечает и на ошибки — проверяем, что пришёл ответ LLM
+            assert update.message.replies and 'ответ' in update.message.replies[-1], update.message.replies
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(user_id) for user_id in range(users)))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пропускная способность бота: sync против async LLM-вызовов.')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=2, help='Сообщений от каждого пользователя')
+    parser.add_argument('--latency', type=float, default=0.3, help='Задержка замоканной LLM, с')
+    parser.add_argument('--limit', type=int, default=Config.BOT_MAX_CONCURRENT_REQUESTS,
+                        help='Лимит одновременных запросов к LLM')
+    args = parser.parse_args()
+
+    config = {key: getattr(Config, key) for key in dir(Config) if not key.startswith('__')}
+    # Фиктивные ключи: оба провайдера создаются, но в сеть не ходят
+    config.update(YANDEX_API_KEY='test', YANDEX_FOLDER_ID='test', RESPONSE_CACHE_ENABLED=False)
+    llm_manager = LLMManager(config)
+    mock_llm_clients(llm_manager, args.latency)
+    telegram_bot._llm_manager = llm_manager
+    states = [{'model': 'local_llm', 'memory': build_memory(config)} for _ in range(args.users)]
+    for user_id, state in enumerate(states):
+        telegram_bot.user_states.set(user_id, state)
+
+    total = args.users * args.messages
+    print(f"{args.users} users x {args.messages} messages, LLM latency {args.latency}s, limit {args.limit}")
+    print(f"{'mode':<6} {'wall s':>8} {'msg/s':>8}")
+
+    # sync: как было до AsyncOpenAI — блокирующий вызов прямо в корутине
+    async def blocking_agenerate(self, *a, **kw):
+        return self.generate_response(*a, **kw)
+
+    original = LLMManager.agenerate_response
+    LLMManager.agenerate_response = blocking_agenerate
+    try:
+        sync_sec = asyncio.run(run_load(args.users, args.messages))
+    finally:
+        LLMManager.agenerate_response = original
+    print(f"{'sync':<6} {sync_sec:>8.2f} {total / sync_sec:>8.1f}")
+
+    for state in states:
+        state['memory'].clear()
+    telegram_bot.llm_semaphore = asyncio.Semaphore(args.limit)
+    async_sec = asyncio.run(run_load(args.users, args.messages))
+    print(f"{'async':<6} {async_sec:>8.2f} {total / async_sec:>8.1f}")
+    print(f"speedup: {sync_sec / async_sec:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# benchmarks/chunking_benchmark.py
+"""
+Нарезка на чанки: окно CHUNK_SIZE символов (chars) против чанкера по предложениям
+и токенам модели эмбеддингов (tokens).
+
+Для каждой стратегии: чанков/с и МБ текста/с, средний размер чанка в токенах,
+заполнение окна модели (токены чанка / CHUNK_MAX_TOKENS), доля чанков длиннее окна
+(их хвост модель молча обрежет) и доля чанков, заканчивающихся концом предложения.
+Токены для обеих стратегий считаются одним и тем же токенайзером модели.
+
+    python benchmarks/chunking_benchmark.py --paragraphs 2000
+    python benchmarks/chunking_benchmark.py --file docs/manual.txt
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services.chunking import CharChunker, TokenChunker, get_token_counter
+from app.services.document_parser import iter_segments
+
+WORDS = (
+    "документ индекс поиск модель вектор запрос ответ данные файл текст система "
+    "пользователь сервер память диск сеть кластер задача очередь отчёт договор "
+    "index search model vector query answer data file text system user server memory"
+).split()
+
+
+def make_document(rng: random.Random, paragraphs: int) -> str:
+    def sentence():
+        words = [rng.choice(WORDS) for _ in range(rng.randint(4, 28))]
+        return ' '.join(words).capitalize() + rng.choice('...!?')
+
+    return '\n\n'.join(' '.join(sentence() for _ in range(rng.randint(1, 9))) for _ in range(paragraphs))
+
+
+def measure(chunker, segments: list, count_tokens, max_tokens: int, repeats: int) -> dict:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        chunks = [chunk for chunk, _ in chunker(segments)]
+    elapsed = (time.perf_counter() - started) / repeats
+
+    tokens = np.array([len(count_tokens(chunk)) for chunk in chunks])
+    chars = sum(len(text) for _, text in segments)
+    return {
+        'chunks': len(chunks),
+        'chunks_per_sec': len(chunks) / elapsed,
+        'mb_per_sec': chars / elapsed / 1e6,
+        'avg_tokens': tokens.mean(),
+        'fill': np.minimum(tokens / max_tokens, 1.0).mean(),
+        'over_window': (tokens > max_tokens).mean(),
+        'sentence_end': np.mean([chunk[-1] in '.!?…' for chunk in chunks]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нарезка на чанки: chars против tokens.')
+    parser.add_argument('--file', help='TXT/PDF/DOCX для нарезки (по умолчанию — синтетический текст)')
+    parser.add_argument('--paragraphs', type=int, default=2000, help='Абзацев в синтетическом документе')
+    parser.add_argument('--max-tokens', type=int, default=Config.CHUNK_MAX_TOKENS)
+    parser.add_argument('--overlap-tokens', type=int, default=Config.CHUNK_OVERLAP_TOKENS)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.file:
+        segments = list(iter_segments(args.file))
+    else:
+        segments = [(None, make_document(random.Random(0), args.paragraphs))]
+
+    count_tokens = get_token_counter(Config.EMBEDDING_MODEL, Config.EMBEDDING_CACHE_FOLDER)
+    strategies = (
+        ('chars', CharChunker(Config.CHUNK_SIZE, Config.CHUNK_OVERLAP)),
+        ('tokens', TokenChunker(args.max_tokens, args.overlap_tokens,
+                                Config.EMBEDDING_MODEL, Config.EMBEDDING_CACHE_FOLDER)),
+    )
+
+    print(f"{sum(len(text) for _, text in segments) / 1e6:.2f}M chars, chars {Config.CHUNK_SIZE}/{Config.CHUNK_OVERLAP}, "
+          f"tokens {args.max_tokens}/{args.overlap_tokens}")
+    print(f"{'strategy':<9} {'chunks':>7} {'chunks/s':>10} {'MB/s':>6} {'avg tok':>8} {'fill':>6} "
+          f"{'over win':>9} {'sent end':>9}")
+    for name, chunker in strategies:
+        stats = measure(chunker, segments, count_tokens, args.max_tokens, args.repeats)
+        print(f"{name:<9} {stats['chunks']:>7} {stats['chunks_per_sec']:>10.0f} {stats['mb_per_sec']:>6.2f} "
+              f"{stats['avg_tokens']:>8.1f} {stats['fill']:>6.1%} {stats['over_window']:>9.1%} "
+              f"{stats['sentence_end']:>9.1%}")
+
+
+if __name__ == '__main__':
+    main()
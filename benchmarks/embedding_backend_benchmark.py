@@ -0,0 +1,82 @@
+# benchmarks/embedding_backend_benchmark.py
+"""
+Пропускная способность бэкендов модели эмбеддингов на CPU: torch, torch_int8,
+onnx, onnx_int8 (см. EMBEDDING_BACKEND).
+
+Для каждого бэкенда — время загрузки, задержка одиночного запроса (как поиск
+в /api/chat) и тексты/с при кодировании чанков батчами (как индексация).
+
+    python benchmarks/embedding_backend_benchmark.py --threads 4 --batch 1 16 64
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services.embedding_service import EmbeddingService, EMBEDDING_BACKENDS
+
+WORDS = (
+    "документ индекс поиск модель вектор запрос ответ данные файл текст система "
+    "пользователь сервер память диск сеть кластер задача очередь отчёт договор "
+    "index search model vector query answer data file text system user server memory"
+).split()
+
+
+def make_text(rng: random.Random, n_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пропускная способность бэкендов эмбеддингов.')
+    parser.add_argument('--backends', nargs='+', default=list(EMBEDDING_BACKENDS), choices=EMBEDDING_BACKENDS)
+    parser.add_argument('--texts', type=int, default=512, help='Чанков для кодирования батчами')
+    parser.add_argument('--queries', type=int, default=100, help='Одиночных запросов')
+    parser.add_argument('--batch', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('--threads', type=int, default=Config.EMBEDDING_NUM_THREADS, help='0 — все ядра')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    chunks = [make_text(rng, 100) for _ in range(args.texts)]
+    queries = [make_text(rng, 8) for _ in range(args.queries)]
+
+    print(f"model {Config.EMBEDDING_MODEL}, threads {args.threads or 'default'}")
+    header = f"{'backend':<11} {'load s':>7} {'query p50 ms':>13} {'query p99 ms':>13}"
+    header += ''.join(f" {f'batch {b} t/s':>14}" for b in args.batch)
+    print(header)
+    for backend in args.backends:
+        service = EmbeddingService(Config.EMBEDDING_MODEL, cache_folder=Config.EMBEDDING_CACHE_FOLDER,
+                                   batching=False, backend=backend, onnx_file=Config.EMBEDDING_ONNX_FILE,
+                                   num_threads=args.threads)
+        try:
+            service.encode(queries[0])  # загрузка + прогрев
+        except Exception as e:
+            print(f"{backend:<11} unavailable: {e}")
+            continue
+
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            service.encode(query)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        row = f"{backend:<11} {service.load_time:>7.2f} {np.percentile(latencies, 50):>13.2f} {np.percentile(latencies, 99):>13.2f}"
+        for batch_size in args.batch:
+            started = time.perf_counter()
+            service.encode(chunks, batch_size=batch_size)
+            row += f" {args.texts / (time.perf_counter() - started):>14.1f}"
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# benchmarks/embedding_batching_benchmark.py
+"""
+Пропускная способность и p99 кодирования запросов при разном числе параллельных
+клиентов: каждый вызов encode идёт в модель сам по себе (direct) против
+микробатчинга EmbeddingBatcher (batched).
+
+Каждый поток кодирует --requests одиночных запросов подряд, как /api/chat.
+С --ingest параллельно идёт индексация (bulk-encode больших списков чанков) —
+видно, насколько запросы пользователей обгоняют её благодаря приоритету.
+
+    python benchmarks/embedding_batching_benchmark.py --concurrency 1 4 16 64 --requests 50
+    python benchmarks/embedding_batching_benchmark.py --concurrency 16 --ingest
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services.embedding_service import EmbeddingService
+from app.services.embedding_batcher import PRIORITY_BULK
+
+WORDS = (
+    "документ индекс поиск модель вектор запрос ответ данные файл текст система "
+    "пользователь сервер память диск сеть кластер задача очередь отчёт договор "
+    "index search model vector query answer data file text system user server memory"
+).split()
+
+
+def make_text(rng: random.Random, n_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def run_level(service: EmbeddingService, concurrency: int, requests: int, ingest: bool) -> dict:
+    stop = threading.Event()
+
+    def ingest_loop():
+        rng = random.Random(1)
+        while not stop.is_set():
+            service.encode([make_text(rng, 80) for _ in range(256)], priority=PRIORITY_BULK)
+
+    def client(seed: int):
+        rng = random.Random(seed)
+        latencies = []
+        for _ in range(requests):
+            query = make_text(rng, 8)
+            started = time.perf_counter()
+            service.encode(query)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    ingester = threading.Thread(target=ingest_loop, daemon=True) if ingest else None
+    if ingester:
+        ingester.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    if ingester:
+        ingester.join()
+
+    latencies = np.array([latency for result in results for latency in result]) * 1000
+    return {
+        'qps': len(latencies) / elapsed,
+        'p50': np.percentile(latencies, 50),
+        'p99': np.percentile(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробатчинг эмбеддингов: direct против batched.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help='Число параллельных клиентов')
+    parser.add_argument('--requests', type=int, default=50, help='Запросов на одного клиента')
+    parser.add_argument('--max-batch', type=int, default=Config.EMBEDDING_MAX_BATCH)
+    parser.add_argument('--wait-ms', type=float, default=Config.EMBEDDING_BATCH_WAIT_MS)
+    parser.add_argument('--ingest', action='store_true', help='Параллельно кодировать чанки как при индексации')
+    args = parser.parse_args()
+
+    direct = EmbeddingService(Config.EMBEDDING_MODEL, cache_folder=Config.EMBEDDING_CACHE_FOLDER,
+                              batch_size=Config.EMBEDDING_BATCH_SIZE, batching=False)
+    batched = EmbeddingService(Config.EMBEDDING_MODEL, cache_folder=Config.EMBEDDING_CACHE_FOLDER,
+                               batch_size=Config.EMBEDDING_BATCH_SIZE, max_batch=args.max_batch,
+                               batch_wait_ms=args.wait_ms)
+    # Одни и те же веса для обоих режимов
+    batched._model = direct.model
+    direct.encode(make_text(random.Random(0), 8))  # прогрев
+
+    print(f"model {Config.EMBEDDING_MODEL}, max_batch {args.max_batch}, wait {args.wait_ms} ms"
+          f"{', with background ingestion' if args.ingest else ''}")
+    print(f"{'clients':>7} {'mode':<8} {'q/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for concurrency in args.concurrency:
+        for mode, service in (('direct', direct), ('batched', batched)):
+            stats = run_level(service, concurrency, args.requests, args.ingest)
+            print(f"{concurrency:>7} {mode:<8} {stats['qps']:>9.1f} {stats['p50']:>8.1f} {stats['p99']:>8.1f}")
+    print(f"batcher: {batched.batcher.get_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# benchmarks/embedding_parity_check.py
+"""
+Проверка совпадения эмбеддингов бэкендов с эталонным PyTorch.
+
+Индекс FAISS построен эмбеддингами одного бэкенда, а запросы после смены
+EMBEDDING_BACKEND кодирует другой. Переиндексация не нужна, если векторы почти
+совпадают. Скрипт считает для каждого бэкенда:
+- косинус между его эмбеддингом и эмбеддингом torch для каждого текста (mean / min);
+- overlap@k — долю общих top-k соседей, когда запросы кодирует проверяемый бэкенд,
+  а корпус — torch (как в уже построенном индексе).
+Если минимальный косинус ниже --threshold, код выхода 1.
+
+    python benchmarks/embedding_parity_check.py --backends torch_int8 onnx onnx_int8 --threshold 0.99
+"""
+
+import os
+import sys
+import random
+import argparse
+
+import numpy as np
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services.embedding_service import EmbeddingService, EMBEDDING_BACKENDS
+
+WORDS = (
+    "документ индекс поиск модель вектор запрос ответ данные файл текст система "
+    "пользователь сервер память диск сеть кластер задача очередь отчёт договор "
+    "index search model vector query answer data file text system user server memory"
+).split()
+
+
+def make_text(rng: random.Random, n_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(queries: np.ndarray, corpus: np.ndarray, k: int) -> np.ndarray:
+    return np.argsort(-(queries @ corpus.T), axis=1)[:, :k]
+
+
+def make_service(backend: str, threads: int) -> EmbeddingService:
+    return EmbeddingService(Config.EMBEDDING_MODEL, cache_folder=Config.EMBEDDING_CACHE_FOLDER,
+                            batch_size=Config.EMBEDDING_BATCH_SIZE, batching=False, backend=backend,
+                            onnx_file=Config.EMBEDDING_ONNX_FILE, num_threads=threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Совпадение эмбеддингов бэкендов с PyTorch.')
+    parser.add_argument('--backends', nargs='+', default=['torch_int8', 'onnx', 'onnx_int8'],
+                        choices=[b for b in EMBEDDING_BACKENDS if b != 'torch'])
+    parser.add_argument('--corpus', type=int, default=1000, help='Число чанков корпуса')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.99, help='Минимально допустимый косинус')
+    parser.add_argument('--threads', type=int, default=Config.EMBEDDING_NUM_THREADS)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    corpus = [make_text(rng, rng.randint(40, 120)) for _ in range(args.corpus)]
+    queries = [make_text(rng, rng.randint(3, 12)) for _ in range(args.queries)]
+
+    reference = make_service('torch', args.threads)
+    ref_corpus = normalize(reference.encode(corpus))
+    ref_queries = normalize(reference.encode(queries))
+    ref_top = top_k(ref_queries, ref_corpus, args.k)
+
+    print(f"model {Config.EMBEDDING_MODEL}, {args.corpus} chunks, {args.queries} queries, k={args.k}")
+    print(f"{'backend':<11} {'cos mean':>9} {'cos min':>9} {f'overlap@{args.k}':>11}")
+    failed = []
+    for backend in args.backends:
+        try:
+            service = make_service(backend, args.threads)
+            cand_corpus = normalize(service.encode(corpus))
+            cand_queries = normalize(service.encode(queries))
+        except Exception as e:
+            print(f"{backend:<11} unavailable: {e}")
+            failed.append(backend)
+            continue
+        cosines = np.concatenate([
+            np.sum(cand_corpus * ref_corpus, axis=1),
+            np.sum(cand_queries * ref_queries, axis=1)
+        ])
+        # Запросы — новым бэкендом, корпус — старым: так ищет уже построенный индекс
+        cand_top = top_k(cand_queries, ref_corpus, args.k)
+        overlap = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(ref_top, cand_top)])
+        print(f"{backend:<11} {cosines.mean():>9.5f} {cosines.min():>9.5f} {overlap:>11.3f}")
+        if cosines.min() < args.threshold:
+            failed.append(backend)
+
+    if failed:
+        print(f"FAIL (cos < {args.threshold} or unavailable): {', '.join(failed)} — после смены бэкенда переиндексируйте документы")
+        return 1
+    print(f"OK: all backends match torch (cos >= {args.threshold}), re-indexing is not needed")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
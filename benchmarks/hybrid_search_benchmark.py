@@ -0,0 +1,123 @@
+# benchmarks/hybrid_search_benchmark.py
+"""
+Задержка и качество поиска: только FAISS, только BM25 (FTS5 в хранилище чанков)
+и гибридный поиск с reciprocal rank fusion (RAG_LEXICAL_WEIGHT).
+
+Каждый синтетический чанк содержит уникальный артикул (например, KX-4821.07).
+Половина запросов — «артикул + пара слов», где нужен ровно этот чанк: на них
+видно, как плотный поиск теряет точные идентификаторы. Вторая половина — обычные
+запросы из слов словаря (только задержка). Кэши запросов отключены.
+
+    python benchmarks/hybrid_search_benchmark.py --chunks 5000 --queries 200 --weight 0.3
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+import numpy as np
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services.embedding_service import build_embedding_service
+from app.services.vector_db import VectorDB
+from app.services.rag_engine import RAGEngine
+
+WORDS = (
+    "документ индекс поиск модель вектор запрос ответ данные файл текст система "
+    "пользователь сервер память диск сеть кластер задача очередь отчёт договор "
+    "index search model vector query answer data file text system user server memory"
+).split()
+
+
+def make_text(rng: random.Random, n_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def make_code(rng: random.Random) -> str:
+    letters = ''.join(rng.choice('ABCDEFGHKMPRTX') for _ in range(2))
+    return f"{letters}-{rng.randint(1000, 9999)}.{rng.randint(0, 99):02d}"
+
+
+def build_index(index_dir: str, n_chunks: int, rng: random.Random):
+    service = build_embedding_service(vars(Config))
+    vector_db = VectorDB(index_path=index_dir, embedding_model_name=Config.EMBEDDING_MODEL,
+                         embedding_service=service, index_type=Config.FAISS_INDEX_TYPE)
+    vector_db.initialize_index()
+
+    codes = [make_code(rng) for _ in range(n_chunks)]
+    texts = [f"{make_text(rng, 30)} артикул {code} {make_text(rng, 30)}" for code in codes]
+    metadata = [{'doc_id': i // 100 + 1, 'chunk_no': i % 100, 'text': text} for i, text in enumerate(texts)]
+    vector_db.add_embeddings(service.encode(texts), metadata)
+    return vector_db, codes, metadata
+
+
+def make_engine(vector_db, weight: float) -> RAGEngine:
+    return RAGEngine(vector_db, Config.EMBEDDING_MODEL, Config.CHUNK_SIZE, Config.CHUNK_OVERLAP, min_score=0.0,
+                     query_cache_size=0, retrieval_cache_size=0, lexical_weight=weight,
+                     lexical_min_score=Config.RAG_LEXICAL_MIN_SCORE, rrf_k=Config.RAG_RRF_K,
+                     hybrid_candidates=Config.RAG_HYBRID_CANDIDATES)
+
+
+def measure(search, queries):
+    """search(query) -> список (doc_id, chunk_no); возвращает задержки в мс и результаты."""
+    latencies, found = [], []
+    for query in queries:
+        started = time.perf_counter()
+        found.append(search(query))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return np.array(latencies), found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Векторный, BM25 и гибридный поиск: задержка и hit@k.')
+    parser.add_argument('--chunks', type=int, default=5000, help='Число чанков в индексе')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--weight', type=float, default=Config.RAG_LEXICAL_WEIGHT, help='Вес BM25 в слиянии')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as index_dir:
+        started = time.perf_counter()
+        vector_db, codes, metadata = build_index(index_dir, args.chunks, rng)
+        print(f"Index: {args.chunks} chunks, built in {time.perf_counter() - started:.1f}s")
+
+        targets = rng.sample(range(args.chunks), args.queries // 2)
+        code_queries = [f"{codes[i]} {make_text(rng, 2)}" for i in targets]
+        plain_queries = [make_text(rng, 8) for _ in range(args.queries - len(code_queries))]
+        queries = code_queries + plain_queries
+        expected = [(metadata[i]['doc_id'], metadata[i]['chunk_no']) for i in targets]
+
+        dense = make_engine(vector_db, 0.0)
+        hybrid = make_engine(vector_db, args.weight)
+        # Прогрев: загрузка модели и первый вызов FAISS / FTS5 не попадают в замер
+        hybrid.search_similar(queries[0], k=args.k)
+
+        modes = {
+            'dense': lambda q: [(h['doc_id'], h['chunk_no']) for h in dense.search_similar(q, k=args.k)],
+            'bm25': lambda q: [(m['doc_id'], m['chunk_no'])
+                               for m in vector_db.search_lexical_batch([q], k=args.k)[0][1]],
+            f'hybrid w={args.weight}': lambda q: [(h['doc_id'], h['chunk_no'])
+                                                  for h in hybrid.search_similar(q, k=args.k)],
+        }
+        print(f"{'mode':<14} {'p50 ms':>8} {'p99 ms':>8} {'queries/s':>10} {f'code hit@{args.k}':>12}")
+        for name, search in modes.items():
+            latencies, found = measure(search, queries)
+            hit = np.mean([target in hits for target, hits in zip(expected, found)]) if expected else 0.0
+            print(f"{name:<14} {np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} "
+                  f"{len(queries) / (latencies.sum() / 1000):>10.1f} {hit:>12.2%}")
+
+        vector_db.wal.close()
+
+
+if __name__ == '__main__':
+    main()
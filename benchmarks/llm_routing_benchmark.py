@@ -0,0 +1,109 @@
+# benchmarks/llm_routing_benchmark.py
+"""
+Хвост латентности и доля ошибок LLM-запросов в режимах single / fallback / hedged.
+
+HTTP-вызовы провайдеров замоканы: у yandex_gpt обычно быстрый ответ, но с
+тяжёлым хвостом (--slow-rate медленных) и долей ошибок (--error-rate), у
+local_llm — ровная задержка. Запросы идут через LLMManager.generate_response
+из нескольких потоков, как в веб-роутах.
+
+    python benchmarks/llm_routing_benchmark.py --requests 400 --threads 8
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services import llm_routing
+from app.services.llm_manager import LLMManager
+
+
+def mock_providers(llm_manager: LLMManager, args):
+    def yandex_create(**kwargs):
+        roll = random.random()
+        if roll < args.error_rate:
+            time.sleep(args.fast)
+            raise ConnectionError('mocked Yandex GPT failure')
+        time.sleep(args.slow if roll < args.error_rate + args.slow_rate else args.fast)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='yandex'))])
+
+    def local_create(**kwargs):
+        time.sleep(args.local)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='local'))])
+
+    for name, create in (('yandex_gpt', yandex_create), ('local_llm', local_create)):
+        llm_manager.providers[name].client = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+        )
+
+
+def run_mode(mode: str, args) -> dict:
+    config = {key: getattr(Config, key) for key in dir(Config) if not key.startswith('__')}
+    config.update(YANDEX_API_KEY='test', YANDEX_FOLDER_ID='test', RESPONSE_CACHE_ENABLED=False,
+                  LLM_MAX_RETRIES=0, LLM_ROUTING_MODE=mode, LLM_FALLBACK_CHAIN=['yandex_gpt', 'local_llm'],
+                  LLM_CIRCUIT_FAILURES=args.circuit_failures, LLM_HEDGE_MIN_DELAY_SEC=args.hedge_min_delay)
+    # Статистика латентности и breaker'ы общие для процесса — каждый режим с чистого листа
+    llm_routing._health.clear()
+    llm_manager = LLMManager(config)
+    mock_providers(llm_manager, args)
+
+    def send(i: int):
+        started = time.perf_counter()
+        try:
+            result = llm_manager.generate_response(f"вопрос {i}", model='yandex_gpt')
+            return time.perf_counter() - started, result['model_used']
+        except RuntimeError:
+            return time.perf_counter() - started, None
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(send, range(args.requests)))
+
+    latencies = np.array([elapsed for elapsed, _ in results]) * 1000
+    answered = [model for _, model in results if model]
+    return {
+        'p50': np.percentile(latencies, 50),
+        'p95': np.percentile(latencies, 95),
+        'p99': np.percentile(latencies, 99),
+        'errors': len(results) - len(answered),
+        'local': answered.count('local_llm'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Латентность LLM-запросов: single, fallback, hedged.')
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--fast', type=float, default=0.05, help='Обычный ответ yandex_gpt, с')
+    parser.add_argument('--slow', type=float, default=1.0, help='Медленный ответ yandex_gpt, с')
+    parser.add_argument('--slow-rate', type=float, default=0.04)
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--local', type=float, default=0.15, help='Ответ local_llm, с')
+    # Задержки замоканы в десятки раз короче настоящих, поэтому и нижняя граница hedge-задержки меньше
+    parser.add_argument('--hedge-min-delay', type=float, default=0.02, help='LLM_HEDGE_MIN_DELAY_SEC, с')
+    parser.add_argument('--circuit-failures', type=int, default=Config.LLM_CIRCUIT_FAILURES)
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests, {args.threads} threads; yandex_gpt {args.fast}s "
+          f"({args.slow_rate:.0%} at {args.slow}s, {args.error_rate:.0%} errors), local_llm {args.local}s")
+    print(f"{'mode':<9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'by local':>9}")
+    for mode in ('single', 'fallback', 'hedged'):
+        stats = run_mode(mode, args)
+        print(f"{mode:<9} {stats['p50']:>8.0f} {stats['p95']:>8.0f} {stats['p99']:>8.0f} "
+              f"{stats['errors']:>7} {stats['local']:>9}")
+
+
+if __name__ == '__main__':
+    main()
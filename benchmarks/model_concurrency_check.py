@@ -0,0 +1,114 @@
+# benchmarks/model_concurrency_check.py
+"""
+Проверка выбора модели под параллельной нагрузкой.
+
+Две сессии чата с разными моделями (yandex_gpt и local_llm) одновременно шлют
+запросы в POST /api/chat из нескольких потоков. HTTP-вызовы провайдеров
+замоканы случайной задержкой, а ответ содержит id модели, на которую ушёл
+запрос. Каждый ответ должен прийти от модели своей сессии — и в 'model_used',
+и в тексте. Любое расхождение — ошибка, код выхода 1.
+
+    python benchmarks/model_concurrency_check.py --requests 200 --threads 16
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+# БД, индекс и логи — во временной папке, рабочие данные проекта не трогаем
+work_dir = tempfile.mkdtemp(prefix='model_concurrency_')
+os.environ['DATABASE_URL'] = f"sqlite:///{work_dir}/database.db"
+os.environ.setdefault('YANDEX_API_KEY', 'test')
+os.environ.setdefault('YANDEX_FOLDER_ID', 'test')
+os.environ['RESPONSE_CACHE_ENABLED'] = '0'
+os.chdir(work_dir)
+
+from config import Config
+
+Config.FAISS_INDEX_PATH = os.path.join(work_dir, 'faiss_index')
+Config.DOCUMENTS_FOLDER = os.path.join(work_dir, 'documents')
+os.makedirs(Config.DOCUMENTS_FOLDER, exist_ok=True)
+
+from app import create_app, db
+from app.models import User, ChatSession
+from app.services.llm_manager import get_llm_providers
+
+
+def mock_provider_clients(providers: dict, max_latency: float):
+    """Ответ провайдера — id модели, на которую пришёл запрос."""
+    def create(**kwargs):
+        time.sleep(random.uniform(0, max_latency))
+        content = f"answered-by {kwargs['model']}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    for provider in providers.values():
+        provider.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Параллельные запросы к двум моделям через /api/chat.')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.05, help='Максимальная задержка замоканной LLM, с')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        providers = get_llm_providers(app.config)
+        if set(providers) != {'yandex_gpt', 'local_llm'}:
+            print(f"Нужны обе модели, доступны: {list(providers)}")
+            return 1
+        user = User(username='concurrency-check')
+        db.session.add(user)
+        db.session.commit()
+        sessions = {}
+        for model_name in providers:
+            session = ChatSession(user_id=user.id, title=model_name, model_used=model_name)
+            db.session.add(session)
+            db.session.commit()
+            sessions[model_name] = session.id
+    mock_provider_clients(providers, args.latency)
+    model_ids = {
+        'yandex_gpt': providers['yandex_gpt'].model,
+        'local_llm': providers['local_llm'].model_name,
+    }
+
+    def send(i: int):
+        model_name = 'yandex_gpt' if i % 2 else 'local_llm'
+        response = app.test_client().post('/api/chat', json={'message': f'q{i}', 'session_id': sessions[model_name]})
+        data = response.get_json()
+        if response.status_code != 200:
+            return model_name, f"HTTP {response.status_code}: {data}"
+        if data['model_used'] != model_name or data['response'] != f"answered-by {model_ids[model_name]}":
+            return model_name, f"got model_used={data['model_used']}, response={data['response']!r}"
+        return model_name, None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    errors = [(model_name, error) for model_name, error in results if error]
+    print(f"{args.requests} requests, {args.threads} threads, {elapsed:.2f}s ({args.requests / elapsed:.1f} req/s)")
+    for model_name in sessions:
+        failed = sum(1 for name, _ in errors if name == model_name)
+        total = sum(1 for name, _ in results if name == model_name)
+        print(f"  {model_name:<11} {total - failed}/{total} answered by the right model")
+    for model_name, error in errors[:10]:
+        print(f"  ERROR [{model_name}] {error}")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+# benchmarks/parse_pool_benchmark.py
+"""
+Скорость разбора PDF на чанки: в потоке индексации (inline) против пула процессов
+(PARSE_WORKERS). Генерирует --docs синтетических PDF по --pages страниц.
+
+Параллельно с разбором поток-«веб-запрос» каждые 10 мс выполняет небольшую
+CPU-работу на Python и меряет её задержку: при inline-разборе PyPDF2 держит GIL,
+и p99 этого потока растёт; в пуле процессов GIL веб-сервера свободен.
+
+    python benchmarks/parse_pool_benchmark.py --docs 8 --pages 120 --workers 1 2 4
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+import numpy as np
+
+# === ДОБАВЛЯЕМ КОРЕНЬ ПРОЕКТА В sys.path ===
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+# =================================================
+
+from config import Config
+from app.services.chunking import build_chunker
+from app.services.document_parser import (iter_segments, iter_parsed_chunks, submit_parsing, get_parse_pool,
+                                          get_parse_manager)
+
+WORDS = (
+    "document index search model vector query answer data file text system "
+    "user server memory disk network cluster task queue report contract"
+).split()
+
+
+def make_pdf(path: str, pages_text):
+    """Минимальный PDF: страница — список строк текста шрифтом Helvetica."""
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        ('<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages_text))), len(pages_text))).encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for i, lines in enumerate(pages_text):
+        body = ('BT /F1 10 Tf 12 TL 40 800 Td ' + ' '.join(f'({line}) Tj T*' for line in lines) + ' ET').encode('latin-1')
+        objects.append((f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                        f'/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>').encode())
+        objects.append(b'<< /Length %d >>\nstream\n' % len(body) + body + b'\nendstream')
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n'.encode() + obj + b'\nendobj\n'
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    for offset in offsets:
+        out += f'{offset:010d} 00000 n \n'.encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    with open(path, 'wb') as f:
+        f.write(bytes(out))
+
+
+def make_corpus(directory: str, docs: int, pages: int) -> list:
+    rng = random.Random(0)
+    paths = []
+    for n in range(docs):
+        path = os.path.join(directory, f'doc_{n}.pdf')
+        make_pdf(path, [[' '.join(rng.choice(WORDS) for _ in range(12)) for _ in range(60)]
+                        for _ in range(pages)])
+        paths.append(path)
+    return paths
+
+
+def probe_loop(stop: threading.Event, latencies: list):
+    """Имитация обработчика запроса: короткая CPU-работа на Python раз в 10 мс."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        sum(i * i for i in range(2000))
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.01)
+
+
+def run(paths: list, chunker, workers: int, pages_per_task: int) -> dict:
+    latencies = []
+    stop = threading.Event()
+    prober = threading.Thread(target=probe_loop, args=(stop, latencies), daemon=True)
+    chunks = 0
+    pool = get_parse_pool(workers)
+    if pool is not None:
+        # Прогрев: старт spawn-процессов не входит в замер
+        list(pool.map(abs, range(workers * 4)))
+        get_parse_manager()
+
+    prober.start()
+    started = time.perf_counter()
+    if pool is None:
+        for path in paths:
+            chunks += sum(1 for _ in chunker(iter_segments(path)))
+    else:
+        parsing = [submit_parsing(pool, path, chunker, pages_per_task) for path in paths]
+        for tasks in parsing:
+            chunks += sum(1 for _ in iter_parsed_chunks(tasks))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    prober.join()
+    if pool is not None:
+        pool.shutdown()
+        # Следующий замер получит новый пул нужного размера
+        import app.services.document_parser as document_parser
+        document_parser._pool = None
+
+    probe = np.array(latencies) * 1000
+    return {
+        'elapsed': elapsed,
+        'chunks': chunks,
+        'p50': np.percentile(probe, 50),
+        'p99': np.percentile(probe, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Разбор PDF: inline против пула процессов.')
+    parser.add_argument('--docs', type=int, default=8, help='Число PDF')
+    parser.add_argument('--pages', type=int, default=120, help='Страниц в каждом PDF')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Размеры пула')
+    parser.add_argument('--pages-per-task', type=int, default=Config.PARSE_PAGES_PER_TASK)
+    args = parser.parse_args()
+    chunker = build_chunker(vars(Config))
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_corpus(directory, args.docs, args.pages)
+        total_pages = args.docs * args.pages
+        print(f"{args.docs} PDF x {args.pages} pages, chunking '{chunker.strategy}', "
+              f"{args.pages_per_task} pages per task, {os.cpu_count()} CPU")
+        print(f"{'mode':<10} {'pages/s':>9} {'chunks':>8} {'probe p50 ms':>13} {'probe p99 ms':>13}")
+        for workers in [0] + args.workers:
+            stats = run(paths, chunker, workers, args.pages_per_task)
+            mode = 'inline' if workers == 0 else f'pool x{workers}'
+            print(f"{mode:<10} {total_pages / stats['elapsed']:>9.1f} {stats['chunks']:>8} "
+                  f"{stats['p50']:>13.2f} {stats['p99']:>13.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -28,13 +28,139 @@ class Config:
     OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL') or 'http://localhost:11434'
     LOCAL_MODEL_NAME = os.environ.get('LOCAL_MODEL_NAME', 'local_llm') 
 
+    # === HTTP-клиенты LLM (общий пул keep-alive соединений на процесс) ===
+    LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get('LLM_HTTP_MAX_CONNECTIONS', 100))
+    LLM_HTTP_MAX_KEEPALIVE = int(os.environ.get('LLM_HTTP_MAX_KEEPALIVE', 20))
+    LLM_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_HTTP_KEEPALIVE_EXPIRY', 30))   # сек
+    LLM_HTTP_TIMEOUT = float(os.environ.get('LLM_HTTP_TIMEOUT', 120))                    # сек, весь запрос
+    LLM_HTTP_CONNECT_TIMEOUT = float(os.environ.get('LLM_HTTP_CONNECT_TIMEOUT', 10))
+    LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))                      # только при LLM_ROUTING_MODE=single
+
+    # === Маршрутизация запросов к LLM ===
+    # single — только модель сессии; fallback — при ошибке или таймауте запрос уходит
+    # следующей модели из LLM_FALLBACK_CHAIN; hedged — как fallback, но если модель не
+    # ответила за свой p95, следующая запускается параллельно и берётся первый ответ
+    LLM_ROUTING_MODE = os.environ.get('LLM_ROUTING_MODE', 'single')
+    LLM_FALLBACK_CHAIN = [name.strip() for name in os.environ.get('LLM_FALLBACK_CHAIN', 'yandex_gpt,local_llm').split(',')
+                          if name.strip()]
+    LLM_PROVIDER_TIMEOUTS = {                                                            # сек, на один запрос
+        'yandex_gpt': float(os.environ.get('YANDEX_GPT_TIMEOUT', LLM_HTTP_TIMEOUT)),
+        'local_llm': float(os.environ.get('LOCAL_LLM_TIMEOUT', LLM_HTTP_TIMEOUT)),
+    }
+    LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', 95))
+    LLM_HEDGE_DELAY_SEC = float(os.environ.get('LLM_HEDGE_DELAY_SEC', 3.0))          # пока нет статистики латентности
+    LLM_HEDGE_MIN_DELAY_SEC = float(os.environ.get('LLM_HEDGE_MIN_DELAY_SEC', 0.2))
+    LLM_HEDGE_WORKERS = int(os.environ.get('LLM_HEDGE_WORKERS', 32))                 # потоки для попыток fallback / hedged
+    LLM_LATENCY_WINDOW = int(os.environ.get('LLM_LATENCY_WINDOW', 200))              # замеров для p95
+    # Circuit breaker: после N ошибок подряд модель пропускается LLM_CIRCUIT_RESET_SEC секунд
+    LLM_CIRCUIT_FAILURES = int(os.environ.get('LLM_CIRCUIT_FAILURES', 5))
+    LLM_CIRCUIT_RESET_SEC = float(os.environ.get('LLM_CIRCUIT_RESET_SEC', 30))
+
     # === Telegram Bot ===
     TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+    # Сколько запросов к LLM бот выполняет одновременно (остальные ждут своей очереди)
+    BOT_MAX_CONCURRENT_REQUESTS = int(os.environ.get('BOT_MAX_CONCURRENT_REQUESTS', 16))
+    # Состояния пользователей бота в памяти: не больше BOT_USER_STATES_SIZE, простаивающие дольше TTL забываются
+    BOT_USER_STATES_SIZE = int(os.environ.get('BOT_USER_STATES_SIZE', 10000))
+    BOT_USER_STATES_TTL_SEC = float(os.environ.get('BOT_USER_STATES_TTL_SEC', 86400))
     
     # === RAG ===
     EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+    EMBEDDING_CACHE_FOLDER = os.environ.get('EMBEDDING_CACHE_FOLDER') or os.path.expanduser("~/.cache/sentence_transformers")
+    EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+    # torch | torch_int8 | onnx | onnx_int8 — те же веса, переиндексация при смене не нужна,
+    # если benchmarks/embedding_parity_check.py проходит
+    EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch')
+    EMBEDDING_ONNX_FILE = os.environ.get('EMBEDDING_ONNX_FILE')                    # None — model.onnx / model_qint8_avx2.onnx
+    EMBEDDING_NUM_THREADS = int(os.environ.get('EMBEDDING_NUM_THREADS', 0))        # потоки torch / ONNX Runtime, 0 — все ядра
+    # Микробатчинг: параллельные вызовы модели собираются в один проход
+    EMBEDDING_BATCHING_ENABLED = os.environ.get('EMBEDDING_BATCHING_ENABLED', '1').lower() not in ('0', 'false', 'no')
+    EMBEDDING_MAX_BATCH = int(os.environ.get('EMBEDDING_MAX_BATCH', 64))          # текстов в одном проходе
+    EMBEDDING_BATCH_WAIT_MS = float(os.environ.get('EMBEDDING_BATCH_WAIT_MS', 5))  # сколько ждать попутчиков
+    # tokens — чанки из целых предложений/абзацев по токенам модели; chars — окно CHUNK_SIZE символов
+    CHUNK_STRATEGY = os.environ.get('CHUNK_STRATEGY', 'tokens')
     CHUNK_SIZE = 500
     CHUNK_OVERLAP = 50
+    CHUNK_MAX_TOKENS = int(os.environ.get('CHUNK_MAX_TOKENS', 254))        # окно all-MiniLM-L6-v2 (256) минус [CLS]/[SEP]
+    CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 32))
+
+    # === FAISS index ===
+    # flat | ivf_flat | hnsw | ivf_pq. Индекс растёт как flat и сам переходит на этот тип,
+    # когда число векторов достигает FAISS_PROMOTE_THRESHOLD
+    FAISS_INDEX_TYPE = os.environ.get('FAISS_INDEX_TYPE', 'flat')
+    FAISS_PROMOTE_THRESHOLD = int(os.environ.get('FAISS_PROMOTE_THRESHOLD', 50000))
+    FAISS_NLIST = int(os.environ['FAISS_NLIST']) if os.environ.get('FAISS_NLIST') else None  # None — ~4*sqrt(N)
+    FAISS_NPROBE = int(os.environ.get('FAISS_NPROBE', 16))       # IVF: сколько кластеров просматривать
+    FAISS_HNSW_M = int(os.environ.get('FAISS_HNSW_M', 32))
+    FAISS_EF_SEARCH = int(os.environ.get('FAISS_EF_SEARCH', 64))  # HNSW: ширина поиска
+    FAISS_PQ_M = int(os.environ.get('FAISS_PQ_M', 16))           # IVF-PQ: число подвекторов (делитель размерности)
+    # ip — косинус через inner product (для новых индексов), l2 — старое поведение
+    FAISS_METRIC = os.environ.get('FAISS_METRIC', 'ip')
+    # Доля удалённых, но физически не вычищенных векторов (HNSW), после которой индекс перестраивается
+    FAISS_COMPACTION_RATIO = float(os.environ.get('FAISS_COMPACTION_RATIO', 0.2))
+    # Изменения индекса пишутся в журнал (wal.log); полный снимок — когда журнал вырос или прошло время
+    FAISS_CHECKPOINT_WAL_MB = int(os.environ.get('FAISS_CHECKPOINT_WAL_MB', 64))
+    FAISS_CHECKPOINT_INTERVAL_SEC = int(os.environ.get('FAISS_CHECKPOINT_INTERVAL_SEC', 300))
+    # Поиск по области документов: до стольких векторов flat/HNSW ищутся точным перебором
+    # только этих векторов, больше — фильтром IDSelector внутри индекса
+    FAISS_FILTER_EXACT_MAX = int(os.environ.get('FAISS_FILTER_EXACT_MAX', 4096))
+    # Открывать снимок индекса через mmap (страницы общие для нескольких процессов).
+    # IVF — всегда; flat и HNSW — только с FAISS >= 1.9 (IO_FLAG_MMAP_IFC), иначе читаются в память
+    FAISS_MMAP = os.environ.get('FAISS_MMAP', '1').lower() not in ('0', 'false', 'no')
+
+    # === Retrieval ===
+    RAG_TOP_K = int(os.environ.get('RAG_TOP_K', 5))                       # максимум чанков в контексте
+    RAG_MIN_SCORE = float(os.environ.get('RAG_MIN_SCORE', 0.3))           # минимальная косинусная близость
+    RAG_RELATIVE_SCORE = float(os.environ.get('RAG_RELATIVE_SCORE', 0.75))  # доля от лучшего скора (адаптивный k)
+    # Гибридный поиск: BM25 по тексту чанков сливается с FAISS через reciprocal rank fusion.
+    # Вес BM25 в слиянии (0 — только векторный поиск). Отсечки применяются к каждому поиску до
+    # слияния: RAG_MIN_SCORE — к косинусу, RAG_LEXICAL_MIN_SCORE — к BM25, RAG_RELATIVE_SCORE —
+    # к каждому относительно его лучшего кандидата; скор слияния ранжирует, но не отсекает
+    RAG_LEXICAL_WEIGHT = float(os.environ.get('RAG_LEXICAL_WEIGHT', 0.3))
+    RAG_LEXICAL_MIN_SCORE = float(os.environ.get('RAG_LEXICAL_MIN_SCORE', 1.0))  # минимальный BM25
+    RAG_RRF_K = int(os.environ.get('RAG_RRF_K', 60))
+    RAG_HYBRID_CANDIDATES = int(os.environ.get('RAG_HYBRID_CANDIDATES', 20))  # кандидатов из каждого поиска
+    SEARCH_MAX_QUERIES = int(os.environ.get('SEARCH_MAX_QUERIES', 64))    # лимит запросов в POST /api/search
+    SEARCH_MAX_K = int(os.environ.get('SEARCH_MAX_K', 50))
+
+    # === КЭШ ЗАПРОСОВ ===
+    # Размер 0 отключает кэш
+    QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 1024))            # эмбеддинги запросов
+    QUERY_CACHE_TTL_SEC = float(os.environ.get('QUERY_CACHE_TTL_SEC', 3600))
+    RETRIEVAL_CACHE_SIZE = int(os.environ.get('RETRIEVAL_CACHE_SIZE', 1024))    # top-k результаты поиска
+    RETRIEVAL_CACHE_TTL_SEC = float(os.environ.get('RETRIEVAL_CACHE_TTL_SEC', 600))
+
+    # === СЕМАНТИЧЕСКИЙ КЭШ ОТВЕТОВ LLM ===
+    # Отдаёт сохранённый ответ той же модели на похожий вопрос с тем же RAG-контекстом
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+    RESPONSE_CACHE_THRESHOLD = float(os.environ.get('RESPONSE_CACHE_THRESHOLD', 0.95))  # косинусная близость вопросов
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+    RESPONSE_CACHE_TTL_SEC = float(os.environ.get('RESPONSE_CACHE_TTL_SEC', 86400))
+    # Сколько последних реплик диалога входит в ключ кэша: ответ с историей отдаётся только при той же истории
+    RESPONSE_CACHE_HISTORY_MESSAGES = int(os.environ.get('RESPONSE_CACHE_HISTORY_MESSAGES', 6))
+
+    # === ПАМЯТЬ ДИАЛОГА ===
+    # История, которая уходит в LLM: последние реплики в пределах бюджета токенов
+    CONVERSATION_MAX_TOKENS = int(os.environ.get('CONVERSATION_MAX_TOKENS', 1500))
+    CONVERSATION_MAX_TURNS = int(os.environ.get('CONVERSATION_MAX_TURNS', 20))
+    # Сворачивать вытесненные реплики в краткое содержание (лишний запрос к LLM)
+    CONVERSATION_SUMMARY_ENABLED = os.environ.get('CONVERSATION_SUMMARY_ENABLED', '0').lower() in ('1', 'true', 'yes')
+    CONVERSATION_SUMMARY_MAX_TOKENS = int(os.environ.get('CONVERSATION_SUMMARY_MAX_TOKENS', 200))
+    CONVERSATION_CACHE_SESSIONS = int(os.environ.get('CONVERSATION_CACHE_SESSIONS', 1000))  # сессий веб-чата в памяти
+    CONVERSATION_CACHE_TTL_SEC = float(os.environ.get('CONVERSATION_CACHE_TTL_SEC', 3600))
+
+    # === Ingestion (фоновая индексация) ===
+    INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', 2))
+    INGESTION_QUEUE_SIZE = int(os.environ.get('INGESTION_QUEUE_SIZE', 32))
+    INGESTION_BATCH_DOCS = int(os.environ.get('INGESTION_BATCH_DOCS', 4))  # документов в одной задаче воркера
+    # Чанки идут в модель и индекс батчами: память индексации ограничена батчем, а не размером файла
+    INGESTION_CHUNK_BATCH = int(os.environ.get('INGESTION_CHUNK_BATCH', 256))
+    # Разбор PDF/DOCX в отдельных процессах (мимо GIL веб-сервера); 0 — в потоке индексации
+    PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', max(1, min(4, (os.cpu_count() or 2) - 1))))
+    PARSE_PAGES_PER_TASK = int(os.environ.get('PARSE_PAGES_PER_TASK', 32))  # большие PDF режутся на диапазоны
+    # python run.py ingest <папка|zip>: документов на один вызов add_documents и журналы прогресса для возобновления
+    BULK_INGEST_BATCH_DOCS = int(os.environ.get('BULK_INGEST_BATCH_DOCS', 32))
+    BULK_INGEST_STATE_DIR = str(DATA_DIR / "ingest_state")
 
     # === File upload ===
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
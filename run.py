@@ -14,10 +14,21 @@ if project_root not in sys.path:
 
 def main():
     parser = argparse.ArgumentParser(description='Запустить AI Assistant.')
-    parser.add_argument('mode', choices=['web', 'bot', 'both'], nargs='?', default='both',
-                        help='Режим запуска: web (Flask), bot (Telegram бот), both (Flask + Telegram бот)')
+    parser.add_argument('mode', choices=['web', 'bot', 'both', 'ingest'], nargs='?', default='both',
+                        help='Режим запуска: web (Flask), bot (Telegram бот), both (Flask + Telegram бот), '
+                             'ingest (массовая индексация папки или zip-архива)')
+    parser.add_argument('source', nargs='?', help='ingest: папка или zip-архив с документами')
+    parser.add_argument('--batch-docs', type=int, default=None,
+                        help='ingest: документов в одной пачке индексации (по умолчанию BULK_INGEST_BATCH_DOCS)')
+    parser.add_argument('--restart', action='store_true',
+                        help='ingest: забыть прогресс прошлых прогонов этого источника и начать сначала')
     args = parser.parse_args()
 
+    if args.mode == 'ingest':
+        if not args.source:
+            parser.error('ingest: укажите папку или zip-архив')
+        sys.exit(run_ingest(args.source, batch_docs=args.batch_docs, restart=args.restart))
+
     # === ЗАПУСК FLASK ===
     if args.mode in ['web', 'both']:
         print("🚀 Запуск веб-сервера Flask...")
@@ -68,5 +79,45 @@ def main():
                 print("⚠️ Telegram бот не запущен, но Flask работает.")
         # === КОНЕЦ ЗАПУСКА TELEGRAM БОТА ===
 
+def run_ingest(source, batch_docs=None, restart=False):
+    """
+    Индексирует папку или zip-архив без HTTP (см. app/services/bulk_ingest.py).
+    Прерванный прогон продолжается при повторном запуске с тем же источником.
+    """
+    if not os.path.exists(source):
+        print(f"❌ Не найдено: {source}")
+        return 1
+    if os.path.exists('.env'):
+        from dotenv import load_dotenv
+        load_dotenv()
+
+    from app import create_app
+    from app.services.bulk_ingest import BulkIngestor
+    from app.services.rag_engine import build_rag_engine
+
+    app = create_app()
+    with app.app_context():
+        config = app.config
+        ingestor = BulkIngestor(
+            rag_engine=build_rag_engine(config),
+            documents_folder=config['DOCUMENTS_FOLDER'],
+            state_dir=config['BULK_INGEST_STATE_DIR'],
+            extensions=config['ALLOWED_EXTENSIONS'],
+            batch_docs=batch_docs or config['BULK_INGEST_BATCH_DOCS'],
+            progress=lambda stats: print(f"  … проиндексировано {stats['indexed']}, "
+                                         f"дубликатов {stats['duplicates']}, ошибок {stats['failed']}, "
+                                         f"чанков {stats['chunks']}")
+        )
+        print(f"🚀 Индексация {source}...")
+        stats = ingestor.run(source, restart=restart)
+
+    print(f"✅ Готово за {stats['elapsed_sec']} с: проиндексировано {stats['indexed']}, "
+          f"дубликатов {stats['duplicates']}, ошибок {stats['failed']}, "
+          f"пропущено (прошлые прогоны) {stats['skipped']}")
+    print(f"   {stats['chunks']} чанков ({stats['reused_chunks']} без эмбеддинга), "
+          f"{stats['files_per_sec']} files/sec, {stats['chunks_per_sec']} chunks/sec")
+    return 1 if stats['failed'] and not stats['indexed'] else 0
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
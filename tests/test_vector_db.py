@@ -0,0 +1,90 @@
+# tests/test_vector_db.py
+import pytest
+
+np = pytest.importorskip('numpy')
+faiss = pytest.importorskip('faiss')
+
+from app.services.vector_db import VectorDB, INDEX_TYPES, get_index_type
+
+DIMENSION = 16
+# IVF-PQ обучает 256 центроидов на подвектор
+N_VECTORS = 300
+
+
+class FakeEmbeddingService:
+    """VectorDB от модели нужна только размерность: векторы в тестах задаются напрямую."""
+
+    def get_dimension(self) -> int:
+        return DIMENSION
+
+
+def make_db(index_path, index_type, use_mmap=True) -> VectorDB:
+    vector_db = VectorDB(index_path=str(index_path), embedding_model_name='test',
+                         embedding_service=FakeEmbeddingService(), index_type=index_type,
+                         promote_threshold=1, pq_m=4, use_mmap=use_mmap)
+    vector_db.initialize_index()
+    return vector_db
+
+
+def make_vectors(n: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((n, DIMENSION)).astype(np.float32)
+
+
+def make_metadata(n: int, first_doc: int = 1) -> list:
+    return [{'doc_id': first_doc + i // 100, 'chunk_no': i % 100, 'text': f'chunk {first_doc} {i}'}
+            for i in range(n)]
+
+
+@pytest.mark.parametrize('index_type', INDEX_TYPES)
+def test_checkpoint_reloads_with_mmap(tmp_path, index_type):
+    vectors = make_vectors(N_VECTORS)
+    vector_db = make_db(tmp_path, index_type)
+    vector_db.add_embeddings(vectors, make_metadata(N_VECTORS))
+    vector_db.save_index()
+    vector_db.wal.close()
+
+    reloaded = make_db(tmp_path, index_type)
+    assert reloaded.get_index_info()['ntotal'] == N_VECTORS
+    scores, metadata = reloaded.search_vectors(vectors[0], k=3)
+    assert metadata
+
+    # Запись после открытия через mmap переводит индекс на копию в памяти
+    reloaded.add_embeddings(make_vectors(1, seed=1), make_metadata(1, first_doc=100))
+    assert reloaded.get_index_info()['ntotal'] == N_VECTORS + 1
+    assert not reloaded.get_index_info()['mmap']
+    reloaded.wal.close()
+
+
+@pytest.mark.parametrize('index_type', ['flat', 'hnsw'])
+def test_scoped_search_skips_chunks_without_vector(tmp_path, index_type):
+    vectors = make_vectors(10)
+    vector_db = make_db(tmp_path, index_type)
+    vector_db.add_embeddings(vectors, make_metadata(10))
+    # Строка чанка уже в хранилище, а вектора в индексе ещё нет: так видит общее хранилище
+    # поиск во время add_embeddings или процесс, чей индекс отстаёт
+    vector_db.chunks.add([(2 << 20) | 0], make_metadata(1, first_doc=2))
+
+    scope = vector_db.scope_vector_ids([1, 2])
+    assert len(scope) == 11
+    scores, metadata = vector_db.search_vectors_batch([vectors[0]], k=20, vector_ids=scope)[0]
+    assert len(metadata) == 10
+    assert all(meta['doc_id'] == 1 for meta in metadata)
+
+    scores, metadata = vector_db.search_vectors(vectors[0], k=3, doc_ids=[2])
+    assert metadata == []
+    vector_db.wal.close()
+
+
+@pytest.mark.parametrize('index_type', INDEX_TYPES)
+def test_get_index_type(tmp_path, index_type):
+    vector_db = make_db(tmp_path, index_type)
+    vector_db.add_embeddings(make_vectors(N_VECTORS), make_metadata(N_VECTORS))
+    assert get_index_type(vector_db.index) == index_type
+    assert vector_db.get_index_info()['type'] == index_type
+    vector_db.save_index()
+    vector_db.wal.close()
+
+    # Тип читается и у снимка, открытого через mmap
+    reloaded = make_db(tmp_path, index_type)
+    assert reloaded.get_index_info()['type'] == index_type
+    reloaded.wal.close()